@@ -8,19 +8,19 @@ detect tone via sentiment analysis, and generate context-aware replies.
 """
 
 import os
-import re
 import torch
 import numpy as np
-import pandas as pd
-from datasets import load_dataset, Dataset
 from transformers import (
-    AutoTokenizer, AutoModelForSeq2SeqLM, Seq2SeqTrainer, Seq2SeqTrainingArguments,
+    AutoTokenizer, AutoModelForSeq2SeqLM, Seq2SeqTrainingArguments,
     DataCollatorForSeq2Seq, pipeline
 )
 from evaluate import load as load_metric
 import nltk
 from nltk.sentiment import SentimentIntensityAnalyzer
 
+from training_data import load_tokenized_split, TokenBudgetSeq2SeqTrainer
+from training_profile import cpu_training_profile
+
 # -------------------------
 # 1. SETUP
 # -------------------------
@@ -30,6 +30,17 @@ BATCH_SIZE = 4
 EPOCHS = 1
 MAX_SOURCE_LEN = 512
 MAX_TARGET_LEN = 150
+# Token-budget batches never cost more than BATCH_SIZE full-length rows: padded
+# source + label tokens, label tokens alone (decoder logits), and at most MAX_BATCH_SIZE rows
+MAX_TOKENS_PER_BATCH = BATCH_SIZE * (MAX_SOURCE_LEN + MAX_TARGET_LEN)
+MAX_LABEL_TOKENS_PER_BATCH = BATCH_SIZE * MAX_TARGET_LEN
+MAX_BATCH_SIZE = 4 * BATCH_SIZE
+EVAL_SAMPLES = 200  # held-out threads generated at each evaluation
+
+# CPU profile (used only when CUDA is unavailable, see training_profile.py)
+GRAD_ACCUM_STEPS = 2       # micro-batches of MAX_TOKENS_PER_BATCH / GRAD_ACCUM_STEPS
+FREEZE_ENCODER = False
+FREEZE_LOWER_LAYERS = 0    # e.g. 6 freezes the bottom half of the 12-layer encoder
 
 os.makedirs(LOCAL_MODEL_DIR, exist_ok=True)
 
@@ -42,50 +53,19 @@ print(f"✅ Using {'GPU' if device==0 else 'CPU'} for training.")
 tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
 model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_NAME)
 
-# -------------------------
-# 3. LOAD DATASET
-# -------------------------
-print("⏳ Loading dataset from HuggingFace...")
-hf_dataset = load_dataset("sidhq/email-thread-summary")
-train_df = pd.DataFrame(hf_dataset["train"])
+cpu_args = {}
+if device == -1:
+    cpu_args = cpu_training_profile(model, grad_accum_steps=GRAD_ACCUM_STEPS,
+                                    freeze_encoder=FREEZE_ENCODER, freeze_lower_layers=FREEZE_LOWER_LAYERS)
 
 # -------------------------
-# 4. DATA CLEANING
+# 3-5. LOAD, CLEAN & TOKENIZE
 # -------------------------
-def clean_email_text(text):
-    """Remove signatures, email addresses, and redundant formatting."""
-    if text is None:
-        return ""
-    text = re.sub(r"-----Original Message-----.*", " ", text, flags=re.DOTALL | re.IGNORECASE)
-    text = re.sub(r"__+|--+|\*\*+", " ", text)
-    text = re.sub(r"\b[\w\.-]+@[\w\.-]+\.\w+\b", " ", text)
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
-
-def flatten_thread(thread):
-    """Flatten email thread into a single text block."""
-    if not isinstance(thread, dict):
-        return ""
-    subject = thread.get("subject", "")
-    messages = thread.get("messages", [])
-    cleaned = [clean_email_text(m.get("body", "")) for m in messages if isinstance(m, dict)]
-    return subject + "\n" + "\n".join(cleaned)
-
-train_df["flat_text"] = train_df["thread"].apply(flatten_thread)
-train_df["summary"] = train_df["summary"].fillna("")
-
-# -------------------------
-# 5. TOKENIZATION
-# -------------------------
-def tokenize(batch):
-    """Tokenize input (email thread) and target (summary)."""
-    inputs = tokenizer(batch["flat_text"], max_length=MAX_SOURCE_LEN, truncation=True)
-    targets = tokenizer(batch["summary"], max_length=MAX_TARGET_LEN, truncation=True)
-    inputs["labels"] = targets["input_ids"]
-    return inputs
-
-train_dataset = Dataset.from_pandas(train_df)
-tokenized_train = train_dataset.map(tokenize, batched=True)
+# Tokenized split is cached on disk per tokenizer + max lengths (training_data.py)
+print("⏳ Loading dataset from HuggingFace...")
+tokenized_train = load_tokenized_split(tokenizer, MAX_SOURCE_LEN, MAX_TARGET_LEN)
+tokenized_eval = load_tokenized_split(tokenizer, MAX_SOURCE_LEN, MAX_TARGET_LEN, split="eval")
+tokenized_eval = tokenized_eval.select(range(min(EVAL_SAMPLES, len(tokenized_eval))))
 
 # -------------------------
 # 6. DATA COLLATOR
@@ -98,13 +78,17 @@ data_collator = DataCollatorForSeq2Seq(tokenizer, model=model)
 training_args = Seq2SeqTrainingArguments(
     output_dir=LOCAL_MODEL_DIR,
     per_device_train_batch_size=BATCH_SIZE,
+    per_device_eval_batch_size=BATCH_SIZE,
     weight_decay=0.01,
     num_train_epochs=EPOCHS,
     save_total_limit=2,
     logging_steps=50,
     fp16=device == 0,
     evaluation_strategy="epoch",
-    push_to_hub=False
+    predict_with_generate=True,
+    generation_max_length=MAX_TARGET_LEN,
+    push_to_hub=False,
+    **cpu_args
 )
 
 # -------------------------
@@ -115,26 +99,36 @@ rouge_metric = load_metric("rouge")
 def compute_metrics(eval_pred):
     """Compute ROUGE scores to evaluate summarization quality."""
     preds, labels = eval_pred
+    # -100 marks ignored positions; it is not a valid token id for decoding
+    preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
+    labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
     decoded_preds = tokenizer.batch_decode(preds, skip_special_tokens=True)
     decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
     result = rouge_metric.compute(predictions=decoded_preds, references=decoded_labels)
-    result = {k: round(v.mid.fmeasure * 100, 2) for k, v in result.items()}
+    # evaluate returns floats; older datasets metrics returned aggregate scores
+    result = {k: round((v.mid.fmeasure if hasattr(v, "mid") else v) * 100, 2) for k, v in result.items()}
     return result
 
 # -------------------------
 # 9. TRAINER
 # -------------------------
-trainer = Seq2SeqTrainer(
+trainer = TokenBudgetSeq2SeqTrainer(
     model=model,
     args=training_args,
     train_dataset=tokenized_train,
+    eval_dataset=tokenized_eval,
     tokenizer=tokenizer,
     data_collator=data_collator,
     compute_metrics=compute_metrics,
+    max_tokens_per_batch=MAX_TOKENS_PER_BATCH // cpu_args.get("gradient_accumulation_steps", 1),
+    max_label_tokens_per_batch=MAX_LABEL_TOKENS_PER_BATCH // cpu_args.get("gradient_accumulation_steps", 1),
+    max_batch_size=max(1, MAX_BATCH_SIZE // cpu_args.get("gradient_accumulation_steps", 1)),
 )
 
 print("⏳ Starting fine-tuning...")
 trainer.train()
+# Re-enable the KV cache before saving, so the saved config generates with it too
+model.config.use_cache = True
 trainer.save_model(LOCAL_MODEL_DIR)
 print(f"✅ Fine-tuned model saved at {LOCAL_MODEL_DIR}")
 
@@ -196,3 +190,5 @@ print("\n✉️ Suggested Reply:\n", result["suggested_reply"])
 # -------------------------
 # After training, ROUGE-L values and qualitative summaries are used
 # to assess performance. Tone-based responses provide interpretability.
+# For ROUGE vs. CPU latency across base / fine-tuned / optimized models,
+# run: python evaluate_models.py --quantize
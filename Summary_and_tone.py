@@ -1,13 +1,28 @@
+import os
 import torch
 import json
 import sys
 import re
+import hashlib
+import time
+import argparse
+from collections import deque
 from transformers import (
     AutoTokenizer,
     AutoModelForSeq2SeqLM,
     pipeline,
 )
-from bs4 import BeautifulSoup
+from email_text import clean_text, is_html
+from digest import (digest_groups, update_digest_groups, digest_from_groups, load_digest_cache, save_digest_cache,
+                    load_digest_groups, save_digest_groups, DIGEST_CACHE_PATH, DIGEST_GROUPS_PATH)
+from search_index import update_search_index, SEARCH_INDEX_DIR
+from recategorize import (email_fields, score_keywords, regex_counts, update_keyword_index,
+                          CATEGORY_MIN_SCORE, KEYWORD_INDEX_PATH)
+from body_store import BodyStore, load_body, migrate_bodies, BODY_STORE_DIR
+from training_profile import peak_memory_mb, current_memory_mb
+from learned_categorizer import load_categorizer, save_categorizer, LEARNED_MODEL_PATH
+from autotune import load_tuned_settings, use_threads, set_inter_op_threads
+from smart_reply import generate_replies, REPLY_INTENTS, FALLBACK_REPLY
 
 # ========== 1. DEVICE CHECK ==========
 if torch.cuda.is_available():
@@ -20,20 +35,38 @@ else:
 # ========== 2. MODEL LOADING ==========
 print("⏳ Loading DistilBART summarizer, sentiment analyzer, and reply generator...", file=sys.stderr)
 
-# Summarization model (DistilBART)
-summarizer_model = "sshleifer/distilbart-cnn-12-6"
+# Summarization model (DistilBART). Point GM_SUMMARIZER_MODEL at a local checkpoint,
+# e.g. the distilled ./distilbart_student from distill.py, to serve a different model.
+summarizer_model = os.environ.get("GM_SUMMARIZER_MODEL", "sshleifer/distilbart-cnn-12-6")
+tone_model = "distilbert-base-uncased-finetuned-sst-2-english"
+reply_model = "google/flan-t5-base"
+
+# Batch sizes and thread counts measured on this host by autotune.py, if it has been run
+tuned = load_tuned_settings([summarizer_model, tone_model, reply_model])
+if tuned:
+    # Inter-op threads are process-wide and must be set before the models run
+    set_inter_op_threads(tuned.get(summarizer_model) or next(iter(tuned.values())))
+    for model_id, settings in tuned.items():
+        print(f"⚙️ {model_id}: batch {settings['batch_size']}, {settings['intra_op_threads']} threads (autotuned)", file=sys.stderr)
+        multi = settings.get("multiProcess")
+        if multi:
+            print(f"ℹ️ {model_id}: {multi['workers']} processes x {multi['intra_op_threads']} threads reach "
+                  f"{multi['throughput']} emails/s on this host (one process: {settings['throughput']}); "
+                  f"split --mailboxes between that many runs to use it", file=sys.stderr)
+else:
+    print("ℹ️ No autotune profile for this host, using default batch sizes (run autotune.py)", file=sys.stderr)
+
 tokenizer_sum = AutoTokenizer.from_pretrained(summarizer_model)
 model_sum = AutoModelForSeq2SeqLM.from_pretrained(summarizer_model)
 summarizer = pipeline("summarization", model=model_sum, tokenizer=tokenizer_sum, device=device)
 
 # Sentiment / tone model
-tone_model = "distilbert-base-uncased-finetuned-sst-2-english"
 tone_analyzer = pipeline("sentiment-analysis", model=tone_model, device=device)
 
 # Smart Reply model
 reply_generator = pipeline(
     "text2text-generation",
-    model="google/flan-t5-base",
+    model=reply_model,
     device=device
 )
 
@@ -64,66 +97,23 @@ def save_json_file(filepath, data):
         return False
 
 # ========== 4. CLEAN TEXT ==========
-def clean_text(text):
-    """Remove HTML tags and clean text"""
-    if not text:
-        return ""
-    # Remove HTML tags
-    text = BeautifulSoup(text, "html.parser").get_text()
-    # Remove excessive whitespace, newlines, tabs
-    text = re.sub(r'\s+', ' ', text)
-    # Remove special characters but keep punctuation
-    text = re.sub(r'[^\w\s\.,!?\-]', '', text)
-    return text.strip()
-
-def is_html(text):
-    """Check if text contains HTML"""
-    if not text:
-        return False
-    return bool(re.search(r'<[^>]+>', text))
+# clean_text / is_html live in email_text.py, shared with the training scripts
 
 # ========== 5. IMPROVED CATEGORIZE EMAIL ==========
 def categorize_email(subject, body, snippet, templates):
     """Categorize email based on keywords from template.json with improved matching"""
-    subject_text = clean_text(subject).lower()
-    body_text = clean_text(body).lower()
-    snippet_text = clean_text(snippet).lower()
-    
-    combined_text = f"{subject_text} {subject_text} {body_text} {snippet_text}"
-    
+    # Scoring is shared with recategorize.py, which applies rule changes incrementally
+    fields = email_fields(subject, body, snippet)
+
     categories = []
     category_scores = {}
 
     for rule in templates.get('rules', []):
         category = rule.get('category', '')
         keywords = rule.get('keywords', [])
-        
-        score = 0
-        matched_keywords = []
-        
-        for kw in keywords:
-            kw_lower = kw.lower().strip()
-            if not kw_lower:
-                continue
-                
-            pattern = r'\b' + re.escape(kw_lower) + r'\b'
-            
-            subject_matches = len(re.findall(pattern, subject_text))
-            body_matches = len(re.findall(pattern, body_text))
-            snippet_matches = len(re.findall(pattern, snippet_text))
-            
-            if subject_matches > 0:
-                score += subject_matches * 3
-                matched_keywords.append(kw)
-            if body_matches > 0:
-                score += body_matches * 2
-                if kw not in matched_keywords:
-                    matched_keywords.append(kw)
-            if snippet_matches > 0:
-                score += snippet_matches * 1
-                if kw not in matched_keywords:
-                    matched_keywords.append(kw)
-        
+
+        score, matched_keywords = score_keywords(keywords, lambda kw: regex_counts(kw, fields))
+
         if score > 0:
             category_scores[category.lower()] = {
                 'score': score,
@@ -131,7 +121,7 @@ def categorize_email(subject, body, snippet, templates):
             }
 
     for cat, data in category_scores.items():
-        if data['score'] >= 2:
+        if data['score'] >= CATEGORY_MIN_SCORE:
             categories.append(cat)
             print(f"  ✓ Matched category '{cat}' (score: {data['score']}, keywords: {', '.join(data['matched'])})", file=sys.stderr)
 
@@ -246,120 +236,267 @@ def detect_tone_advanced(text, sentiment_result):
     return tone, combined_conf
 
 # ========== 7. SMART REPLY GENERATION ==========
-def generate_smart_reply(email_subject, email_body, email_snippet):
-    """Generate smart reply suggestions using Flan-T5"""
+# One candidate per intent in REPLY_INTENTS, decoded from a single encoder pass per
+# batch (see smart_reply.py, which autotune.py benchmarks directly).
+def generate_smart_replies(emails):
+    """Reply candidates for [(subject, body, snippet), ...]: [[{"intent", "text"}, ...], ...]"""
     try:
-        # Use snippet or body for context
-        email_text = clean_text(email_body) if email_body and len(email_body) < 500 else clean_text(email_snippet)
-        
-        # Limit text length
-        if len(email_text) > 300:
-            email_text = email_text[:300]
-        
-        # Create prompt
-        prompt = f"Write a polite and professional email reply to this message:\n\nSubject: {email_subject}\nMessage: {email_text}\n\nReply:"
-        
-        # Generate reply
-        response = reply_generator(prompt, max_length=150, min_length=20, do_sample=False)[0]['generated_text']
-        
-        print(f"  🤖 Generated smart reply: {response[:50]}...", file=sys.stderr)
-        return response.strip()
-        
+        use_threads(tuned.get(reply_model))
+        candidates = generate_replies(reply_generator.model, reply_generator.tokenizer, emails)
+        for c in candidates:
+            print(f"  🤖 Generated {len(c)} smart replies: {c[0]['text'][:50]}...", file=sys.stderr)
+        return candidates
+
     except Exception as e:
         print(f"  ⚠️ Smart reply generation failed: {e}", file=sys.stderr)
-        return "Thank you for your email. I'll get back to you shortly."
+        return [[{"intent": REPLY_INTENTS[0][0], "text": FALLBACK_REPLY}] for _ in emails]
+
+# ========== 8. LONG EMAIL SUMMARIZATION ==========
+# Long emails are split on sentence boundaries into chunks that fit the encoder,
+# the chunks are summarized as one batch, and the chunk summaries are reduced
+# (recursively if needed) into the final summary. Chunk summaries are cached by
+# content, so an edited or extended email only re-summarizes the chunks that changed.
+CHUNK_TOKENS = 900          # leaves room for "Subject: ..." under the 1024-token limit
+SUMMARY_BATCH_SIZE = tuned.get(summarizer_model, {}).get("batch_size", 8)
+SUMMARY_CACHE_PATH = "summary_cache.json"
+SUMMARY_CACHE_MAX_ENTRIES = 20000
+SUMMARY_KWARGS = {"max_length": 120, "min_length": 30, "do_sample": False}
+SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+")
+
+def count_tokens(text):
+    return len(tokenizer_sum(text, add_special_tokens=False)["input_ids"])
+
+def split_into_chunks(text, max_tokens=CHUNK_TOKENS):
+    """Greedily pack sentences into chunks of at most max_tokens tokens"""
+    sentences = [s for s in SENTENCE_SPLIT_RE.split(text) if s.strip()]
+    if not sentences:
+        return []
+    token_ids = tokenizer_sum(sentences, add_special_tokens=False)["input_ids"]
+    chunks, current, current_len = [], [], 0
+    for sentence, ids in zip(sentences, token_ids):
+        if current and current_len + len(ids) > max_tokens:
+            chunks.append(" ".join(current))
+            current, current_len = [], 0
+        if len(ids) > max_tokens:
+            # A single run-on "sentence" longer than a chunk is cut on token boundaries
+            chunks.extend(tokenizer_sum.decode(ids[i:i + max_tokens]) for i in range(0, len(ids), max_tokens))
+            continue
+        current.append(sentence)
+        current_len += len(ids)
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def load_summary_cache(path=SUMMARY_CACHE_PATH):
+    cache = load_json_file(path) if os.path.exists(path) else None
+    return cache if isinstance(cache, dict) else {}
+
+def save_summary_cache(cache, path=SUMMARY_CACHE_PATH):
+    # Hits are moved to the end, so the front holds the least recently used entries
+    if len(cache) > SUMMARY_CACHE_MAX_ENTRIES:
+        for key in list(cache)[:len(cache) - SUMMARY_CACHE_MAX_ENTRIES]:
+            del cache[key]
+    save_json_file(path, cache)
+
+def chunk_cache_key(text):
+    payload = json.dumps([summarizer_model, SUMMARY_KWARGS, text], sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def summarize_chunks(chunks, cache):
+    """Summarize chunks in one batched call, reusing cached chunk summaries"""
+    keys = [chunk_cache_key(c) for c in chunks]
+    missing = [(k, c) for k, c in zip(keys, chunks) if k not in cache]
+    for key in keys:
+        if key in cache:
+            cache[key] = cache.pop(key)
+    if missing:
+        use_threads(tuned.get(summarizer_model))
+        results = summarizer(
+            [c for _, c in missing],
+            truncation=True,
+            batch_size=SUMMARY_BATCH_SIZE,
+            **SUMMARY_KWARGS
+        )
+        for (key, _), result in zip(missing, results):
+            cache[key] = result["summary_text"]
+    print(f"  🧩 {len(chunks)} chunk(s), {len(chunks) - len(missing)} from cache", file=sys.stderr)
+    return [cache[k] for k in keys]
+
+def reduce_to_chunk(text, cache):
+    """Summarize chunks of text, then their summaries, until one chunk remains"""
+    chunks = split_into_chunks(text)
+    while len(chunks) > 1:
+        chunks = split_into_chunks(" ".join(summarize_chunks(chunks, cache)))
+    return chunks[0] if chunks else ""
+
+def summarize_long_text(subject, text, cache):
+    """Map-reduce summary of text that does not fit in one encoder pass"""
+    body = reduce_to_chunk(text, cache)
+    return summarize_chunks([f"Subject: {subject}\n\n{body}"], cache)[0]
+
+def summarize_text(text, cache):
+    """Summary of text of any length (used for the inbox digest)"""
+    return summarize_chunks([reduce_to_chunk(text, cache)], cache)[0]
+
+# ========== 9. PROCESS EMAIL ==========
+TONE_BATCH_SIZE = tuned.get(tone_model, {}).get("batch_size", 16)
+
+def prepare_email(email_data, store=None):
+    """Subject, body, snippet and the cleaned text the models see"""
+    subject = email_data.get('subject', '')
+    # Inline for records straight from Gmail, else decompressed from the body store
+    body = load_body(email_data, store)
+    snippet = email_data.get('snippet', '')
+
+    # HTML bodies are reduced to their text; long ones are then chunked like plain bodies
+    plain_text = clean_text(body) if body else ""
+    if not plain_text:
+        plain_text = clean_text(snippet)
+    elif is_html(body):
+        print(f"  📧 Email {email_data.get('id', 'unknown')}: HTML body cleaned to {len(plain_text.split())} words", file=sys.stderr)
+    return {
+        "subject": subject,
+        "body": body,
+        "snippet": snippet,
+        "plain_text": plain_text,
+        "text_for_summary": f"Subject: {subject}\n\n{plain_text}",
+    }
+
+def fallback_analysis(email_data):
+    return {
+        "aiSummary": {
+            "summary": clean_text(email_data.get('snippet', 'Unable to generate summary'))[:120],
+            "tone": "Neutral",
+            "confidence": 0.0
+        },
+        "categories": []
+    }
+
+def summarize_batch(items, ai_settings, summary_cache):
+    """Summaries for prepared emails; the short ones share one batched summarizer call"""
+    summaries = [item["text_for_summary"][:120] for item in items]
+    if not ai_settings.get("emailSummarization", True):
+        return summaries
 
-# ========== 8. PROCESS EMAIL ==========
-def process_email(email_data, templates, ai_settings):
-    """Analyze a single email for summary, tone, and smart reply"""
-    try:
-        email_id = email_data.get('id', 'unknown')
-        subject = email_data.get('subject', '')
-        body = email_data.get('body', '')
-        snippet = email_data.get('snippet', '')
-
-        # Check if body is HTML
-        if is_html(body):
-            print(f"  📧 Email {email_id}: HTML detected, using snippet for summary", file=sys.stderr)
-            text_for_summary = f"Subject: {subject}\n\n{clean_text(snippet)}"
-        else:
-            plain_text = clean_text(body) if body else clean_text(snippet)
-            text_for_summary = f"Subject: {subject}\n\n{plain_text}"
+    short = []
+    for i, item in enumerate(items):
+        text = item["text_for_summary"]
+        if len(text.split()) <= 30:
+            continue
+        try:
+            if count_tokens(text) > CHUNK_TOKENS:
+                print(f"  📚 Email {item['id']}: long input, using chunked summarization", file=sys.stderr)
+                summaries[i] = summarize_long_text(item["subject"], item["plain_text"], summary_cache)
+            else:
+                short.append(i)
+        except Exception as e:
+            print(f"  ⚠️ Summarization failed: {e}", file=sys.stderr)
 
-        # Truncate if too long
-        if len(text_for_summary) > 3000:
-            text_for_summary = text_for_summary[:3000]
+    if short:
+        try:
+            use_threads(tuned.get(summarizer_model))
+            results = summarizer(
+                [items[i]["text_for_summary"] for i in short],
+                truncation=True,
+                batch_size=SUMMARY_BATCH_SIZE,
+                **SUMMARY_KWARGS
+            )
+            for i, result in zip(short, results):
+                summaries[i] = result["summary_text"]
+        except Exception as e:
+            print(f"  ⚠️ Summarization failed: {e}", file=sys.stderr)
+    return summaries
 
-        # Generate summary if enabled and text is long enough
-        if ai_settings.get("emailSummarization", True) and len(text_for_summary.split()) > 30:
-            try:
-                summary_result = summarizer(
-                    text_for_summary, 
-                    max_length=120, 
-                    min_length=30, 
-                    do_sample=False,
-                    truncation=True
-                )[0]["summary_text"]
-            except Exception as e:
-                print(f"  ⚠️ Summarization failed: {e}", file=sys.stderr)
-                summary_result = text_for_summary[:120]
-        else:
-            summary_result = text_for_summary[:120]
+def detect_tone_batch(items):
+    """(tone, confidence) per prepared email from one batched sentiment call"""
+    tone_texts = [item["text_for_summary"][:512] for item in items]
+    try:
+        use_threads(tuned.get(tone_model))
+        results = tone_analyzer(tone_texts, batch_size=TONE_BATCH_SIZE)
+        return [detect_tone_advanced(text, result) for text, result in zip(tone_texts, results)]
+    except Exception as e:
+        print(f"  ⚠️ Tone detection failed: {e}", file=sys.stderr)
+        return [("Neutral", 0.5)] * len(items)
 
-        # Detect tone
-        tone_text = text_for_summary[:512]
+def learned_categories_batch(items, templates, categorizer):
+    """Categories from the learned categorizer for the whole batch (one matrix multiply)"""
+    categories = {r.get('category', '').lower() for r in templates.get('rules', [])}
+    try:
+        return categorizer.predict([(item["subject"], item["body"], item["snippet"]) for item in items], categories)
+    except Exception as e:
+        print(f"  ⚠️ Learned categorization failed: {e}", file=sys.stderr)
+        return [[] for _ in items]
+
+def process_batch(emails, templates, ai_settings, summary_cache=None, store=None, categorizer=None):
+    """Analyze a batch of emails from one mailbox; returns one result per email, in order"""
+    summary_cache = summary_cache if summary_cache is not None else {}
+    results = [None] * len(emails)
+    items, positions = [], []
+    for i, email_data in enumerate(emails):
         try:
-            tone_result = tone_analyzer(tone_text)[0]
-            tone, confidence = detect_tone_advanced(tone_text, tone_result)
+            item = prepare_email(email_data, store)
+            item["id"] = email_data.get('id', 'unknown')
+            items.append(item)
+            positions.append(i)
         except Exception as e:
-            print(f"  ⚠️ Tone detection failed: {e}", file=sys.stderr)
-            tone = "Neutral"
-            confidence = 0.5
-
-        # Categorize email
-        categories = categorize_email(subject, body, snippet, templates)
-        
-        if categories:
-            print(f"  ✓ Categorized as: {', '.join(categories)}", file=sys.stderr)
-
-        # Generate smart reply if enabled
-        smart_reply = None
-        if ai_settings.get("smartReplyGeneration", True):
-            smart_reply = generate_smart_reply(subject, body, snippet)
-
-        result = {
-            "aiSummary": {
-                "summary": summary_result,
-                "tone": tone,
-                "confidence": round(confidence, 2)
-            },
-            "categories": categories
-        }
-        
-        if smart_reply:
-            result["smartReply"] = smart_reply
+            print(f"⚠️ Error processing email {email_data.get('id', 'unknown')}: {e}", file=sys.stderr)
+            results[i] = fallback_analysis(email_data)
+
+    summaries = summarize_batch(items, ai_settings, summary_cache) if items else []
+    tones = detect_tone_batch(items) if items else []
+    # Generate smart replies if enabled: all intents for the whole batch at once
+    if items and ai_settings.get("smartReplyGeneration", True):
+        replies = generate_smart_replies([(item["subject"], item["body"], item["snippet"]) for item in items])
+    else:
+        replies = [None] * len(items)
+    if items and categorizer is not None:
+        learned = learned_categories_batch(items, templates, categorizer)
+    else:
+        learned = [[] for _ in items]
+    for item, i, summary_result, (tone, confidence), smart_replies, learned_categories in zip(
+            items, positions, summaries, tones, replies, learned):
+        try:
+            # Categorize email: keyword rules, plus what the learned categorizer adds
+            categories = categorize_email(item["subject"], item["body"], item["snippet"], templates)
+            extra = [c for c in learned_categories if c not in categories]
+            if extra:
+                print(f"  🧠 Learned categories: {', '.join(extra)}", file=sys.stderr)
+                categories += extra
+
+            if categories:
+                print(f"  ✓ Categorized as: {', '.join(categories)}", file=sys.stderr)
+
+            result = {
+                "aiSummary": {
+                    "summary": summary_result,
+                    "tone": tone,
+                    "confidence": round(confidence, 2)
+                },
+                "categories": categories,
+                "learnedCategories": extra
+            }
 
-        return result
+            if smart_replies:
+                result["smartReply"] = smart_replies[0]["text"]
+                result["smartReplies"] = smart_replies
 
-    except Exception as e:
-        print(f"⚠️ Error processing email {email_data.get('id', 'unknown')}: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc(file=sys.stderr)
-        
-        return {
-            "aiSummary": {
-                "summary": clean_text(email_data.get('snippet', 'Unable to generate summary'))[:120],
-                "tone": "Neutral",
-                "confidence": 0.0
-            },
-            "categories": []
-        }
+            results[i] = result
+
+        except Exception as e:
+            print(f"⚠️ Error processing email {item['id']}: {e}", file=sys.stderr)
+            import traceback
+            traceback.print_exc(file=sys.stderr)
+            results[i] = fallback_analysis(emails[i])
+    return results
 
-# ========== 9. MAIN EXECUTION ==========
-def main():
-    # Load AI settings first
-    print("📂 Loading AI_settings.json...", file=sys.stderr)
-    ai_settings = load_json_file("AI_settings.json")
+def process_email(email_data, templates, ai_settings, summary_cache=None, store=None, categorizer=None):
+    """Analyze a single email for summary, tone, and smart reply"""
+    return process_batch([email_data], templates, ai_settings, summary_cache, store, categorizer)[0]
+
+# ========== 10. MAIN EXECUTION ==========
+def load_ai_settings(path="AI_settings.json"):
+    print(f"📂 Loading {path}...", file=sys.stderr)
+    ai_settings = load_json_file(path)
     if not ai_settings:
         print("⚠️ AI settings not found, using defaults", file=sys.stderr)
         ai_settings = {
@@ -367,78 +504,369 @@ def main():
             "aiAutoCategorization": True,
             "smartReplyGeneration": True
         }
-    
-    # Check if AI processing is disabled
-    if not ai_settings.get("emailSummarization", True):
-        print("ℹ️ Email summarization is disabled, skipping AI processing", file=sys.stderr)
-        sys.exit(0)
-    
-    # Load database
-    print("📂 Loading database.json...", file=sys.stderr)
-    database = load_json_file("database.json")
-    if not database:
-        print("❌ Failed to load database.json", file=sys.stderr)
-        sys.exit(1)
+    return ai_settings
+
+def apply_analysis(email, analysis, templates, ai_settings):
+    """Write process_email results onto the email record"""
+    # Update email with AI summary
+    email['aiSummary'] = analysis['aiSummary']
+
+    # Add smart reply if available
+    if 'smartReply' in analysis:
+        email['smartReply'] = analysis['smartReply']
+        email['smartReplies'] = analysis['smartReplies']
+
+    # Add categories to labels if auto-categorization is enabled
+    if ai_settings.get("aiAutoCategorization", True):
+        existing_labels = email.get('labels', [])
+        new_categories = analysis['categories']
+
+        # Remove old AI categories first
+        ai_categories = [r['category'].lower() for r in templates.get('rules', [])]
+        existing_labels = [l for l in existing_labels if l not in ai_categories]
+
+        # Merge new categories with existing labels
+        all_labels = list(set(existing_labels + new_categories))
+        email['labels'] = all_labels
+        # Kept apart so the learned categorizer never trains on its own predictions
+        email['learnedLabels'] = analysis.get('learnedCategories', [])
+
+    # Clear new_email flag after processing
+    email['new_email'] = False
+
+def build_inbox_digest(groups, summary_cache, cache_path=DIGEST_CACHE_PATH):
+    """Per-label group summaries combined into one, memoized per node. None if it failed."""
+    print("🗂️ Building inbox digest...", file=sys.stderr)
+    try:
+        digest_cache = load_digest_cache(cache_path)
+        digest = digest_from_groups(
+            groups,
+            summarize=lambda text: summarize_text(text, summary_cache),
+            cache=digest_cache,
+            model_id=summarizer_model
+        )
+        save_digest_cache(digest_cache, cache_path)
+        stats = digest["stats"]
+        print(f"✅ Digest: {len(digest['groups'])} groups, "
+              f"{stats['computed']} nodes computed, {stats['cached']} from cache", file=sys.stderr)
+        return digest
+    except Exception as e:
+        print(f"⚠️ Digest generation failed: {e}", file=sys.stderr)
+        return None
 
-    # Load templates
-    print("📂 Loading template.json...", file=sys.stderr)
-    templates = load_json_file("template.json")
-    if not templates:
-        print("❌ Failed to load template.json", file=sys.stderr)
-        sys.exit(1)
+class Mailbox:
+    """One account: database, rules, settings, caches and indexes under one directory"""
+
+    def __init__(self, root="."):
+        self.root = root
+        self.name = os.path.normpath(root)
+        self.database = self.templates = self.ai_settings = self.store = self.categorizer = None
+        self.emails = []
+        self.pending = deque()
+        self.summary_cache = {}
+        self.stats = {"processed": 0, "batches": 0, "seconds": 0.0, "total_seconds": 0.0, "rss_growth_mb": 0.0}
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def _count_rss_growth(self, before):
+        # The models are shared, so only what this mailbox's own work leaves resident is its own
+        after = current_memory_mb()
+        if before is not None and after is not None:
+            self.stats["rss_growth_mb"] += after - before
+
+    def load(self):
+        """Read settings, rules and emails. Returns False when there is nothing to do."""
+        start = time.perf_counter()
+        rss_before = current_memory_mb()
+        # Load AI settings first
+        self.ai_settings = load_ai_settings(self.path("AI_settings.json"))
+
+        # Check if AI processing is disabled
+        if not self.ai_settings.get("emailSummarization", True):
+            print(f"ℹ️ [{self.name}] Email summarization is disabled, skipping AI processing", file=sys.stderr)
+            return False
+
+        # Load database
+        database_path = self.path("database.json")
+        print(f"📂 Loading {database_path}...", file=sys.stderr)
+        self.database = load_json_file(database_path)
+        if not self.database:
+            raise RuntimeError(f"Failed to load {database_path}")
+
+        # Load templates
+        template_path = self.path("template.json")
+        print(f"📂 Loading {template_path}...", file=sys.stderr)
+        self.templates = load_json_file(template_path)
+        if not self.templates:
+            raise RuntimeError(f"Failed to load {template_path}")
+
+        self.emails = self.database.get('emails', [])
+        if not self.emails:
+            print(f"⚠️ [{self.name}] No emails found in database", file=sys.stderr)
+            return False
+
+        # Bodies synced since the last run move into the compressed body store
+        self.store = BodyStore(self.path(BODY_STORE_DIR))
+        moved = migrate_bodies(self.emails, self.store)
+        if moved:
+            print(f"📦 [{self.name}] Moved {moved} email bodies into the body store", file=sys.stderr)
+
+        self.summary_cache = load_summary_cache(self.path(SUMMARY_CACHE_PATH))
+        if self.ai_settings.get("learnedCategorization", False):
+            self.categorizer = load_categorizer(self.path(LEARNED_MODEL_PATH))
+        # Only process emails without aiSummary or with new_email flag
+        self.pending = deque(e for e in self.emails if e.get('new_email', False) or not e.get('aiSummary'))
+        print(f"📧 [{self.name}] {len(self.pending)} of {len(self.emails)} emails to process "
+              f"({len(self.emails) - len(self.pending)} already processed)", file=sys.stderr)
+        self.stats["total_seconds"] += time.perf_counter() - start
+        self._count_rss_growth(rss_before)
+        return True
 
-    emails = database.get('emails', [])
-    if not emails:
-        print("⚠️ No emails found in database", file=sys.stderr)
-        sys.exit(0)
+    def process_next(self, batch_size):
+        """Analyze up to batch_size pending emails as one batch. Returns how many."""
+        batch = [self.pending.popleft() for _ in range(min(batch_size, len(self.pending)))]
+        if not batch:
+            return 0
+        start = time.perf_counter()
+        rss_before = current_memory_mb()
+        for email in batch:
+            print(f"  [{self.name}] Processing email: {email.get('subject', 'No subject')[:50]}...", file=sys.stderr)
+        analyses = process_batch(batch, self.templates, self.ai_settings, self.summary_cache, self.store,
+                                 self.categorizer)
+        for email, analysis in zip(batch, analyses):
+            apply_analysis(email, analysis, self.templates, self.ai_settings)
+
+        elapsed = time.perf_counter() - start
+        self.stats["processed"] += len(batch)
+        self.stats["batches"] += 1
+        self.stats["seconds"] += elapsed
+        self.stats["total_seconds"] += elapsed
+        self._count_rss_growth(rss_before)
+        return len(batch)
+
+    def finish(self):
+        """Digest, caches and indexes, then save the database. Returns False if saving failed."""
+        start = time.perf_counter()
+        emails = self.emails
+        print(f"✅ [{self.name}] Updated {self.stats['processed']} emails", file=sys.stderr)
+
+        # Saved groups let the stream worker update the digest without reading the mailbox
+        groups = digest_groups(emails, self.templates)
+        save_digest_groups(groups, self.path(DIGEST_GROUPS_PATH))
+        digest = build_inbox_digest(groups, self.summary_cache, self.path(DIGEST_CACHE_PATH))
+        if digest is not None:
+            self.database["digest"] = digest
+        save_summary_cache(self.summary_cache, self.path(SUMMARY_CACHE_PATH))
+
+        # Search index: only new or changed emails are re-tokenized
+        try:
+            stats = update_search_index(emails, root=self.path(SEARCH_INDEX_DIR), store=self.store)
+            print(f"🔎 Search index: {stats['docs']} emails, +{stats['added']} ~{stats['updated']} "
+                  f"-{stats['removed']} in {stats['seconds']}s", file=sys.stderr)
+        except Exception as e:
+            print(f"⚠️ Search index update failed: {e}", file=sys.stderr)
 
-    print(f"📧 Processing {len(emails)} emails...", file=sys.stderr)
+        # Keyword index used by recategorize.py when template rules change
+        try:
+            stats = update_keyword_index(emails, path=self.path(KEYWORD_INDEX_PATH), store=self.store)
+            print(f"🏷️ Keyword index: {stats['docs']} emails, +{stats['added']} ~{stats['updated']} "
+                  f"-{stats['removed']}", file=sys.stderr)
+        except Exception as e:
+            print(f"⚠️ Keyword index update failed: {e}", file=sys.stderr)
 
-    # Process each email
-    updated_count = 0
-    for idx, email in enumerate(emails, 1):
-        # Only process emails without aiSummary or with new_email flag
-        if email.get('new_email', False) or not email.get('aiSummary'):
-            print(f"  Processing email {idx}/{len(emails)}: {email.get('subject', 'No subject')[:50]}...", file=sys.stderr)
-            
-            analysis = process_email(email, templates, ai_settings)
-            
-            # Update email with AI summary
-            email['aiSummary'] = analysis['aiSummary']
-            
-            # Add smart reply if available
-            if 'smartReply' in analysis:
-                email['smartReply'] = analysis['smartReply']
-            
-            # Add categories to labels if auto-categorization is enabled
-            if ai_settings.get("aiAutoCategorization", True):
-                existing_labels = email.get('labels', [])
-                new_categories = analysis['categories']
-                
-                # Remove old AI categories first
-                ai_categories = [r['category'].lower() for r in templates.get('rules', [])]
-                existing_labels = [l for l in existing_labels if l not in ai_categories]
-                
-                # Merge new categories with existing labels
-                all_labels = list(set(existing_labels + new_categories))
-                email['labels'] = all_labels
-            
-            # Clear new_email flag after processing
-            email['new_email'] = False
-            
-            updated_count += 1
+        # Learned categorizer: incremental training on newly labeled emails
+        if self.categorizer is not None:
+            try:
+                trained = self.categorizer.partial_fit(emails, self.templates.get('rules', []), self.store)
+                if trained:
+                    save_categorizer(self.categorizer, self.path(LEARNED_MODEL_PATH))
+                print(f"🧠 Learned categorizer: trained on {trained} new or changed emails", file=sys.stderr)
+            except Exception as e:
+                print(f"⚠️ Learned categorizer training failed: {e}", file=sys.stderr)
+        self.store.close()
+
+        # Save updated database
+        print("💾 Saving updated database...", file=sys.stderr)
+        saved = save_json_file(self.path("database.json"), self.database)
+        self.stats["total_seconds"] += time.perf_counter() - start
+        if saved:
+            print(f"✅ [{self.name}] Processing complete!", file=sys.stderr)
         else:
-            print(f"  Skipping email {idx}/{len(emails)}: Already processed", file=sys.stderr)
+            print(f"❌ [{self.name}] Failed to save database", file=sys.stderr)
+        return saved
 
-    print(f"✅ Updated {updated_count} emails", file=sys.stderr)
+def main(batch_size=None):
+    mailbox = Mailbox(".")
+    try:
+        if not mailbox.load():
+            sys.exit(0)
+    except RuntimeError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        sys.exit(1)
 
-    # Save updated database
-    print("💾 Saving updated database...", file=sys.stderr)
-    if save_json_file("database.json", database):
-        print("✅ Processing complete!", file=sys.stderr)
-    else:
-        print("❌ Failed to save database", file=sys.stderr)
+    while mailbox.pending:
+        mailbox.process_next(batch_size or TENANT_BATCH_SIZE)
+
+    if not mailbox.finish():
         sys.exit(1)
 
+# ========== 11. STREAM MODE ==========
+# `python Summary_and_tone.py --stdin` is the long-running worker used by syncEmails:
+# it reads email records as JSON lines on stdin and writes one JSON line per processed
+# email to stdout with only the fields it changed. Records are analyzed together, in
+# batches of TENANT_BATCH_SIZE or whatever has arrived when a {"flush": true} line
+# comes. {"deleted": [ids]} names emails that left the mailbox. On flush, the new
+# emails are added to the indexes and deleted ones removed, the digest groups they
+# touch are re-summarized, caches are saved, and {"flushed": true, "processed": n,
+# "digest": ...} is written back (no digest when nothing changed). database.json is
+# never read, so a handful of new emails costs the same regardless of mailbox size;
+# the full-mailbox rebuild and prune happen in --full runs.
+DELTA_FIELDS = ("id", "aiSummary", "smartReply", "smartReplies", "labels", "learnedLabels", "new_email", "bodyHash")
+
+def stream_main():
+    results = sys.stdout
+    # Anything else that prints must not corrupt the result stream
+    sys.stdout = sys.stderr
+
+    def emit(message):
+        results.write(json.dumps(message, ensure_ascii=False) + "\n")
+        results.flush()
+
+    summary_cache = load_summary_cache()
+    pending = []     # received, not analyzed yet
+    processed = []   # analyzed since the last flush
+    removed = []     # deleted since the last flush
+    templates = ai_settings = categorizer = None
+
+    def analyze_pending():
+        print(f"  Processing {len(pending)} emails as one batch", file=sys.stderr)
+        analyses = process_batch(pending, templates, ai_settings, summary_cache, categorizer=categorizer)
+        for record, analysis in zip(pending, analyses):
+            apply_analysis(record, analysis, templates, ai_settings)
+        # Bodies go to the store; index.js drops them from the records when bodyHash comes back
+        migrate_bodies(pending)
+        for record in pending:
+            emit({k: record[k] for k in DELTA_FIELDS if k in record})
+        processed.extend(pending)
+        pending.clear()
+
+    def publish():
+        """Index and digest updates for what changed since the last flush. Returns the digest or None."""
+        save_summary_cache(summary_cache)
+        try:
+            update_search_index(processed, prune=False, removed_ids=removed)
+            update_keyword_index(processed, prune=False, removed_ids=removed)
+        except Exception as e:
+            print(f"⚠️ Index update failed: {e}", file=sys.stderr)
+        digest = None
+        groups = load_digest_groups()
+        if update_digest_groups(groups, processed, removed, templates or load_json_file("template.json") or {"rules": []}):
+            save_digest_groups(groups)
+            digest = build_inbox_digest(groups, summary_cache)
+        processed.clear()
+        removed.clear()
+        return digest
+
+    print("📡 Waiting for email records on stdin...", file=sys.stderr)
+    for line in iter(sys.stdin.readline, ""):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(f"⚠️ Skipping malformed record: {e}", file=sys.stderr)
+            continue
+
+        if record.get("flush"):
+            count = len(processed) + len(pending)
+            if pending:
+                analyze_pending()
+            digest = publish()
+            emit({"flushed": True, "processed": count, **({"digest": digest} if digest else {})})
+            continue
+
+        if "deleted" in record:
+            removed.extend(record.get("deleted") or [])
+            continue
+
+        if not pending and not processed:
+            # Settings and rules may have changed since the last batch
+            ai_settings = load_ai_settings()
+            templates = load_json_file("template.json") or {"rules": []}
+            categorizer = load_categorizer() if ai_settings.get("learnedCategorization", False) else None
+
+        pending.append(record)
+        if len(pending) >= TENANT_BATCH_SIZE:
+            analyze_pending()
+
+    # stdin closed mid-batch: keep what was computed
+    if pending:
+        analyze_pending()
+    if processed or removed:
+        publish()
+    print("👋 stdin closed, worker exiting", file=sys.stderr)
+
+# ========== 12. MULTI-MAILBOX MODE ==========
+# `python Summary_and_tone.py --mailboxes accounts/alice accounts/bob` serves several
+# accounts from one process, so the three models are loaded once rather than once per
+# account. Each directory has its own database.json, template.json, AI_settings.json,
+# caches, indexes and body store. Mailboxes take turns one batch at a time, so a large
+# backlog in one account does not hold up new mail in the others, and a batch never
+# mixes mailboxes because each one has its own rules and settings.
+# Emails per batch; autotune.py measures the reply model per email (all intents included)
+TENANT_BATCH_SIZE = tuned.get(reply_model, {}).get("batch_size", 8)
+
+def print_mailbox_report(mailboxes):
+    print("📊 Per-mailbox report:", file=sys.stderr)
+    print(f"  {'mailbox':<24} {'emails':>7} {'batches':>8} {'model s':>8} {'total s':>8} "
+          f"{'emails/s':>9} {'+RSS MB':>9}", file=sys.stderr)
+    for mailbox in mailboxes:
+        stats = mailbox.stats
+        rate = stats["processed"] / stats["seconds"] if stats["seconds"] else 0.0
+        print(f"  {mailbox.name[-24:]:<24} {stats['processed']:>7} {stats['batches']:>8} "
+              f"{stats['seconds']:>8.1f} {stats['total_seconds']:>8.1f} {rate:>9.2f} "
+              f"{stats['rss_growth_mb']:>9.1f}", file=sys.stderr)
+    peak = peak_memory_mb()
+    if peak is not None:
+        print(f"  Process peak memory: {peak:.0f} MB (models shared by all mailboxes)", file=sys.stderr)
+
+def run_mailboxes(mailboxes, batch_size=TENANT_BATCH_SIZE):
+    """Process the mailboxes round robin, one batch each per turn. Returns the ones that failed."""
+    failed = []
+    queue = deque()
+    for mailbox in mailboxes:
+        try:
+            if mailbox.load():
+                queue.append(mailbox)
+        except RuntimeError as e:
+            print(f"❌ [{mailbox.name}] {e}", file=sys.stderr)
+            failed.append(mailbox)
+
+    while queue:
+        mailbox = queue.popleft()
+        mailbox.process_next(batch_size)
+        if mailbox.pending:
+            queue.append(mailbox)
+        elif not mailbox.finish():
+            failed.append(mailbox)
+
+    print_mailbox_report(mailboxes)
+    return failed
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Summarize, categorize and draft replies for synced emails.")
+    parser.add_argument("--stdin", action="store_true", help="Run as the long-lived worker used by index.js")
+    parser.add_argument("--mailboxes", nargs="+", metavar="DIR", help="Process several mailbox directories")
+    parser.add_argument("--full", action="store_true",
+                        help="Process ./database.json and rebuild its digest and indexes (the default)")
+    parser.add_argument("--batch-size", type=int, default=TENANT_BATCH_SIZE, help="Emails per batch")
+    args = parser.parse_args()
+
+    if args.stdin:
+        stream_main()
+    elif args.mailboxes:
+        sys.exit(1 if run_mailboxes([Mailbox(d) for d in args.mailboxes], args.batch_size) else 0)
+    else:
+        main(args.batch_size)
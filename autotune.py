@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+autotune.py
+
+Batch size and thread layout sweep for the three models in Summary_and_tone.py.
+
+- Runs each model on a synthetic email sample at growing batch sizes, for a few
+  layouts of worker processes x intra-op threads (x inter-op threads)
+- The reply model is timed through smart_reply.generate_replies, the code
+  Summary_and_tone.py serves with (one encoder pass, one decoded row per intent),
+  so its batch size is a number of emails like the other two
+- The workers of a layout run each batch size in lock step, so their batches
+  overlap and the aggregate throughput is what the host actually delivers
+- Picks the highest single-process throughput; among settings within TOLERANCE
+  of it, the one with the lowest per-batch latency wins
+- Saves the pick per host and model to autotune_profile.json. Summary_and_tone.py
+  loads it at startup (batch sizes, intra/inter-op threads) and keeps its
+  defaults for models or hosts that were never tuned
+
+Summary_and_tone.py is one process, so its settings only come from one-worker
+layouts. When several worker processes do better in aggregate, that layout is saved
+next to the pick as "multiProcess": a recommendation to run that many processes
+(e.g. splitting --mailboxes between them), each with its threads.
+
+Usage:
+    python autotune.py                          # all three models
+    python autotune.py --only tone --emails 128
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import subprocess
+from datetime import datetime, timezone
+
+import torch
+
+from training_profile import physical_cores
+
+PROFILE_PATH = "autotune_profile.json"
+BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64)
+# Settings within this fraction of the best throughput are ranked by latency
+TOLERANCE = 0.05
+# Stop growing the batch once throughput falls this far below the best so far
+DROP_OFF = 0.15
+
+# Same models and call settings as Summary_and_tone.py (reply settings live in smart_reply.py)
+MODELS = {
+    "summarizer": {
+        "task": "summarization",
+        "model": os.environ.get("GM_SUMMARIZER_MODEL", "sshleifer/distilbart-cnn-12-6"),
+        "kwargs": {"truncation": True, "max_length": 120, "min_length": 30, "do_sample": False},
+        "emails": 32,
+    },
+    "tone": {
+        "task": "sentiment-analysis",
+        "model": "distilbert-base-uncased-finetuned-sst-2-english",
+        "kwargs": {},
+        "emails": 128,
+    },
+    "reply": {
+        "task": "text2text-generation",
+        "model": "google/flan-t5-base",
+        "kwargs": {},
+        "emails": 32,
+    },
+}
+
+# ---------------------------
+# Synthetic emails
+# ---------------------------
+SUBJECTS = [
+    "Project update for this week", "Invoice #4821 is overdue", "Team meeting moved to Thursday",
+    "Your flight booking confirmation", "Quick question about the report", "Welcome to the newsletter",
+    "Action required: verify your account", "Lunch on Friday?",
+]
+SENTENCES = [
+    "I wanted to follow up on the points we discussed in yesterday's meeting.",
+    "The draft of the quarterly report is attached for your review.",
+    "Please let me know if the proposed timeline works for your team.",
+    "Payment for the last invoice has not been received yet.",
+    "We have moved the deadline by one week to leave room for testing.",
+    "Your booking includes one checked bag and a window seat.",
+    "Could you send over the latest numbers before the end of the day?",
+    "Thanks again for your help with the migration last month.",
+    "The new dashboard is live and the first feedback has been positive.",
+    "If you have any questions, feel free to reply to this email.",
+    "We noticed a sign-in from a new device and want to make sure it was you.",
+    "The venue has confirmed the reservation for twenty people.",
+]
+
+def synthetic_emails(n, seed=0):
+    """(subject, body) pairs with a mix of short, medium and long bodies."""
+    rng = random.Random(seed)
+    emails = []
+    for i in range(n):
+        length = rng.choice((3, 8, 20, 40))
+        emails.append((rng.choice(SUBJECTS), " ".join(rng.choice(SENTENCES) for _ in range(length))))
+    return emails
+
+def model_inputs(name, emails):
+    """What Summary_and_tone.py feeds each model for these emails."""
+    if name == "reply":
+        # generate_smart_replies takes (subject, body, snippet); Gmail snippets are ~200 chars
+        return [(subject, body, body[:200]) for subject, body in emails]
+    texts = [f"Subject: {subject}\n\n{body}" for subject, body in emails]
+    return [t[:512] for t in texts] if name == "tone" else texts
+
+# ---------------------------
+# Host profile
+# ---------------------------
+def cpu_name():
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+def host_key():
+    device = torch.cuda.get_device_name(0) if torch.cuda.is_available() else "cpu"
+    return f"{platform.node()} | {cpu_name()} | {physical_cores()} cores | {device}"
+
+def load_profile(path=PROFILE_PATH):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            profile = json.load(f)
+        return profile if isinstance(profile, dict) else {}
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def save_profile(profile, path=PROFILE_PATH):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp, path)
+
+def load_tuned_settings(model_ids, path=PROFILE_PATH):
+    """{model_id: settings} tuned on this host, for the given models that have been tuned."""
+    models = load_profile(path).get(host_key(), {}).get("models", {})
+    # Older profiles could pick a multi-process layout, whose threads are wrong for one process
+    return {m: models[m] for m in model_ids if m in models and models[m].get("workers", 1) == 1}
+
+def use_threads(settings):
+    """Switch to the intra-op thread count tuned for one model (no-op when untuned)."""
+    if settings and settings.get("intra_op_threads"):
+        torch.set_num_threads(settings["intra_op_threads"])
+
+def set_inter_op_threads(settings):
+    """Inter-op threads can only be set before torch runs any parallel work."""
+    if settings and settings.get("inter_op_threads"):
+        try:
+            torch.set_num_interop_threads(settings["inter_op_threads"])
+        except RuntimeError as e:
+            print(f"⚠️ Could not set inter-op threads: {e}", file=sys.stderr)
+
+# ---------------------------
+# Worker (one process of a layout)
+# ---------------------------
+def run_worker(name, intra, interop, n_emails):
+    results = sys.stdout
+    # Model loading chatter must not corrupt the result stream
+    sys.stdout = sys.stderr
+
+    def emit(message):
+        results.write(json.dumps(message) + "\n")
+        results.flush()
+
+    torch.set_num_interop_threads(interop)
+    torch.set_num_threads(intra)
+    from transformers import pipeline
+
+    spec = MODELS[name]
+    device = 0 if torch.cuda.is_available() else -1
+    model = pipeline(spec["task"], model=spec["model"], device=device)
+    texts = model_inputs(name, synthetic_emails(n_emails))
+    if name == "reply":
+        from smart_reply import generate_replies
+        run = lambda batch: generate_replies(model.model, model.tokenizer, batch)
+    else:
+        run = lambda batch: model(batch, batch_size=len(batch), **spec["kwargs"])
+    emit({"ready": True})
+
+    # The parent sends one batch size per line and closes stdin when done
+    for line in iter(sys.stdin.readline, ""):
+        batch_size = int(line)
+        try:
+            run(texts[:batch_size])  # warm-up
+            latencies = []
+            start = time.perf_counter()
+            for i in range(0, len(texts), batch_size):
+                batch_start = time.perf_counter()
+                run(texts[i:i + batch_size])
+                latencies.append(time.perf_counter() - batch_start)
+            emit({"emails": len(texts), "seconds": time.perf_counter() - start,
+                  "latency": sorted(latencies)[len(latencies) // 2]})
+        except RuntimeError as e:  # out of memory
+            emit({"error": str(e)})
+
+# ---------------------------
+# Sweep
+# ---------------------------
+def thread_layouts(cores, cuda):
+    """(workers, intra-op threads, inter-op threads) combinations to try."""
+    if cuda:
+        return [(1, cores, 1)]
+    layouts = [(workers, cores // workers, 1) for workers in (1, 2, 4) if workers <= cores]
+    layouts.append((1, cores, 2))
+    if cores >= 4:
+        layouts.append((1, cores // 2, 1))
+    return list(dict.fromkeys(layouts))
+
+def read_message(proc):
+    """Next JSON object the worker wrote; None if it exited."""
+    for line in iter(proc.stdout.readline, ""):
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(message, dict):
+            return message
+    return None
+
+def sweep_layout(name, workers, intra, interop, n_emails):
+    command = [sys.executable, os.path.abspath(__file__), "--worker", name,
+               "--intra", str(intra), "--interop", str(interop), "--emails", str(n_emails)]
+    procs = [subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+             for _ in range(workers)]
+    results, best = [], 0.0
+    try:
+        if any(read_message(p) is None for p in procs):
+            print(f"  ⚠️ {workers}x{intra} threads: worker failed to start", file=sys.stderr)
+            return results
+        for batch_size in BATCH_SIZES:
+            if batch_size > n_emails:
+                break
+            for p in procs:
+                p.stdin.write(f"{batch_size}\n")
+                p.stdin.flush()
+            messages = [read_message(p) for p in procs]
+            if any(m is None or "error" in m for m in messages):
+                print(f"  ⚠️ {workers}x{intra} threads, batch {batch_size}: failed, stopping here", file=sys.stderr)
+                break
+            throughput = sum(m["emails"] for m in messages) / max(m["seconds"] for m in messages)
+            latency = max(m["latency"] for m in messages)
+            results.append({"workers": workers, "intra_op_threads": intra, "inter_op_threads": interop,
+                            "batch_size": batch_size, "throughput": round(throughput, 3),
+                            "latency_ms": round(latency * 1000, 1)})
+            print(f"  {workers:>7} {intra:>6} {interop:>8} {batch_size:>6} {throughput:>10.2f} "
+                  f"{latency * 1000:>11.0f}", file=sys.stderr)
+            best = max(best, throughput)
+            if throughput < best * (1 - DROP_OFF):
+                break
+    finally:
+        for p in procs:
+            if p.stdin:
+                p.stdin.close()
+            p.wait()
+    return results
+
+def pick_best(results):
+    """Highest throughput; the lowest latency among results within TOLERANCE of it."""
+    top = max(r["throughput"] for r in results)
+    return min((r for r in results if r["throughput"] >= top * (1 - TOLERANCE)),
+               key=lambda r: (r["latency_ms"], -r["throughput"]))
+
+def tune_model(name, n_emails):
+    spec = MODELS[name]
+    cores = physical_cores()
+    print(f"⏱️ Tuning {name} ({spec['model']}) on {n_emails} synthetic emails", file=sys.stderr)
+    print(f"  {'workers':>7} {'intra':>6} {'interop':>8} {'batch':>6} {'emails/s':>10} {'latency ms':>11}",
+          file=sys.stderr)
+    results = []
+    for workers, intra, interop in thread_layouts(cores, torch.cuda.is_available()):
+        results += sweep_layout(name, workers, intra, interop, n_emails)
+    single = [r for r in results if r["workers"] == 1]
+    if not single:
+        return None
+    best = pick_best(single)
+    print(f"✅ {name}: batch {best['batch_size']}, {best['intra_op_threads']} threads, "
+          f"inter-op {best['inter_op_threads']}: {best['throughput']} emails/s, "
+          f"{best['latency_ms']} ms per batch", file=sys.stderr)
+    tuned = dict(best, tunedAt=datetime.now(timezone.utc).isoformat(), emails=n_emails)
+    overall = pick_best(results)
+    if overall["workers"] > 1 and overall["throughput"] > best["throughput"]:
+        tuned["multiProcess"] = overall
+        print(f"ℹ️ {name}: {overall['workers']} processes x {overall['intra_op_threads']} threads, batch "
+              f"{overall['batch_size']}: {overall['throughput']} emails/s in aggregate", file=sys.stderr)
+    return tuned
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune batch sizes and thread counts for this host.")
+    parser.add_argument("--only", choices=sorted(MODELS), nargs="+", help="Models to tune (default: all)")
+    parser.add_argument("--emails", type=int, help="Synthetic emails per measurement")
+    parser.add_argument("--profile", default=PROFILE_PATH)
+    parser.add_argument("--worker", choices=sorted(MODELS), help=argparse.SUPPRESS)
+    parser.add_argument("--intra", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--interop", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.intra, args.interop, args.emails)
+        return
+
+    profile = load_profile(args.profile)
+    host = host_key()
+    print(f"🖥️ Host: {host}", file=sys.stderr)
+    for name in args.only or MODELS:
+        tuned = tune_model(name, args.emails or MODELS[name]["emails"])
+        if tuned is None:
+            print(f"❌ {name}: no successful measurement", file=sys.stderr)
+            continue
+        entry = profile.setdefault(host, {"models": {}})
+        entry["models"][MODELS[name]["model"]] = tuned
+        # Saved after every model, so an interrupted sweep keeps what it measured
+        save_profile(profile, args.profile)
+    print(f"💾 Saved {args.profile}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
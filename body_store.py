@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+body_store.py
+
+Content-addressed store for email bodies, so database.json only carries metadata.
+
+- Bodies are zlib-compressed and appended to one packed file (body_store/bodies.pack)
+- body_store/index.json maps body hash -> [offset, length] in the pack
+- Records keep "bodyHash" instead of "body"; identical bodies are stored once
+- Reads go through mmap and decompress only the requested body
+- index.js reads the same files (fs.readSync + zlib.inflateSync) for /api/body
+- Writers (the stream worker, full runs, this CLI) take body_store/lock while they
+  append to the pack or publish the index, and merge the index on disk with their
+  own new entries, so concurrent processes neither share offsets nor drop entries
+
+zlib rather than zstd: both Python and Node ship it, so neither side needs a new
+dependency, and bodies are small enough that the ratio difference is minor.
+
+Usage:
+    python body_store.py --migrate      # move bodies out of database.json, report size/load time
+    python body_store.py --compact      # drop bodies no email references any more
+                                        # (stop the app first: readers keep old offsets)
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import zlib
+import hashlib
+import argparse
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+BODY_STORE_DIR = "body_store"
+COMPRESSION_LEVEL = 6
+
+def body_hash(body):
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+def body_key(email):
+    """Stable identity of an email's body, whether it is inline or in the store."""
+    if email.get("bodyHash"):
+        return email["bodyHash"]
+    return body_hash(email.get("body") or "")
+
+class BodyStore:
+    def __init__(self, root=BODY_STORE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.pack_path = os.path.join(root, "bodies.pack")
+        self.index_path = os.path.join(root, "index.json")
+        self.lock_path = os.path.join(root, "lock")
+        self.index = self._read_index()
+        # Entries this process appended but has not published yet
+        self._added = {}
+        self._file = None
+        self._map = None
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock shared by every process that writes this store."""
+        with open(self.lock_path, "a+b") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    # -- reading -------------------------------------------------------
+    def _mapped(self, end):
+        """mmap of the pack covering at least `end` bytes (remapped after appends)."""
+        if self._map is None or len(self._map) < end:
+            self._close_map()
+            self._file = open(self.pack_path, "rb")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+        self._map = self._file = None
+
+    def __contains__(self, h):
+        return h in self.index
+
+    def get(self, h):
+        entry = self.index.get(h)
+        if entry is None:
+            # Possibly stored by another process since this one read the index
+            self.index = {**self._read_index(), **self._added}
+            entry = self.index.get(h)
+        if entry is None:
+            return None
+        offset, length = entry
+        return zlib.decompress(self._mapped(offset + length)[offset:offset + length]).decode("utf-8")
+
+    # -- writing -------------------------------------------------------
+    def put(self, body):
+        h = body_hash(body)
+        if h not in self.index:
+            data = zlib.compress(body.encode("utf-8"), COMPRESSION_LEVEL)
+            # The end of the pack is only read and extended under the lock
+            with self._locked(), open(self.pack_path, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(data)
+            self.index[h] = self._added[h] = [offset, len(data)]
+        return h
+
+    def _publish(self):
+        """Merge this process's new entries into the index on disk. Caller holds the lock."""
+        index = self._read_index()
+        index.update(self._added)
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f, separators=(",", ":"))
+        os.replace(tmp, self.index_path)
+        self.index = index
+        self._added = {}
+
+    def flush(self):
+        """Publish the index; pack bytes are always written before the entries that point at them."""
+        if not self._added:
+            return
+        with self._locked():
+            self._publish()
+
+    def close(self):
+        self.flush()
+        self._close_map()
+
+    def compact(self, live_hashes):
+        """Rewrite the pack with only the given bodies. Returns bytes reclaimed."""
+        with self._locked():
+            # Start from every entry any process has published
+            self._publish()
+            before = os.path.getsize(self.pack_path) if os.path.exists(self.pack_path) else 0
+            tmp = self.pack_path + ".tmp"
+            index = {}
+            with open(tmp, "wb") as out:
+                for h in sorted(live_hashes):
+                    entry = self.index.get(h)
+                    if entry is None:
+                        continue
+                    offset, length = entry
+                    index[h] = [out.tell(), length]
+                    out.write(self._mapped(offset + length)[offset:offset + length])
+            self._close_map()
+            os.replace(tmp, self.pack_path)
+            tmp = self.index_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(index, f, separators=(",", ":"))
+            os.replace(tmp, self.index_path)
+            self.index = index
+        return before - os.path.getsize(self.pack_path)
+
+# ---------------------------
+# Records
+# ---------------------------
+_default_store = None
+
+def default_store():
+    global _default_store
+    if _default_store is None:
+        _default_store = BodyStore()
+    return _default_store
+
+def load_body(email, store=None):
+    """The email's body, decompressed from the store only when it is not inline."""
+    if "body" in email:
+        return email.get("body") or ""
+    if email.get("bodyHash"):
+        return (store or default_store()).get(email["bodyHash"]) or ""
+    return ""
+
+def migrate_bodies(emails, store=None):
+    """Move inline bodies into the store, leaving bodyHash on each record. Returns how many moved."""
+    store = store or default_store()
+    moved = 0
+    for email in emails:
+        if "body" in email:
+            email["bodyHash"] = store.put(email.pop("body") or "")
+            moved += 1
+    store.flush()
+    return moved
+
+# ---------------------------
+# CLI
+# ---------------------------
+def _measure(path):
+    start = time.perf_counter()
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return data, os.path.getsize(path), time.perf_counter() - start
+
+def _mb(n):
+    return f"{n / (1024 * 1024):.1f} MB"
+
+def main():
+    parser = argparse.ArgumentParser(description="Move email bodies out of database.json into a compressed store.")
+    parser.add_argument("--database", default="database.json")
+    parser.add_argument("--migrate", action="store_true")
+    parser.add_argument("--compact", action="store_true")
+    args = parser.parse_args()
+
+    store = BodyStore()
+    data, size_before, load_before = _measure(args.database)
+    emails = data.get("emails", [])
+
+    if args.migrate:
+        moved = migrate_bodies(emails, store)
+        tmp = args.database + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, args.database)
+        _, size_after, load_after = _measure(args.database)
+        pack = os.path.getsize(store.pack_path) if os.path.exists(store.pack_path) else 0
+        print(f"✅ Moved {moved} bodies into {store.root}/ ({len(store.index)} unique)")
+        print(f"   database.json: {_mb(size_before)} -> {_mb(size_after)}")
+        print(f"   load time:     {load_before * 1000:.0f} ms -> {load_after * 1000:.0f} ms")
+        print(f"   body pack:     {_mb(pack)} compressed")
+
+    if args.compact:
+        live = {e["bodyHash"] for e in emails if e.get("bodyHash")}
+        reclaimed = store.compact(live)
+        print(f"✅ Compacted body pack: {len(live)} bodies kept, {_mb(reclaimed)} reclaimed")
+    store.close()
+    if not (args.migrate or args.compact):
+        parser.print_help(sys.stderr)
+
+if __name__ == "__main__":
+    main()
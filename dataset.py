@@ -12,18 +12,34 @@ This version includes:
 - Robust plotting (NaN handling, index alignment)
 - Per-message tone export (hf_message_tones.csv)
 - Tone distribution chart
+- Parquet feature store so unchanged stages load from cache (feature_store.py)
+- Stage graph with a CLI to run a subset (--only sentiment / --only plots),
+  independent stages in parallel, and per-stage timings in run_report.json
 """
 
 import os
 import re
+import json
+import time
 import argparse
-from collections import Counter
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.decomposition import PCA
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+import joblib
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+from sklearn.decomposition import TruncatedSVD, IncrementalPCA
+from sklearn.random_projection import SparseRandomProjection
+from sklearn.pipeline import make_pipeline
+
+import email_text
+from email_text import flatten_thread
+from feature_store import FeatureStore, code_version, dataset_fingerprint
 
 # --- Optional libraries ---
 try:
@@ -61,34 +77,11 @@ def load_hf_dataset(hf_name="sidhq/email-thread-summary"):
     for split in ds.keys():
         print(f" - Converting split '{split}' to pandas")
         df = pd.DataFrame(ds[split])
+        df.attrs["fingerprint"] = dataset_fingerprint(ds[split])
         dfs[split] = df
         print(f"   {split}: {len(df)} rows")
     return dfs
 
-# ---------------------------
-# Cleaning & flattening
-# ---------------------------
-def clean_email_text(text):
-    if text is None:
-        return ""
-    text = re.sub(r"-----Original Message-----.*", " ", text, flags=re.DOTALL | re.IGNORECASE)
-    text = re.sub(r"__+|--+|\*\*+", " ", text)
-    text = re.sub(r"\b[\w\.-]+@[\w\.-]+\.\w+\b", " ", text)
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
-
-def flatten_thread(thread):
-    if not isinstance(thread, dict):
-        return "", "", []
-    subject = thread.get("subject", "") or ""
-    messages = thread.get("messages", []) or []
-    cleaned_messages = []
-    for m in messages:
-        body = m.get("body", "") if isinstance(m, dict) else str(m)
-        cleaned_messages.append(clean_email_text(body))
-    flat = subject + " \n " + " \n ".join(cleaned_messages)
-    return flat, subject, cleaned_messages
-
 # ---------------------------
 # Feature engineering
 # ---------------------------
@@ -141,6 +134,32 @@ def compute_thread_sentiment(cleaned_messages, sia):
     scores = [sia.polarity_scores(m)["compound"] for m in cleaned_messages if m and m.strip()]
     return float(np.mean(scores)) if scores else 0.0
 
+# ---------------------------
+# Cached stages
+# ---------------------------
+def compute_qc(df):
+    return pd.DataFrame({
+        "num_messages": df["thread"].apply(lambda t: len(t.get("messages", [])) if isinstance(t, dict) else 0),
+        "summary_len_words": df["summary"].apply(lambda s: len(str(s).split())),
+    }, index=df.index)
+
+def compute_features(df):
+    return df.apply(lambda r: pd.Series(derive_features_from_thread(r)), axis=1)
+
+def compute_sentiment(df, sia):
+    return pd.DataFrame({
+        "avg_sentiment": df["cleaned_messages"].apply(lambda msgs: compute_thread_sentiment(msgs, sia)),
+    }, index=df.index)
+
+def stage_versions():
+    """Code versions per stage; downstream stages fold in their inputs' versions."""
+    qc = code_version(compute_qc)
+    # The whole email_text module, so its compiled patterns are part of the key too
+    features = code_version(compute_features, derive_features_from_thread, email_text,
+                            URGENCY_KEYWORDS, MEETING_KEYWORDS, ZOOM_REGEX, URL_REGEX)
+    sentiment = code_version(features, compute_sentiment, compute_thread_sentiment)
+    return {"qc": qc, "features": features, "sentiment": sentiment}
+
 def export_message_tones(df, sia, fname="hf_message_tones.csv"):
     rows = []
     for idx, row in df.iterrows():
@@ -173,24 +192,24 @@ def export_message_tones(df, sia, fname="hf_message_tones.csv"):
         print(f"Message-level tones saved to: {out_csv}")
         # Plot distribution
         tone_counts = Counter(out_df["tone"])
-        fig = plt.figure(figsize=(5,4))
-        plt.bar(tone_counts.keys(), tone_counts.values())
-        plt.title("Tone Distribution (per message)")
+        fig = Figure(figsize=(5,4))
+        ax = fig.subplots()
+        ax.bar(tone_counts.keys(), tone_counts.values())
+        ax.set_title("Tone Distribution (per message)")
         save_fig(fig, "tone_distribution.png")
-        plt.close(fig)
 
 # ---------------------------
 # Visualization helpers
 # ---------------------------
 def plot_hist(series, title, xlabel, ylabel="Count", bins=30, fname="plot.png"):
     try:
-        fig = plt.figure(figsize=(7,4))
-        plt.hist(series.dropna(), bins=bins)
-        plt.title(title)
-        plt.xlabel(xlabel)
-        plt.ylabel(ylabel)
+        fig = Figure(figsize=(7,4))
+        ax = fig.subplots()
+        ax.hist(series.dropna(), bins=bins)
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
         save_fig(fig, fname)
-        plt.close(fig)
     except Exception as e:
         print(f"plot_hist failed for {fname}: {e}")
 
@@ -200,13 +219,14 @@ def plot_bar_from_counts(counter, topn=10, title="", xlabel="", fname="bar.png")
         if not items:
             return
         keys, vals = zip(*items)
-        fig = plt.figure(figsize=(8,4))
-        plt.bar(range(len(keys)), vals)
-        plt.xticks(range(len(keys)), keys, rotation=45, ha="right")
-        plt.title(title)
-        plt.xlabel(xlabel)
+        fig = Figure(figsize=(8,4))
+        ax = fig.subplots()
+        ax.bar(range(len(keys)), vals)
+        ax.set_xticks(range(len(keys)))
+        ax.set_xticklabels(keys, rotation=45, ha="right")
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
         save_fig(fig, fname)
-        plt.close(fig)
     except Exception as e:
         print(f"plot_bar_from_counts failed for {fname}: {e}")
 
@@ -218,82 +238,321 @@ def plot_scatter(x, y, title, xlabel, ylabel, fname):
         x_clean, y_clean = x_s[mask], y_s[mask]
         if len(x_clean) == 0:
             return
-        fig = plt.figure(figsize=(7,5))
-        plt.scatter(x_clean, y_clean, alpha=0.6, s=8)
-        plt.title(title)
-        plt.xlabel(xlabel)
-        plt.ylabel(ylabel)
-        plt.grid(True, alpha=0.3)
+        fig = Figure(figsize=(7,5))
+        ax = fig.subplots()
+        ax.scatter(x_clean, y_clean, alpha=0.6, s=8)
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        ax.grid(True, alpha=0.3)
         save_fig(fig, fname)
-        plt.close(fig)
     except Exception as e:
         print(f"plot_scatter failed for {fname}: {e}")
 
-def plot_pca_tfidf(texts, labels_binary, fname="pca.png"):
+# ---------------------------
+# Sparse text projection
+# ---------------------------
+PROJECTION_PATH = os.path.join(OUT_DIR, "tfidf_projection.joblib")
+
+def projection_path(fingerprint, features_version):
+    """Saved projection for one dataset and features code version, so neither can reuse a stale fit."""
+    return os.path.join(OUT_DIR, f"tfidf_projection-{fingerprint[:12]}-{features_version[:12]}.joblib")
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def fit_text_projection(texts, n_components=2, batch_size=None, max_features=1000,
+                        n_hash_features=2**18, sketch_dim=256):
+    """Fit a 2-D text projection without ever densifying the full document matrix.
+
+    In-memory corpora use TF-IDF -> TruncatedSVD, both of which work on the
+    sparse matrix directly. When batch_size is given the corpus is streamed:
+    HashingVectorizer (stateless) -> SparseRandomProjection down to sketch_dim
+    -> IncrementalPCA.partial_fit, so peak memory is batch_size x sketch_dim.
+    """
+    if batch_size:
+        vec = HashingVectorizer(n_features=n_hash_features, stop_words="english",
+                                alternate_sign=False, norm="l2")
+        sketch = SparseRandomProjection(n_components=sketch_dim, dense_output=True, random_state=42)
+        reducer = IncrementalPCA(n_components=n_components)
+        fitted_sketch = False
+        for batch in iter_batches(texts, batch_size):
+            X = vec.transform(batch)
+            if not fitted_sketch:
+                sketch.fit(X)
+                fitted_sketch = True
+            Z = sketch.transform(X)
+            # IncrementalPCA needs at least n_components rows per partial_fit call
+            if Z.shape[0] >= n_components:
+                reducer.partial_fit(Z)
+        return make_pipeline(vec, sketch, reducer)
+
+    # TfidfVectorizer reads the documents once, so an iterator is enough here too
+    projection = make_pipeline(
+        TfidfVectorizer(max_features=max_features, stop_words="english"),
+        TruncatedSVD(n_components=n_components, random_state=42),
+    )
+    projection.fit(texts)
+    return projection
+
+def transform_texts(projection, texts, batch_size=10000):
+    """Project texts in batches so only one batch is vectorized at a time."""
+    parts = [projection.transform(batch) for batch in iter_batches(texts, batch_size)]
+    if not parts:
+        return np.empty((0, 2))
+    return np.vstack(parts)
+
+def save_projection(projection, path=PROJECTION_PATH):
+    try:
+        joblib.dump(projection, path)
+        print(f"Saved projection: {path}")
+    except Exception as e:
+        print(f"Failed to save projection {path}: {e}")
+
+def load_projection(path=PROJECTION_PATH):
+    if not os.path.exists(path):
+        return None
+    try:
+        return joblib.load(path)
+    except Exception as e:
+        print(f"Failed to load projection {path}: {e}")
+        return None
+
+def plot_pca_tfidf(texts, labels_binary, fname="pca.png", batch_size=None,
+                   max_points=20000, projection_path=PROJECTION_PATH, refit=False):
+    """Scatter the 2-D LSA projection of the corpus, coloured by labels_binary.
+
+    A projection saved by a previous run is reused unless refit=True, so new
+    threads land in the same coordinate space. Only max_points randomly chosen
+    threads are transformed and drawn.
+    """
     try:
-        texts = list(texts)
-        if not texts:
+        if not isinstance(texts, pd.Series):
+            texts = pd.Series(texts)
+        if texts.empty:
             return
-        vec = TfidfVectorizer(max_features=1000, stop_words="english")
-        X = vec.fit_transform(texts).toarray()
-        coords = PCA(n_components=2, random_state=42).fit_transform(X)
         c = np.array(labels_binary)
-        if len(c) != coords.shape[0]:
-            c = np.resize(c, coords.shape[0])
-        fig = plt.figure(figsize=(7,6))
-        plt.scatter(coords[:,0], coords[:,1], c=c, cmap="coolwarm", alpha=0.6, s=12)
-        plt.title("PCA of TF-IDF (by urgency)")
-        plt.xlabel("PC1")
-        plt.ylabel("PC2")
+        if len(c) != len(texts):
+            c = np.resize(c, len(texts))
+
+        projection = None if refit else load_projection(projection_path)
+        if projection is None:
+            # Streamed from the Series; no extra list copy of the corpus
+            projection = fit_text_projection(iter(texts), batch_size=batch_size)
+            save_projection(projection, projection_path)
+
+        if max_points and len(texts) > max_points:
+            rng = np.random.default_rng(42)
+            idx = np.sort(rng.choice(len(texts), size=max_points, replace=False))
+            texts, c = texts.iloc[idx], c[idx]
+
+        coords = transform_texts(projection, iter(texts))
+        fig = Figure(figsize=(7,6))
+        ax = fig.subplots()
+        ax.scatter(coords[:,0], coords[:,1], c=c, cmap="coolwarm", alpha=0.6, s=12)
+        ax.set_title("LSA projection of TF-IDF (by urgency)")
+        ax.set_xlabel("Component 1")
+        ax.set_ylabel("Component 2")
         save_fig(fig, fname)
-        plt.close(fig)
     except Exception as e:
         print(f"plot_pca_tfidf failed for {fname}: {e}")
 
 # ---------------------------
-# Main analysis
+# Analysis stages
 # ---------------------------
-def analyze_hf_and_kaggle():
+Stage = namedtuple("Stage", ["name", "deps", "group", "func"])
+STAGES = {}
+
+def stage(name, deps=(), group=None):
+    """Register an analysis stage. Stages are registered in a valid topological order."""
+    def register(func):
+        STAGES[name] = Stage(name, tuple(deps), group or name, func)
+        return func
+    return register
+
+@stage("load")
+def stage_load(ctx):
     dfs = load_hf_dataset()
     df = dfs.get("train")
     print(f"Using {len(df)} threads.")
+    store = FeatureStore(df.attrs.get("fingerprint") or dataset_fingerprint(df.to_dict("records")))
+    return {"df": df, "store": store, "versions": stage_versions()}
+
+@stage("qc", deps=["load"])
+def stage_qc(ctx):
+    df = ctx["df"]
+    qc = ctx["store"].get_or_compute("qc", ctx["versions"]["qc"], lambda: compute_qc(df), index=df.index)
+    qc[["num_messages","summary_len_words"]].to_csv(os.path.join(OUT_DIR,"hf_data_qc.csv"), index=False)
+    return {"qc": qc}
+
+@stage("features", deps=["load"])
+def stage_features(ctx):
+    df = ctx["df"]
+    feats = ctx["store"].get_or_compute("features", ctx["versions"]["features"], lambda: compute_features(df), index=df.index)
+    return {"features": feats}
+
+@stage("sentiment", deps=["features"])
+def stage_sentiment(ctx):
+    feats = ctx["features"]
+    sia = ensure_nltk_and_sia()
+    sentiment = ctx["store"].get_or_compute("sentiment", ctx["versions"]["sentiment"],
+                                            lambda: compute_sentiment(feats, sia), index=feats.index)
+    return {"sentiment": sentiment, "sia": sia}
 
-    # QC
-    df["num_messages"] = df["thread"].apply(lambda t: len(t.get("messages", [])) if isinstance(t, dict) else 0)
-    df["summary_len_words"] = df["summary"].apply(lambda s: len(str(s).split()))
-    df[["num_messages","summary_len_words"]].to_csv(os.path.join(OUT_DIR,"hf_data_qc.csv"), index=False)
+@stage("message_tones", deps=["sentiment"], group="sentiment")
+def stage_message_tones(ctx):
+    export_message_tones(ctx["features"], ctx["sia"])
 
-    plot_hist(df["num_messages"], "Messages per Thread", "Number of messages", bins=20, fname="messages_per_thread.png")
-    plot_hist(df["summary_len_words"], "Summary Length (words)", "Words in summary", bins=20, fname="summary_length_hist.png")
+@stage("plot_messages_per_thread", deps=["qc"], group="plots")
+def stage_plot_messages_per_thread(ctx):
+    plot_hist(ctx["qc"]["num_messages"], "Messages per Thread", "Number of messages", bins=20, fname="messages_per_thread.png")
 
-    # Features
-    feats = df.apply(lambda r: pd.Series(derive_features_from_thread(r)), axis=1)
-    df = pd.concat([df, feats], axis=1)
+@stage("plot_summary_length", deps=["qc"], group="plots")
+def stage_plot_summary_length(ctx):
+    plot_hist(ctx["qc"]["summary_len_words"], "Summary Length (words)", "Words in summary", bins=20, fname="summary_length_hist.png")
 
-    subj_counts = Counter(df["subject"].fillna("").astype(str))
+@stage("plot_top_subjects", deps=["features"], group="plots")
+def stage_plot_top_subjects(ctx):
+    subj_counts = Counter(ctx["features"]["subject"].fillna("").astype(str))
     plot_bar_from_counts(subj_counts, topn=10, title="Top Subjects", xlabel="Subject", fname="top_subjects.png")
 
-    urgent_count = int(df["contains_urgent"].sum())
-    fig = plt.figure(figsize=(4,3))
-    plt.bar(["no_urgent","urgent"], [len(df)-urgent_count, urgent_count])
-    plt.title("Urgency (keyword heuristic)")
+@stage("plot_urgency", deps=["features"], group="plots")
+def stage_plot_urgency(ctx):
+    feats = ctx["features"]
+    urgent_count = int(feats["contains_urgent"].sum())
+    fig = Figure(figsize=(4,3))
+    ax = fig.subplots()
+    ax.bar(["no_urgent","urgent"], [len(feats)-urgent_count, urgent_count])
+    ax.set_title("Urgency (keyword heuristic)")
     save_fig(fig,"urgent_count.png")
-    plt.close(fig)
 
-    plot_scatter(df["num_messages"], df["total_words"], "Total words vs Number of messages",
+@stage("plot_words_vs_messages", deps=["qc", "features"], group="plots")
+def stage_plot_words_vs_messages(ctx):
+    plot_scatter(ctx["qc"]["num_messages"], ctx["features"]["total_words"], "Total words vs Number of messages",
                  "Number of messages", "Total words", "words_vs_messages.png")
 
-    # Tone
-    sia = ensure_nltk_and_sia()
-    df["avg_sentiment"] = df["cleaned_messages"].apply(lambda msgs: compute_thread_sentiment(msgs, sia))
-    plot_hist(df["avg_sentiment"], "Average Thread Sentiment", "Compound sentiment", bins=30, fname="avg_sentiment_hist.png")
+@stage("plot_sentiment", deps=["sentiment"], group="plots")
+def stage_plot_sentiment(ctx):
+    plot_hist(ctx["sentiment"]["avg_sentiment"], "Average Thread Sentiment", "Compound sentiment", bins=30, fname="avg_sentiment_hist.png")
 
-    export_message_tones(df, sia)
+@stage("plot_projection", deps=["features"], group="plots")
+def stage_plot_projection(ctx):
+    feats = ctx["features"]
+    path = projection_path(ctx["store"].fingerprint, ctx["versions"]["features"])
+    plot_pca_tfidf(feats["flat_text"].fillna(""), feats["contains_urgent"], fname="pca_tfidf_urgent.png",
+                   batch_size=ctx.get("projection_batch_size"), projection_path=path,
+                   refit=ctx.get("refit", False))
 
-    # PCA
-    plot_pca_tfidf(df["flat_text"].fillna(""), df["contains_urgent"], fname="pca_tfidf_urgent.png")
+# ---------------------------
+# Stage runner
+# ---------------------------
+def resolve_stages(selected):
+    """Expand stage/group names into the stages to run, dependencies included, in registry order."""
+    needed = set()
+    stack = []
+    for name in selected:
+        matches = [s.name for s in STAGES.values() if name in (s.name, s.group)]
+        if not matches:
+            raise ValueError(f"Unknown stage or group: {name}")
+        stack.extend(matches)
+    while stack:
+        name = stack.pop()
+        if name not in needed:
+            needed.add(name)
+            stack.extend(STAGES[name].deps)
+    return [name for name in STAGES if name in needed]
+
+def _timed(stage_def, ctx):
+    start = time.perf_counter()
+    outputs = stage_def.func(ctx)
+    return outputs or {}, time.perf_counter() - start
+
+def run_stages(selected=None, workers=4, report_path=None, options=None):
+    """Run the selected stages, starting each one as soon as its dependencies finish.
+
+    options are run settings (e.g. refit, projection_batch_size) that stages read from ctx.
+    """
+    names = resolve_stages(selected or list(STAGES))
+    ctx = dict(options or {})
+    report = {name: {"deps": list(STAGES[name].deps), "status": "pending", "seconds": None} for name in names}
+    pending = list(names)
+    running = {}
+    run_start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while pending or running:
+            for name in list(pending):
+                dep_status = [report[d]["status"] for d in STAGES[name].deps]
+                if any(st in ("failed", "skipped") for st in dep_status):
+                    report[name]["status"] = "skipped"
+                    pending.remove(name)
+                elif all(st == "ok" for st in dep_status):
+                    print(f"[stage] {name} started")
+                    running[pool.submit(_timed, STAGES[name], ctx)] = name
+                    report[name]["status"] = "running"
+                    pending.remove(name)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    outputs, seconds = future.result()
+                    ctx.update(outputs)
+                    report[name].update(status="ok", seconds=round(seconds, 3))
+                    print(f"[stage] {name} finished in {seconds:.2f}s")
+                except Exception as e:
+                    report[name].update(status="failed", error=str(e))
+                    print(f"[stage] {name} failed: {e}")
+
+    summary = {
+        "finished_at": datetime.now().isoformat(timespec="seconds"),
+        "workers": workers,
+        "total_seconds": round(time.perf_counter() - run_start, 3),
+        "stages": report,
+    }
+    report_path = report_path or os.path.join(OUT_DIR, "run_report.json")
+    try:
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Run report saved to: {report_path}")
+    except Exception as e:
+        print(f"Failed to save run report {report_path}: {e}")
+    return summary
 
+# ---------------------------
+# Main analysis
+# ---------------------------
+def analyze_hf_and_kaggle(selected=None, workers=4, report_path=None, options=None):
+    summary = run_stages(selected, workers=workers, report_path=report_path, options=options)
     print("\nAnalysis complete. Outputs in:", os.path.abspath(OUT_DIR))
+    return summary
+
+def parse_args(argv=None):
+    groups = sorted({s.group for s in STAGES.values()})
+    parser = argparse.ArgumentParser(description="Analyze the sidhq/email-thread-summary dataset.")
+    parser.add_argument("--only", nargs="+", metavar="STAGE",
+                        help=f"Run only these stages or groups plus their dependencies (groups: {', '.join(groups)})")
+    parser.add_argument("--workers", type=int, default=4, help="Stages to run concurrently (default: 4)")
+    parser.add_argument("--report", default=None, help="Run report path (default: ./outputs/run_report.json)")
+    parser.add_argument("--refit", action="store_true", help="Refit the text projection instead of reusing the saved one")
+    parser.add_argument("--projection-batch-size", type=int, default=None,
+                        help="Fit the text projection in streamed batches of this many threads (default: in memory)")
+    parser.add_argument("--list", action="store_true", help="List stages and exit")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    analyze_hf_and_kaggle()
+    args = parse_args()
+    if args.list:
+        for s in STAGES.values():
+            print(f"{s.name:28s} group={s.group:10s} deps={','.join(s.deps) or '-'}")
+    else:
+        analyze_hf_and_kaggle(args.only, workers=args.workers, report_path=args.report,
+                              options={"refit": args.refit, "projection_batch_size": args.projection_batch_size})
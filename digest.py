@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+digest.py
+
+Hierarchical inbox digest built from the per-email summaries in database.json.
+
+- Leaves are the existing aiSummary.summary strings (no re-summarizing of bodies)
+- Leaves are grouped by label (or by thread) and each group is summarized once
+- Group summaries are combined into one inbox-level digest
+- Every tree node is memoized by a hash of its input text, so new emails only
+  recompute the groups they land in, plus the root
+- The leaves of each group are saved to digest_groups.json, so the stream worker
+  can fold in a batch of new emails and deleted ids without reading the mailbox
+
+The summarizer is passed in by the caller (Summary_and_tone.py), which keeps
+this module free of model loading.
+"""
+
+import json
+import hashlib
+from datetime import datetime, timezone
+
+DIGEST_CACHE_PATH = "digest_cache.json"
+DIGEST_GROUPS_PATH = "digest_groups.json"
+DIGEST_CACHE_MAX_ENTRIES = 2000
+# Most recent emails per group that feed its summary
+DIGEST_MAX_PER_GROUP = 50
+# Labels that are not worth a digest section
+SKIPPED_LABELS = {"trash", "draft", "sent", "spam"}
+GMAIL_LABELS = {"inbox", "starred", "promotions", "social", "updates"}
+
+# ---------------------------
+# Grouping
+# ---------------------------
+def primary_label(email, categories):
+    """Custom category first, then a Gmail category tab, else 'inbox'."""
+    labels = [l for l in email.get("labels", []) or [] if l not in SKIPPED_LABELS]
+    for label in labels:
+        if label in categories:
+            return label
+    for label in labels:
+        if label not in ("inbox", "starred"):
+            return label
+    return "inbox"
+
+def group_emails(emails, templates, group_by="label"):
+    """Return {group_key: [email, ...]} in database order (newest first)."""
+    categories = {r["category"].lower() for r in (templates or {}).get("rules", [])}
+    groups = {}
+    for email in emails:
+        summary = (email.get("aiSummary") or {}).get("summary")
+        if not summary:
+            continue
+        labels = set(email.get("labels", []) or [])
+        if labels & SKIPPED_LABELS:
+            continue
+        if group_by == "thread":
+            key = email.get("threadId") or email.get("id", "")
+        else:
+            key = primary_label(email, categories)
+        groups.setdefault(key, []).append(email)
+    return groups
+
+def leaf(email):
+    """What the digest keeps of an email."""
+    return {"id": email.get("id"), "subject": email.get("subject") or "",
+            "summary": email["aiSummary"]["summary"]}
+
+def digest_groups(emails, templates, group_by="label"):
+    """{group_key: [leaf, ...]} with the most recent DIGEST_MAX_PER_GROUP emails of each group."""
+    return {key: [leaf(e) for e in members[:DIGEST_MAX_PER_GROUP]]
+            for key, members in group_emails(emails, templates, group_by).items()}
+
+def update_digest_groups(groups, emails, removed_ids, templates, group_by="label"):
+    """Fold newly processed emails (newest first) and deleted ids into saved groups, in place.
+
+    Returns the keys of the groups that changed. A group that lost emails is not
+    refilled with older ones until the next full run rebuilds the groups.
+    """
+    gone = set(removed_ids) | {e.get("id") for e in emails}
+    changed = set()
+    for key, leaves in groups.items():
+        kept = [l for l in leaves if l["id"] not in gone]
+        if len(kept) != len(leaves):
+            groups[key] = kept
+            changed.add(key)
+    for key, members in group_emails(emails, templates, group_by).items():
+        groups[key] = ([leaf(e) for e in members] + groups.get(key, []))[:DIGEST_MAX_PER_GROUP]
+        changed.add(key)
+    for key in [k for k, leaves in groups.items() if not leaves]:
+        del groups[key]
+    return changed
+
+def group_title(key, members, group_by):
+    if group_by == "thread":
+        return members[-1].get("subject") or "(no subject)"
+    return key.capitalize()
+
+def leaf_text(member):
+    return f"{member.get('subject') or '(no subject)'}: {member['summary']}"
+
+# ---------------------------
+# Memoized tree
+# ---------------------------
+def node_key(text, model_id):
+    return hashlib.sha1(f"{model_id}\n{text}".encode("utf-8")).hexdigest()
+
+def summarize_node(text, summarize, cache, model_id, stats):
+    """Summary of a node's input text, from the cache when the input is unchanged."""
+    key = node_key(text, model_id)
+    if key in cache:
+        stats["cached"] += 1
+        # Re-insert so recently used nodes survive pruning
+        cache[key] = cache.pop(key)
+        return cache[key]
+    stats["computed"] += 1
+    cache[key] = summarize(text)
+    return cache[key]
+
+def prune_cache(cache, max_entries=DIGEST_CACHE_MAX_ENTRIES):
+    for key in list(cache)[:max(0, len(cache) - max_entries)]:
+        del cache[key]
+    return cache
+
+def build_digest(emails, templates, summarize, cache, model_id="", group_by="label"):
+    """Build the digest tree from the whole mailbox (see digest_from_groups)."""
+    return digest_from_groups(digest_groups(emails, templates, group_by), summarize, cache, model_id, group_by)
+
+def digest_from_groups(leaf_groups, summarize, cache, model_id="", group_by="label"):
+    """Build the digest tree from grouped leaves and return it as a JSON-serializable dict.
+
+    summarize(text) -> str must handle inputs longer than the model limit.
+    cache is a dict of node summaries and is updated in place; unchanged groups
+    are served from it without calling summarize.
+    """
+    stats = {"computed": 0, "cached": 0}
+    groups = []
+    for key, members in leaf_groups.items():
+        if len(members) == 1:
+            # A single email is its own summary
+            summary = members[0]["summary"]
+        else:
+            text = "\n".join(leaf_text(e) for e in members)
+            summary = summarize_node(text, summarize, cache, model_id, stats)
+        groups.append({
+            "key": key,
+            "title": group_title(key, members, group_by),
+            "count": len(members),
+            "emailIds": [e.get("id") for e in members],
+            "summary": summary,
+        })
+    groups.sort(key=lambda g: (-g["count"], g["key"]))
+
+    if not groups:
+        root = ""
+    elif len(groups) == 1:
+        root = groups[0]["summary"]
+    else:
+        text = "\n".join(f"{g['title']} ({g['count']}): {g['summary']}" for g in groups)
+        root = summarize_node(text, summarize, cache, model_id, stats)
+
+    return {
+        "generatedAt": datetime.now(timezone.utc).isoformat(),
+        "groupBy": group_by,
+        "summary": root,
+        "groups": groups,
+        "stats": stats,
+    }
+
+def _load_dict(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def load_digest_cache(path=DIGEST_CACHE_PATH):
+    return _load_dict(path)
+
+def save_digest_cache(cache, path=DIGEST_CACHE_PATH):
+    prune_cache(cache)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False)
+
+def load_digest_groups(path=DIGEST_GROUPS_PATH):
+    return _load_dict(path)
+
+def save_digest_groups(groups, path=DIGEST_GROUPS_PATH):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(groups, f, ensure_ascii=False)
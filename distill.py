@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Summarizer Distillation
+-----------------------
+Distils the fine-tuned DistilBART (./distilbart_finetuned) into a smaller
+student that Summary_and_tone.py can serve:
+
+1. The teacher generates pseudo-summaries for the email threads (cached)
+2. A student is built: a layer-pruned copy of the teacher (e.g. 12-3, 6-6)
+   or a small pretrained model such as t5-small
+3. The student is trained on the pseudo-summaries (sequence-level KD), plus
+   a KL term on the teacher's logits when both share a vocabulary
+4. The student is saved to ./distilbart_student and compared with the teacher
+   on ROUGE and CPU latency (evaluate_models.py)
+
+Serve it with:  GM_SUMMARIZER_MODEL=./distilbart_student python Summary_and_tone.py
+"""
+
+import os
+import copy
+import json
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from datasets import Dataset, load_from_disk
+from transformers import (
+    AutoTokenizer, AutoModelForSeq2SeqLM,
+    Seq2SeqTrainingArguments, DataCollatorForSeq2Seq
+)
+
+from training_data import (load_splits, flatten_batch, build_tokenize_fn, source_prefix,
+                           TokenBudgetSeq2SeqTrainer, NUM_PROC, MAX_SOURCE_LEN)
+from training_profile import cpu_training_profile
+from evaluate_models import evaluate_models, generate_batched, print_table, GEN_KWARGS
+
+# -------------------------
+# 1. SETUP
+# -------------------------
+TEACHER_DIR = "./distilbart_finetuned"
+STUDENT_DIR = "./distilbart_student"
+PSEUDO_CACHE_DIR = "./cache/pseudo_labels"
+MAX_TARGET_LEN = 150
+BATCH_SIZE = 4
+# Token-budget batches never cost more than BATCH_SIZE full-length rows: padded
+# source + label tokens, label tokens alone (decoder logits), and at most MAX_BATCH_SIZE rows
+MAX_TOKENS_PER_BATCH = BATCH_SIZE * (MAX_SOURCE_LEN + MAX_TARGET_LEN)
+MAX_LABEL_TOKENS_PER_BATCH = BATCH_SIZE * MAX_TARGET_LEN
+MAX_BATCH_SIZE = 4 * BATCH_SIZE
+
+# -------------------------
+# 2. PSEUDO-LABELS
+# -------------------------
+def teacher_key(teacher_dir, n_samples):
+    """Pseudo-labels depend on the teacher weights, the sample count, source length and generation settings."""
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(teacher_dir)):
+        path = os.path.join(teacher_dir, name)
+        if os.path.isfile(path):
+            h.update(f"{name}:{os.path.getsize(path)}:{int(os.path.getmtime(path))}".encode("utf-8"))
+    h.update(json.dumps({"n": n_samples, "source_len": MAX_SOURCE_LEN, "gen": GEN_KWARGS}, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+def build_pseudo_labels(teacher, teacher_tok, teacher_dir, n_samples, batch_size):
+    """Teacher summaries for the train threads, cached on disk."""
+    path = os.path.join(PSEUDO_CACHE_DIR, teacher_key(teacher_dir, n_samples))
+    if os.path.isdir(path):
+        print(f"✅ Loaded pseudo-labels from cache: {path}")
+        return load_from_disk(path)
+
+    train = load_splits()["train"]
+    if n_samples and len(train) > n_samples:
+        train = train.select(range(n_samples))
+    texts = train.map(flatten_batch, batched=True, num_proc=NUM_PROC if NUM_PROC > 1 else None,
+                      remove_columns=train.column_names)["flat_text"]
+    print(f"⏳ Teacher generating {len(texts)} pseudo-summaries...")
+    summaries, seconds = generate_batched(teacher, teacher_tok, texts, batch_size)
+    print(f"✅ Generated in {seconds:.0f}s ({len(texts) / max(seconds, 1e-9):.2f} threads/s)")
+
+    ds = Dataset.from_dict({"flat_text": texts, "summary": summaries})
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    ds.save_to_disk(tmp)
+    os.replace(tmp, path)
+    return load_from_disk(path)
+
+# -------------------------
+# 3. STUDENT
+# -------------------------
+def pick_layers(n_teacher, n_student):
+    """Evenly spaced teacher layers, always keeping the first and last."""
+    return [int(i) for i in np.linspace(0, n_teacher - 1, n_student).round()]
+
+def create_pruned_student(teacher, encoder_layers, decoder_layers):
+    """Copy a BART teacher keeping a subset of its encoder/decoder layers (shrink-and-fine-tune)."""
+    config = copy.deepcopy(teacher.config)
+    config.encoder_layers = encoder_layers
+    config.decoder_layers = decoder_layers
+    student = AutoModelForSeq2SeqLM.from_config(config)
+
+    teacher_state = teacher.state_dict()
+    maps = {
+        "encoder": pick_layers(teacher.config.encoder_layers, encoder_layers),
+        "decoder": pick_layers(teacher.config.decoder_layers, decoder_layers),
+    }
+    student_state = {}
+    for key in student.state_dict():
+        source = key
+        for side, chosen in maps.items():
+            marker = f".{side}.layers."
+            if marker in key:
+                head, rest = key.split(marker, 1)
+                idx, tail = rest.split(".", 1)
+                source = f"{head}{marker}{chosen[int(idx)]}.{tail}"
+        student_state[key] = teacher_state[source]
+    student.load_state_dict(student_state)
+    print(f"🧬 Student {encoder_layers}-{decoder_layers}: encoder layers {maps['encoder']}, decoder layers {maps['decoder']}")
+    return student
+
+def load_student(spec, teacher, teacher_tok):
+    """spec is 'E-D' (layer-pruned teacher) or a model name / path such as t5-small."""
+    parts = spec.split("-")
+    if len(parts) == 2 and all(p.isdigit() for p in parts):
+        return create_pruned_student(teacher, int(parts[0]), int(parts[1])), teacher_tok
+    return AutoModelForSeq2SeqLM.from_pretrained(spec), AutoTokenizer.from_pretrained(spec)
+
+# -------------------------
+# 4. TRAINER (sequence-level + logit KD)
+# -------------------------
+class DistillationTrainer(TokenBudgetSeq2SeqTrainer):
+    """Cross-entropy on pseudo-summaries, blended with KL to the teacher's token distribution."""
+
+    def __init__(self, *args, teacher=None, alpha_logits=0.0, temperature=2.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.teacher = teacher
+        self.alpha_logits = alpha_logits if teacher is not None else 0.0
+        self.temperature = temperature
+        if self.teacher is not None:
+            self.teacher.to(self.args.device).eval()
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        outputs = model(**inputs)
+        loss = outputs.loss
+        if self.alpha_logits > 0:
+            with torch.no_grad():
+                teacher_logits = self.teacher(**inputs).logits
+            mask = (inputs["labels"] != -100).unsqueeze(-1)
+            t = self.temperature
+            kl = F.kl_div(
+                F.log_softmax(outputs.logits / t, dim=-1),
+                F.softmax(teacher_logits / t, dim=-1),
+                reduction="none",
+            ).sum(-1, keepdim=True)
+            kl = (kl * mask).sum() / mask.sum().clamp(min=1) * (t * t)
+            loss = (1 - self.alpha_logits) * loss + self.alpha_logits * kl
+        return (loss, outputs) if return_outputs else loss
+
+# -------------------------
+# 5. MAIN
+# -------------------------
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Distil the fine-tuned summarizer into a smaller student.")
+    parser.add_argument("--teacher", default=TEACHER_DIR)
+    parser.add_argument("--student", default="12-3", help="'E-D' layer-pruned teacher (e.g. 12-3, 6-6) or a model name like t5-small")
+    parser.add_argument("--output", default=STUDENT_DIR)
+    parser.add_argument("--samples", type=int, default=5000, help="Train threads to pseudo-label (0 = all)")
+    parser.add_argument("--gen-batch-size", type=int, default=8)
+    parser.add_argument("--epochs", type=float, default=2)
+    parser.add_argument("--alpha-logits", type=float, default=0.5, help="Weight of the logit KL term (0 = sequence-level only)")
+    parser.add_argument("--temperature", type=float, default=2.0)
+    parser.add_argument("--eval-samples", type=int, default=200)
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    device = 0 if torch.cuda.is_available() else -1
+    teacher_tok = AutoTokenizer.from_pretrained(args.teacher)
+    teacher = AutoModelForSeq2SeqLM.from_pretrained(args.teacher).eval()
+    if device == 0:
+        teacher.to("cuda")
+
+    pseudo = build_pseudo_labels(teacher, teacher_tok, args.teacher, args.samples, args.gen_batch_size)
+
+    student, student_tok = load_student(args.student, teacher, teacher_tok)
+    same_vocab = student_tok.get_vocab() == teacher_tok.get_vocab()
+    if args.alpha_logits > 0 and not same_vocab:
+        print("⚠️ Student vocabulary differs from the teacher; using sequence-level distillation only")
+    prefix = source_prefix(student)
+    if prefix:
+        pseudo = pseudo.map(lambda b: {"flat_text": [prefix + t for t in b["flat_text"]]}, batched=True)
+    tokenized = pseudo.map(build_tokenize_fn(student_tok, MAX_SOURCE_LEN, MAX_TARGET_LEN),
+                           batched=True, num_proc=NUM_PROC if NUM_PROC > 1 else None,
+                           remove_columns=pseudo.column_names)
+
+    cpu_args = cpu_training_profile(student) if device == -1 else {}
+    training_args = Seq2SeqTrainingArguments(
+        output_dir=args.output,
+        per_device_train_batch_size=BATCH_SIZE,
+        learning_rate=5e-5,
+        weight_decay=0.01,
+        num_train_epochs=args.epochs,
+        save_total_limit=1,
+        logging_steps=50,
+        fp16=device == 0,
+        push_to_hub=False,
+        **cpu_args
+    )
+    trainer = DistillationTrainer(
+        model=student,
+        args=training_args,
+        train_dataset=tokenized,
+        tokenizer=student_tok,
+        data_collator=DataCollatorForSeq2Seq(student_tok, model=student),
+        max_tokens_per_batch=MAX_TOKENS_PER_BATCH // cpu_args.get("gradient_accumulation_steps", 1),
+        max_label_tokens_per_batch=MAX_LABEL_TOKENS_PER_BATCH // cpu_args.get("gradient_accumulation_steps", 1),
+        max_batch_size=max(1, MAX_BATCH_SIZE // cpu_args.get("gradient_accumulation_steps", 1)),
+        teacher=teacher if same_vocab else None,
+        alpha_logits=args.alpha_logits,
+        temperature=args.temperature,
+    )
+    print("⏳ Training student...")
+    trainer.train()
+    student.config.use_cache = True
+    trainer.save_model(args.output)
+    student_tok.save_pretrained(args.output)
+    print(f"✅ Student saved at {args.output}")
+
+    rows = evaluate_models([args.teacher, args.output], n_samples=args.eval_samples)
+    print_table(rows)
+    if len(rows) == 2:
+        t, s = rows
+        print(f"\n📉 ROUGE-L change: {s['rougeL'] - t['rougeL']:+.2f} points")
+        print(f"⚡ Speedup: {t['latency_p50_ms'] / max(s['latency_p50_ms'], 1e-9):.2f}x latency, "
+              f"{s['throughput_eps'] / max(t['throughput_eps'], 1e-9):.2f}x throughput")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+email_text.py
+
+Shared email text normalization used by Summary_and_tone.py, dataset.py,
+training.py and Analysis.py.
+
+- clean_email_text: strip quoted replies, rule lines and addresses (dataset threads)
+- flatten_thread: subject + cleaned messages of a thread
+- clean_text: HTML -> plain text for Gmail bodies
+- clean_many: batch API, fans out to a process pool for large corpora
+
+All patterns are compiled once at import. Run `python email_text.py` to check
+the golden outputs below.
+"""
+
+import re
+import sys
+from multiprocessing import Pool
+
+try:
+    from bs4 import BeautifulSoup
+except Exception:
+    BeautifulSoup = None
+
+# ---------------------------
+# Patterns
+# ---------------------------
+ORIGINAL_MESSAGE_RE = re.compile(r"-----Original Message-----.*", re.DOTALL | re.IGNORECASE)
+RULE_RE = re.compile(r"__+|--+|\*\*+")
+EMAIL_ADDRESS_RE = re.compile(r"\b[\w\.-]+@[\w\.-]+\.\w+\b")
+WHITESPACE_RE = re.compile(r"\s+")
+SPECIAL_CHARS_RE = re.compile(r"[^\w\s\.,!?\-]")
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+
+# Inputs below this size are cleaned in-process; pool start-up costs more than it saves
+PARALLEL_THRESHOLD = 5000
+
+# ---------------------------
+# Thread text (dataset / training)
+# ---------------------------
+def clean_email_text(text):
+    """Remove quoted originals, rule lines, email addresses and redundant whitespace."""
+    if text is None:
+        return ""
+    text = ORIGINAL_MESSAGE_RE.sub(" ", text)
+    text = RULE_RE.sub(" ", text)
+    text = EMAIL_ADDRESS_RE.sub(" ", text)
+    return WHITESPACE_RE.sub(" ", text).strip()
+
+def flatten_thread(thread):
+    """Flatten a thread dict into (flat_text, subject, cleaned_messages)."""
+    if not isinstance(thread, dict):
+        return "", "", []
+    subject = thread.get("subject", "") or ""
+    messages = thread.get("messages", []) or []
+    cleaned_messages = []
+    for m in messages:
+        body = m.get("body", "") if isinstance(m, dict) else str(m)
+        cleaned_messages.append(clean_email_text(body))
+    flat = subject + " \n " + " \n ".join(cleaned_messages)
+    return flat, subject, cleaned_messages
+
+# ---------------------------
+# Gmail bodies (Summary_and_tone)
+# ---------------------------
+def is_html(text):
+    """Check if text contains HTML"""
+    if not text:
+        return False
+    return bool(HTML_TAG_RE.search(text))
+
+def clean_text(text):
+    """Remove HTML tags and clean text"""
+    if not text:
+        return ""
+    # Only markup or entities need the HTML parser; plain text skips it
+    if "<" in text or "&" in text:
+        if BeautifulSoup is None:
+            raise ImportError("Please install 'beautifulsoup4': pip install beautifulsoup4")
+        soup = BeautifulSoup(text, "html.parser")
+        # Stylesheets and scripts are not part of the message
+        for tag in soup(["style", "script", "head"]):
+            tag.decompose()
+        text = soup.get_text()
+    text = WHITESPACE_RE.sub(" ", text)
+    text = SPECIAL_CHARS_RE.sub("", text)
+    return text.strip()
+
+# ---------------------------
+# Batch API
+# ---------------------------
+def clean_many(texts, cleaner=clean_email_text, processes=None, chunksize=256):
+    """Clean a batch of texts, in a process pool once the batch is large enough."""
+    texts = list(texts)
+    if processes == 1 or len(texts) < PARALLEL_THRESHOLD:
+        return [cleaner(t) for t in texts]
+    with Pool(processes) as pool:
+        return pool.map(cleaner, texts, chunksize=chunksize)
+
+# ---------------------------
+# Golden outputs
+# ---------------------------
+GOLDEN_CASES = [
+    (clean_email_text, None, ""),
+    (clean_email_text, "  Hi   team,\n\nsee\tbelow.  ", "Hi team, see below."),
+    (clean_email_text, "Sounds good.\n-----Original Message-----\nFrom: a@b.com\nold text",
+     "Sounds good."),
+    (clean_email_text, "Thanks -- Bob\n______\n**Note** mail jane.doe@corp.example.com now",
+     "Thanks Bob Note mail now"),
+    (clean_text, "", ""),
+    (clean_text, "Plain   text, with (parens) & symbols #1!", "Plain text, with parens  symbols 1!"),
+    (clean_text, "Hello\n\nWorld -- it's 50% off: buy now?", "Hello World -- its 50 off buy now?"),
+    (clean_text, "<p>Hi&nbsp;<b>there</b></p><br/>See &amp; sign caf&eacute;",
+     "Hi thereSee  sign café"),
+    (is_html, "<div>x</div>", True),
+    (is_html, "a < b and c > d", True),
+    (is_html, "no markup", False),
+]
+
+GOLDEN_THREAD = (
+    {"subject": "Q3 plan", "messages": [{"body": "Draft attached.\n--\nann@x.org"}, "ok  thanks", {"body": None}]},
+    ("Q3 plan \n Draft attached. \n ok thanks \n ", "Q3 plan", ["Draft attached.", "ok thanks", ""]),
+)
+
+def self_check():
+    failures = 0
+    for func, given, expected in GOLDEN_CASES:
+        got = func(given)
+        if got != expected:
+            failures += 1
+            print(f"FAIL {func.__name__}({given!r}) -> {got!r}, expected {expected!r}")
+    thread, expected = GOLDEN_THREAD
+    if flatten_thread(thread) != expected:
+        failures += 1
+        print(f"FAIL flatten_thread -> {flatten_thread(thread)!r}")
+    inputs = [given for func, given, _ in GOLDEN_CASES if func is clean_email_text] * 2000
+    if clean_many(inputs, processes=2) != [clean_email_text(t) for t in inputs]:
+        failures += 1
+        print("FAIL clean_many differs from clean_email_text")
+    total = len(GOLDEN_CASES) + 2
+    print(f"{total - failures}/{total} golden checks passed")
+    return failures == 0
+
+if __name__ == "__main__":
+    sys.exit(0 if self_check() else 1)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Summarization Model Evaluation (quality vs. latency)
+----------------------------------------------------
+Generates summaries for the held-out split with each candidate model and
+reports ROUGE-1/2/L next to per-email CPU latency and batched throughput,
+so we can pick the model Summary_and_tone.py should serve.
+
+Usage:
+    python evaluate_models.py
+    python evaluate_models.py --models sshleifer/distilbart-cnn-12-6 ./distilbart_finetuned ./distilbart_student --quantize
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+from rouge_score import rouge_scorer
+
+from training_data import load_splits, flatten_batch, source_prefix, MAX_SOURCE_LEN
+
+# -------------------------
+# 1. SETUP
+# -------------------------
+DEFAULT_MODELS = ["sshleifer/distilbart-cnn-12-6", "./distilbart_finetuned"]
+OUT_DIR = "./outputs"
+# Same generation settings as Summary_and_tone.py
+GEN_KWARGS = {"max_length": 120, "min_length": 30, "do_sample": False}
+ROUGE_TYPES = ["rouge1", "rouge2", "rougeL"]
+# A model within this many ROUGE-L points of the best counts as "as good"
+ROUGE_TOLERANCE = 1.0
+
+# -------------------------
+# 2. DATA
+# -------------------------
+def load_eval_examples(n_samples):
+    """Held-out threads (flattened exactly as in training) and reference summaries."""
+    eval_ds = load_splits()["eval"]
+    if n_samples and len(eval_ds) > n_samples:
+        eval_ds = eval_ds.select(range(n_samples))
+    flat = flatten_batch(eval_ds[:])
+    return flat["flat_text"], flat["summary"]
+
+# -------------------------
+# 3. MODELS
+# -------------------------
+def load_variants(model_names, quantize=False):
+    """Yield (label, tokenizer, model) for each model, plus an int8 dynamic-quantized variant if asked."""
+    for name in model_names:
+        if not os.path.isdir(name) and name.startswith((".", "/")):
+            print(f"⚠️ Skipping {name}: directory not found", file=sys.stderr)
+            continue
+        tokenizer = AutoTokenizer.from_pretrained(name)
+        model = AutoModelForSeq2SeqLM.from_pretrained(name).eval()
+        yield name, tokenizer, model
+        if quantize:
+            qmodel = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            yield f"{name} (int8)", tokenizer, qmodel
+
+@torch.inference_mode()
+def generate(model, tokenizer, texts):
+    prefix = source_prefix(model)
+    inputs = tokenizer([prefix + t for t in texts], max_length=MAX_SOURCE_LEN, truncation=True,
+                       padding=True, return_tensors="pt").to(model.device)
+    output_ids = model.generate(**inputs, **GEN_KWARGS)
+    return tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+def generate_batched(model, tokenizer, texts, batch_size):
+    """Summaries for all texts plus total wall time of the batched generation."""
+    predictions = []
+    start = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        predictions.extend(generate(model, tokenizer, texts[i:i + batch_size]))
+    return predictions, time.perf_counter() - start
+
+def measure_latency(model, tokenizer, texts):
+    """Per-email latency with batch size 1, as Summary_and_tone.py serves today."""
+    timings = []
+    for text in texts:
+        start = time.perf_counter()
+        generate(model, tokenizer, [text])
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+# -------------------------
+# 4. ROUGE (parallel)
+# -------------------------
+def _score_chunk(pairs):
+    scorer = rouge_scorer.RougeScorer(ROUGE_TYPES, use_stemmer=True)
+    return [{k: v.fmeasure for k, v in scorer.score(ref, pred).items()} for pred, ref in pairs]
+
+def compute_rouge(predictions, references, workers=None, chunk_size=64):
+    pairs = list(zip(predictions, references))
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        scores = [s for chunk in pool.map(_score_chunk, chunks) for s in chunk]
+    if not scores:
+        return {k: 0.0 for k in ROUGE_TYPES}
+    return {k: round(float(np.mean([s[k] for s in scores])) * 100, 2) for k in ROUGE_TYPES}
+
+# -------------------------
+# 5. REPORT
+# -------------------------
+def recommend(rows):
+    """Fastest model whose ROUGE-L is within ROUGE_TOLERANCE of the best."""
+    if not rows:
+        return None
+    best = max(r["rougeL"] for r in rows)
+    eligible = [r for r in rows if r["rougeL"] >= best - ROUGE_TOLERANCE]
+    return min(eligible, key=lambda r: r["latency_p50_ms"])["model"]
+
+def print_table(rows):
+    header = f"{'model':45s} {'R-1':>6s} {'R-2':>6s} {'R-L':>6s} {'p50 ms':>8s} {'p95 ms':>8s} {'emails/s':>9s}"
+    print("\n" + header)
+    print("-" * len(header))
+    for r in rows:
+        print(f"{r['model'][:45]:45s} {r['rouge1']:6.2f} {r['rouge2']:6.2f} {r['rougeL']:6.2f} "
+              f"{r['latency_p50_ms']:8.0f} {r['latency_p95_ms']:8.0f} {r['throughput_eps']:9.2f}")
+
+def evaluate_models(model_names, n_samples=200, batch_size=8, latency_samples=20,
+                    quantize=False, threads=None, workers=None):
+    if threads:
+        torch.set_num_threads(threads)
+    texts, references = load_eval_examples(n_samples)
+    print(f"📊 Evaluating on {len(texts)} held-out threads (CPU threads: {torch.get_num_threads()})", file=sys.stderr)
+
+    rows = []
+    for label, tokenizer, model in load_variants(model_names, quantize=quantize):
+        print(f"⏳ {label}: generating...", file=sys.stderr)
+        predictions, total_s = generate_batched(model, tokenizer, texts, batch_size)
+        latencies = measure_latency(model, tokenizer, texts[:latency_samples])
+        rouge = compute_rouge(predictions, references, workers=workers)
+        rows.append({
+            "model": label,
+            **rouge,
+            "latency_p50_ms": float(np.percentile(latencies, 50)) if latencies else 0.0,
+            "latency_p95_ms": float(np.percentile(latencies, 95)) if latencies else 0.0,
+            "throughput_eps": len(texts) / total_s if total_s else 0.0,
+            "batch_size": batch_size,
+            "samples": len(texts),
+        })
+        print(f"✅ {label}: ROUGE-L {rouge['rougeL']:.2f}, {rows[-1]['throughput_eps']:.2f} emails/s", file=sys.stderr)
+    return rows
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare summarization models on ROUGE and CPU latency.")
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS, help="Model names or local checkpoint dirs")
+    parser.add_argument("--samples", type=int, default=200, help="Held-out threads to evaluate (default: 200)")
+    parser.add_argument("--batch-size", type=int, default=8, help="Generation batch size for throughput")
+    parser.add_argument("--latency-samples", type=int, default=20, help="Threads timed one at a time")
+    parser.add_argument("--quantize", action="store_true", help="Also evaluate int8 dynamic-quantized variants")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for ROUGE scoring")
+    parser.add_argument("--output", default=os.path.join(OUT_DIR, "model_eval.json"))
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    rows = evaluate_models(args.models, n_samples=args.samples, batch_size=args.batch_size,
+                           latency_samples=args.latency_samples, quantize=args.quantize,
+                           threads=args.threads, workers=args.workers)
+    print_table(rows)
+    choice = recommend(rows)
+    if choice:
+        print(f"\n🏆 Recommended for Summary_and_tone.py: {choice} "
+              f"(fastest within {ROUGE_TOLERANCE} ROUGE-L of the best)")
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"results": rows, "recommended": choice, "generation": GEN_KWARGS}, f, indent=2)
+    print(f"💾 Saved {args.output}")
+
+if __name__ == "__main__":
+    main()
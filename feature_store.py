@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+feature_store.py
+
+Columnar cache for the dataset.py analysis stages.
+
+- Each stage's output columns are written as one Parquet file
+- Files are keyed by dataset fingerprint + stage code version
+- Reads go through a memory-mapped Arrow file, so warm runs skip recomputation
+- Changing a stage's code (or the keyword lists it uses) changes its version,
+  which misses the cache and prunes the stale file on the next save
+"""
+
+import os
+import re
+import json
+import hashlib
+import inspect
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except Exception:
+    raise ImportError("Please install 'pyarrow': pip install pyarrow")
+
+STORE_DIR = "./outputs/feature_store"
+
+# ---------------------------
+# Keys
+# ---------------------------
+def _source_of(obj):
+    if isinstance(obj, re.Pattern):
+        return f"re:{obj.pattern}:{obj.flags}"
+    if inspect.isfunction(obj) or inspect.isclass(obj) or inspect.ismodule(obj):
+        try:
+            return inspect.getsource(obj)
+        except (OSError, TypeError):
+            return f"{obj.__module__}.{obj.__qualname__}"
+    return json.dumps(obj, sort_keys=True, default=str)
+
+def code_version(*parts):
+    """Hash the source of functions and the value of constants a stage depends on."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(_source_of(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:16]
+
+def dataset_fingerprint(hf_split):
+    """HF datasets carry a content fingerprint; fall back to hashing the raw rows."""
+    fp = getattr(hf_split, "_fingerprint", None)
+    if fp:
+        return str(fp)
+    h = hashlib.sha256()
+    for row in hf_split:
+        h.update(json.dumps(row, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+# ---------------------------
+# Store
+# ---------------------------
+class FeatureStore:
+    def __init__(self, fingerprint, root=STORE_DIR):
+        self.fingerprint = fingerprint
+        self.dir = os.path.join(root, fingerprint)
+        os.makedirs(self.dir, exist_ok=True)
+
+    def path(self, stage, version):
+        return os.path.join(self.dir, f"{stage}-{version}.parquet")
+
+    def load(self, stage, version):
+        path = self.path(stage, version)
+        if not os.path.exists(path):
+            return None
+        try:
+            table = pq.read_table(pa.memory_map(path, "r"))
+            df = table.to_pandas()
+            # list columns come back as numpy arrays; callers expect Python lists
+            for field in table.schema:
+                if pa.types.is_list(field.type) or pa.types.is_large_list(field.type):
+                    df[field.name] = table.column(field.name).to_pylist()
+            return df
+        except Exception as e:
+            print(f"Feature store: unreadable entry {path}, recomputing: {e}")
+            return None
+
+    def save(self, stage, version, df):
+        path = self.path(stage, version)
+        tmp = path + ".tmp"
+        try:
+            table = pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+            pq.write_table(table, tmp)
+            os.replace(tmp, path)
+            self.prune(stage, keep=version)
+        except Exception as e:
+            print(f"Feature store: failed to save {stage}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def prune(self, stage, keep):
+        """Drop entries of a stage written by older code versions."""
+        for name in os.listdir(self.dir):
+            if name.startswith(f"{stage}-") and name != f"{stage}-{keep}.parquet":
+                os.remove(os.path.join(self.dir, name))
+
+    def get_or_compute(self, stage, version, compute, index=None):
+        """Return cached columns for stage, or compute, persist and return them."""
+        df = self.load(stage, version)
+        if df is not None and (index is None or len(df) == len(index)):
+            print(f"Feature store: loaded '{stage}' ({version}) from cache")
+        else:
+            print(f"Feature store: computing '{stage}' ({version})")
+            df = compute()
+            self.save(stage, version, df)
+        if index is not None:
+            df.index = index
+        return df
@@ -3,6 +3,7 @@ const path = require("path");
 const express = require("express");
 const readline = require("readline");
 const { google } = require("googleapis");
+const zlib = require("zlib");
 const { spawn } = require("child_process");
 
 const app = express();
@@ -114,6 +115,52 @@ function categorizeEmail(subject, body, snippet, templates) {
   return categories;
 }
 
+/* ---------------------------------------------------------
+   Body store (written by body_store.py)
+--------------------------------------------------------- */
+const BODY_STORE_DIR = "body_store";
+let bodyIndexCache = { mtimeMs: 0, index: {} };
+
+function loadBodyIndex() {
+  try {
+    const indexPath = path.join(BODY_STORE_DIR, "index.json");
+    const { mtimeMs } = fs.statSync(indexPath);
+    if (mtimeMs !== bodyIndexCache.mtimeMs) {
+      bodyIndexCache = { mtimeMs, index: JSON.parse(fs.readFileSync(indexPath, "utf8")) };
+    }
+  } catch (err) {
+    bodyIndexCache = { mtimeMs: 0, index: {} };
+  }
+  return bodyIndexCache.index;
+}
+
+// Decompress one body from the pack; records only carry its hash
+function readBody(hash) {
+  const entry = loadBodyIndex()[hash];
+  if (!entry) return null;
+  const [offset, length] = entry;
+  const buffer = Buffer.alloc(length);
+  const fd = fs.openSync(path.join(BODY_STORE_DIR, "bodies.pack"), "r");
+  try {
+    fs.readSync(fd, buffer, 0, length, offset);
+  } finally {
+    fs.closeSync(fd);
+  }
+  return zlib.inflateSync(buffer).toString("utf8");
+}
+
+function getEmailBody(email) {
+  if (email.body !== undefined) return email.body || "";
+  if (email.bodyHash) {
+    try {
+      return readBody(email.bodyHash) || "";
+    } catch (err) {
+      console.error("Error reading body:", err.message);
+    }
+  }
+  return "";
+}
+
 /* ---------------------------------------------------------
    Database helpers
 --------------------------------------------------------- */
@@ -138,6 +185,15 @@ function saveDatabase(data) {
   }
 }
 
+// Load, change and save with no await in between, so a write made while another
+// handler was waiting (Gmail fetch, AI worker) is never overwritten by a stale copy
+function updateDatabase(change) {
+  const db = loadDatabase();
+  const result = change(db);
+  saveDatabase(db);
+  return result;
+}
+
 /* ---------------------------------------------------------
    Gmail Auth helpers with error handling
 --------------------------------------------------------- */
@@ -317,15 +373,21 @@ async function sendEmail(auth, to, subject, body, threadId = null) {
 /* ---------------------------------------------------------
    Run Python AI Processing (Non-blocking)
 --------------------------------------------------------- */
+let fullRunActive = false;
+
 function runPythonAIProcessing() {
   return new Promise((resolve, reject) => {
     console.log("🤖 Running Python AI processing in background...");
     
-    const pythonProcess = spawn("python", ["Summary_and_tone.py"], {
+    const pythonProcess = spawn("python", ["Summary_and_tone.py", "--full"], {
       detached: true,
       stdio: 'ignore'
     });
     
+    // It saves database.json when it exits; syncEmails holds new emails back until then
+    fullRunActive = true;
+    pythonProcess.on("exit", () => { fullRunActive = false; });
+    pythonProcess.on("error", () => { fullRunActive = false; });
     pythonProcess.unref();
     
     console.log("✅ Python AI processing started in background");
@@ -333,37 +395,127 @@ function runPythonAIProcessing() {
   });
 }
 
+/* ---------------------------------------------------------
+   AI worker: new emails in, per-email deltas out (JSON lines)
+--------------------------------------------------------- */
+let aiWorker = null;
+const aiInFlight = new Set();
+
+function applyAIDeltas(deltas, digest = null) {
+  if (deltas.length === 0 && !digest) return;
+  updateDatabase(db => {
+    if (digest) db.digest = digest;
+    const byId = new Map(db.emails.map(e => [e.id, e]));
+    deltas.forEach(delta => {
+      aiInFlight.delete(delta.id);
+      const email = byId.get(delta.id);
+      if (!email) return;
+      Object.assign(email, delta);
+      // The worker moved the body into the body store
+      if (delta.bodyHash) delete email.body;
+    });
+  });
+  console.log(`✅ Applied AI results for ${deltas.length} emails`);
+}
+
+function getAIWorker() {
+  if (aiWorker) return aiWorker;
+
+  console.log("🤖 Starting Python AI worker...");
+  const worker = spawn("python", ["Summary_and_tone.py", "--stdin"], {
+    stdio: ["pipe", "pipe", "inherit"]
+  });
+  const pending = [];
+
+  readline.createInterface({ input: worker.stdout }).on("line", line => {
+    let message;
+    try {
+      message = JSON.parse(line);
+    } catch (err) {
+      return;
+    }
+    // The digest comes with the flush, so one database write covers the whole batch
+    if (message.flushed) applyAIDeltas(pending.splice(0), message.digest);
+    else if (message.id) pending.push(message);
+  });
+
+  const reset = () => {
+    if (aiWorker === worker) aiWorker = null;
+    applyAIDeltas(pending.splice(0));
+    // Unfinished emails keep new_email: true and are re-sent by the next sync
+    aiInFlight.clear();
+  };
+  worker.on("exit", code => {
+    console.log(`ℹ️ Python AI worker exited (${code})`);
+    reset();
+  });
+  worker.on("error", err => {
+    console.error("AI worker failed to start:", err.message);
+    reset();
+  });
+  worker.stdin.on("error", err => console.error("AI worker stdin error:", err.message));
+
+  aiWorker = worker;
+  return worker;
+}
+
+// Emails that left the mailbox: the worker drops them from the indexes and the digest
+function sendDeletedToAIWorker(ids) {
+  if (ids.length === 0 || fullRunActive) return;
+  const worker = getAIWorker();
+  worker.stdin.write(JSON.stringify({ deleted: ids }) + "\n");
+  worker.stdin.write(JSON.stringify({ flush: true }) + "\n");
+}
+
+function sendToAIWorker(emails) {
+  const batch = emails.filter(e => !aiInFlight.has(e.id));
+  if (batch.length === 0) return;
+
+  const worker = getAIWorker();
+  batch.forEach(e => {
+    aiInFlight.add(e.id);
+    const { id, threadId, sender, subject, body, snippet, labels } = e;
+    worker.stdin.write(JSON.stringify({ id, threadId, sender, subject, body, snippet, labels }) + "\n");
+  });
+  worker.stdin.write(JSON.stringify({ flush: true }) + "\n");
+  console.log(`📤 Sent ${batch.length} new emails to the AI worker`);
+}
+
 /* ---------------------------------------------------------
    Sync & categorize emails
 --------------------------------------------------------- */
 async function syncEmails(auth) {
   try {
-    const db = loadDatabase();
-    const existingIds = new Set(db.emails.map(e => e.id));
     const fetchedEmails = await listMessages(auth);
 
     if (!fetchedEmails || fetchedEmails.length === 0) {
       console.log("⚠️ No emails fetched");
-      return db.emails;
+      return loadDatabase().emails;
     }
 
-    const newEmails = fetchedEmails.filter(e => !existingIds.has(e.id));
-    
-    newEmails.forEach(e => e.new_email = true);
-    
-    db.emails = [...newEmails, ...db.emails.filter(e => fetchedEmails.find(f => f.id === e.id))];
-    db.lastSync = new Date().toISOString();
+    // Read after the fetch: AI results applied while it was running must be kept
+    const { emails, deletedIds } = updateDatabase(db => {
+      const existingIds = new Set(db.emails.map(e => e.id));
+      const fetchedIds = new Set(fetchedEmails.map(f => f.id));
+      const newEmails = fetchedEmails.filter(e => !existingIds.has(e.id));
 
-    saveDatabase(db);
+      newEmails.forEach(e => e.new_email = true);
+
+      const deletedIds = db.emails.filter(e => !fetchedIds.has(e.id)).map(e => e.id);
+      db.emails = [...newEmails, ...db.emails.filter(e => fetchedIds.has(e.id))];
+      db.lastSync = new Date().toISOString();
+      return { emails: db.emails, deletedIds };
+    });
     
+    // New emails, plus any whose results were lost (e.g. the worker exited mid-batch)
     const aiSettings = loadAISettings();
-    if (aiSettings.emailSummarization && newEmails.length > 0) {
-      runPythonAIProcessing().catch(err => {
-        console.error("AI processing failed:", err.message);
-      });
+    const unprocessed = emails.filter(e => e.new_email);
+    if (aiSettings.emailSummarization) {
+      sendDeletedToAIWorker(deletedIds);
+      if (unprocessed.length > 0 && !fullRunActive) sendToAIWorker(unprocessed);
     }
     
-    return db.emails;
+    return emails;
   } catch (err) {
     console.error("Error in syncEmails:", err.message);
     const db = loadDatabase();
@@ -380,26 +532,187 @@ function getCategoryCounts(emails) {
   return counts;
 }
 
+/* ---------------------------------------------------------
+   Search index (built by search_index.py)
+--------------------------------------------------------- */
+const SEARCH_INDEX_DIR = "search_index";
+// Segments are immutable, so each one is parsed once; the manifest says which are live
+let searchIndexCache = { mtimeMs: 0, index: null };
+const searchSegmentCache = new Map();
+
+// Must match tokenize() in search_index.py: TOKEN_RE (letters and digits, lowercased),
+// minus the stop words and overlong terms listed in the manifest
+function tokenizeQuery(text, analyzer) {
+  return (text.toLowerCase().match(/[\p{L}\p{N}]+/gu) || [])
+    .filter(t => !analyzer.stopWords.has(t) && t.length <= analyzer.maxTermLength);
+}
+
+function loadSearchIndex() {
+  try {
+    const manifestPath = path.join(SEARCH_INDEX_DIR, "manifest.json");
+    const { mtimeMs } = fs.statSync(manifestPath);
+    if (mtimeMs === searchIndexCache.mtimeMs) return searchIndexCache.index;
+
+    const manifest = JSON.parse(fs.readFileSync(manifestPath, "utf8"));
+    const segments = manifest.segments.map(meta => {
+      if (!searchSegmentCache.has(meta.name)) {
+        searchSegmentCache.set(meta.name, JSON.parse(fs.readFileSync(path.join(SEARCH_INDEX_DIR, meta.name), "utf8")));
+      }
+      return { ...searchSegmentCache.get(meta.name), deleted: new Set(meta.deleted) };
+    });
+    const live = new Set(manifest.segments.map(meta => meta.name));
+    [...searchSegmentCache.keys()].forEach(name => { if (!live.has(name)) searchSegmentCache.delete(name); });
+
+    let n = 0, totalLength = 0;
+    const terms = new Set();
+    segments.forEach(seg => {
+      seg.lengths.forEach((len, i) => { if (!seg.deleted.has(i)) { n++; totalLength += len; } });
+      Object.keys(seg.postings).forEach(t => terms.add(t));
+    });
+    const analyzer = manifest.analyzer || { stopWords: [], maxTermLength: Infinity };
+    const index = {
+      k1: manifest.k1, b: manifest.b, n, avgdl: n ? totalLength / n : 1, segments,
+      analyzer: { stopWords: new Set(analyzer.stopWords), maxTermLength: analyzer.maxTermLength },
+      // Sorted term list for prefix matching of the word being typed
+      terms: [...terms].sort(),
+    };
+    searchIndexCache = { mtimeMs, index };
+    return index;
+  } catch (err) {
+    searchIndexCache = { mtimeMs: 0, index: null };
+    return null;
+  }
+}
+
+function prefixTerms(terms, prefix, limit = 50) {
+  let lo = 0, hi = terms.length;
+  while (lo < hi) {
+    const mid = (lo + hi) >> 1;
+    if (terms[mid] < prefix) lo = mid + 1; else hi = mid;
+  }
+  const out = [];
+  for (let i = lo; i < terms.length && out.length < limit && terms[i].startsWith(prefix); i++) out.push(terms[i]);
+  return out;
+}
+
+// Same BM25 as search() in search_index.py. Returns every match, best first: the
+// dashboard pages through them and shows the real total
+function searchEmails(query) {
+  const index = loadSearchIndex();
+  if (!index) return null;
+
+  const { k1, b, n, avgdl, segments, terms, analyzer } = index;
+  const tokens = [...new Set(tokenizeQuery(query, analyzer))];
+  const scores = new Map();
+
+  tokens.forEach((token, i) => {
+    // The last word may still be being typed: expand it to indexed terms with that prefix
+    const isKnown = segments.some(seg => seg.postings[token]);
+    const expanded = i === tokens.length - 1 && !isKnown ? prefixTerms(terms, token) : [token];
+    expanded.forEach(term => {
+      const lists = segments.filter(seg => seg.postings[term]);
+      if (!lists.length) return;
+      // df counts deleted copies until their segment is merged
+      const df = lists.reduce((sum, seg) => sum + seg.postings[term].length / 2, 0);
+      const idf = Math.log(1 + (n - df + 0.5) / (df + 0.5));
+      lists.forEach(seg => {
+        const list = seg.postings[term];
+        let doc = 0;
+        for (let j = 0; j < list.length; j += 2) {
+          doc += list[j];
+          if (seg.deleted.has(doc)) continue;
+          const tf = list[j + 1];
+          const norm = k1 * (1 - b + b * seg.lengths[doc] / avgdl);
+          const id = seg.ids[doc];
+          scores.set(id, (scores.get(id) || 0) + idf * tf * (k1 + 1) / (tf + norm));
+        }
+      });
+    });
+  });
+
+  return [...scores.entries()]
+    .sort((x, y) => y[1] - x[1])
+    .map(([id, score]) => ({ id, score: Math.round(score * 1000) / 1000 }));
+}
+
 /* ---------------------------------------------------------
    Routes
 --------------------------------------------------------- */
-app.post("/api/add-template", (req, res) => {
+// Bodies are loaded lazily by the dashboard when an email is opened
+app.get("/api/body/:hash", (req, res) => {
+  try {
+    const body = readBody(req.params.hash);
+    if (body === null) return res.status(404).json({ error: "Body not found" });
+    res.json({ body });
+  } catch (err) {
+    console.error("Error reading body:", err);
+    res.status(500).json({ error: err.message });
+  }
+});
+
+app.get("/api/search", (req, res) => {
+  const query = (req.query.q || "").toString();
+  const start = process.hrtime.bigint();
+  const results = query.trim() ? searchEmails(query) : [];
+  const tookMs = Number(process.hrtime.bigint() - start) / 1e6;
+  // results === null: no index yet, the dashboard falls back to local filtering
+  res.json({ available: results !== null, results: results || [], tookMs });
+});
+
+// Label deltas for one rule change from recategorize.py (keyword index), or null
+function runRecategorize(change) {
+  return new Promise(resolve => {
+    const proc = spawn("python", ["recategorize.py"], { stdio: ["pipe", "pipe", "inherit"] });
+    let output = "";
+    proc.stdout.on("data", chunk => output += chunk);
+    proc.on("error", () => resolve(null));
+    proc.on("close", code => {
+      try {
+        const result = JSON.parse(output);
+        resolve(code === 0 && result.indexed ? result : null);
+      } catch (err) {
+        resolve(null);
+      }
+    });
+    proc.stdin.on("error", () => {});
+    proc.stdin.end(JSON.stringify(change));
+  });
+}
+
+app.post("/api/add-template", async (req, res) => {
   const { category, keywords } = req.body;
   if (!category || !Array.isArray(keywords)) return res.status(400).json({ error: "Invalid template data" });
 
   const templates = loadTemplates();
   const existing = templates.rules.find(r => r.category.toLowerCase() === category.toLowerCase());
+  const before = existing ? [...existing.keywords] : [];
   if (existing) existing.keywords = [...new Set([...existing.keywords, ...keywords])];
   else templates.rules.push({ category, keywords });
 
   saveTemplates(templates);
-  
+
+  // Only emails containing an added keyword can change; the index finds them
+  const after = existing ? existing.keywords : keywords;
+  const result = await runRecategorize({ category, before, after });
+
   const db = loadDatabase();
-  db.emails.forEach(email => {
-    const customCategories = categorizeEmail(email.subject, email.body, email.snippet, templates);
-    const existingLabels = email.labels.filter(l => !templates.rules.some(r => r.category.toLowerCase() === l));
-    email.labels = [...new Set([...existingLabels, ...customCategories])];
-  });
+  if (result) {
+    const label = result.category;
+    const add = new Set(result.add);
+    const remove = new Set(result.remove);
+    db.emails.forEach(email => {
+      if (add.has(email.id)) email.labels = [...new Set([...(email.labels || []), label])];
+      else if (remove.has(email.id)) email.labels = (email.labels || []).filter(l => l !== label);
+    });
+    console.log(`🏷️ Rule '${label}': checked ${result.checked} emails, +${add.size} -${remove.size}`);
+  } else {
+    // No keyword index yet: full rescan
+    db.emails.forEach(email => {
+      const customCategories = categorizeEmail(email.subject, getEmailBody(email), email.snippet, templates);
+      const existingLabels = email.labels.filter(l => !templates.rules.some(r => r.category.toLowerCase() === l));
+      email.labels = [...new Set([...existingLabels, ...customCategories])];
+    });
+  }
   saveDatabase(db);
   
   res.json({ success: true, templates });
@@ -413,6 +726,7 @@ app.post("/api/delete-template", (req, res) => {
   templates.rules = templates.rules.filter(r => r.category.toLowerCase() !== category.toLowerCase());
   saveTemplates(templates);
   
+  // Pure label removal: no text needs to be scanned
   const db = loadDatabase();
   db.emails.forEach(email => {
     email.labels = email.labels.filter(l => l !== category.toLowerCase());
@@ -423,13 +737,16 @@ app.post("/api/delete-template", (req, res) => {
 });
 
 app.post("/api/save-ai-settings", (req, res) => {
-  const { emailSummarization, aiAutoCategorization, smartReplyGeneration } = req.body;
+  const { emailSummarization, aiAutoCategorization, smartReplyGeneration, learnedCategorization } = req.body;
   
+  // Merge, so settings a form does not show (e.g. learnedCategorization on Home) are kept
   const settings = {
+    ...loadAISettings(),
     emailSummarization: emailSummarization !== undefined ? emailSummarization : true,
     aiAutoCategorization: aiAutoCategorization !== undefined ? aiAutoCategorization : true,
     smartReplyGeneration: smartReplyGeneration !== undefined ? smartReplyGeneration : true
   };
+  if (learnedCategorization !== undefined) settings.learnedCategorization = learnedCategorization;
 
   const success = saveAISettings(settings);
   res.json({ success });
@@ -656,9 +973,13 @@ app.get("/", async (req, res) => {
           summary: e.aiSummary?.summary || e.snippet,
         }));
         
-        const bulkSummary = listSummary.map(e => 
-          `${e.sender} (${e.time}): ${e.summary}`
-        ).join("\n\n");
+        // Prefer the hierarchical digest built by Summary_and_tone.py
+        const digest = loadDatabase().digest;
+        const bulkSummary = digest?.summary
+          ? [digest.summary, ...digest.groups.map(g => `${g.title} (${g.count}): ${g.summary}`)].join("\n\n")
+          : listSummary.map(e => 
+              `${e.sender} (${e.time}): ${e.summary}`
+            ).join("\n\n");
 
         res.render("dashboard", {
           emails,
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+learned_categorizer.py
+
+Statistical categorizer trained from the labels already stored in database.json.
+
+- Features: hashed word unigrams and bigrams of the cleaned subject (counted twice),
+  body and snippet, log-scaled term counts, L2-normalized. No fitted vocabulary or
+  idf, so an email maps to the same features for every version of the model
+- Model: one linear classifier per template category (one-vs-rest, logistic loss)
+  trained with SGD partial_fit, so new labeled mail updates it without a retrain
+- Targets: the category labels stored on each processed email; emails the keyword
+  rules match count as positives too, with a lower weight (weak supervision).
+  Labels the model itself added (listed in "learnedLabels") are not trained on
+- A batch of emails is scored with one sparse matrix multiply against the stacked
+  per-category weights
+- Saved with joblib to learned_categorizer.joblib
+
+Summary_and_tone.py adds its categories to the keyword rules' when AI_settings.json
+has "learnedCategorization": true, and trains it on newly processed emails. A
+category only predicts once it has MIN_POSITIVES positive examples.
+
+Usage:
+    python learned_categorizer.py --train          # train on emails not seen yet
+    python learned_categorizer.py --train --reset  # train from scratch
+    python learned_categorizer.py --evaluate       # accuracy and emails/sec vs the keyword rules
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from collections import Counter
+
+import numpy as np
+import joblib
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+from sklearn.preprocessing import normalize
+
+from body_store import body_key, load_body
+from recategorize import email_fields, score_keywords, regex_counts, CATEGORY_MIN_SCORE
+
+LEARNED_MODEL_PATH = "learned_categorizer.joblib"
+N_FEATURES = 2 ** 18
+# A keyword-rule match counts this much as a positive, against 1.0 for a stored label
+WEAK_LABEL_WEIGHT = 0.5
+# A category predicts only after this many positive training examples
+MIN_POSITIVES = 3
+LEARNED_MIN_PROBA = 0.5
+# Saved models whose features were computed differently are discarded on load
+FEATURES_VERSION = "log-tf-l2"
+# Emails vectorized at a time while training (bounds the size of the feature matrix)
+TRAIN_CHUNK_SIZE = 2000
+TRAIN_EPOCHS = 3
+SGD_ALPHA = 1e-5
+
+# ---------------------------
+# Features and targets
+# ---------------------------
+def field_text(fields):
+    subject, body, snippet = fields
+    return f"{subject} {subject} {body} {snippet}"
+
+def keyword_categories(fields, rules):
+    """Categories the template.json keyword rules give (same scoring as categorize_email)."""
+    categories = []
+    for rule in rules:
+        score, _ = score_keywords(rule.get("keywords", []), lambda kw: regex_counts(kw, fields))
+        if score >= CATEGORY_MIN_SCORE:
+            categories.append(rule.get("category", "").lower())
+    return categories
+
+def rule_categories(rules):
+    return [c for c in dict.fromkeys(r.get("category", "").lower() for r in rules) if c]
+
+def is_labeled(email):
+    """Processed emails carry their categories; new ones have none yet."""
+    return bool(email.get("aiSummary")) and not email.get("new_email", False)
+
+def stored_labels(email):
+    """Labels from the keyword rules, Gmail or the user; the model's own predictions excluded."""
+    return set(email.get("labels", []) or []) - set(email.get("learnedLabels", []) or [])
+
+def training_hash(email):
+    parts = (email.get("subject") or "", body_key(email), email.get("snippet") or "",
+             ",".join(sorted(email.get("labels", []) or [])),
+             ",".join(sorted(email.get("learnedLabels", []) or [])))
+    return hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()
+
+# ---------------------------
+# Model
+# ---------------------------
+class LearnedCategorizer:
+    def __init__(self):
+        self.vectorizer = HashingVectorizer(n_features=N_FEATURES, ngram_range=(1, 2), lowercase=False,
+                                            alternate_sign=False, norm=None)
+        self.models = {}
+        self.positives = Counter()
+        # email id -> training_hash of the version trained on
+        self.seen = {}
+
+    def features(self, texts):
+        """L2-normalized log term counts for the texts, as a sparse CSR matrix."""
+        counts = self.vectorizer.transform(texts).tocsr()
+        np.log1p(counts.data, out=counts.data)
+        return normalize(counts)
+
+    def partial_fit(self, emails, rules, store=None, epochs=1):
+        """Train on labeled emails that are new or changed since they were last seen. Returns how many."""
+        pending = [e for e in emails if e.get("id") and is_labeled(e)
+                   and self.seen.get(e["id"]) != training_hash(e)]
+        categories = rule_categories(rules)
+        if not pending or not categories:
+            return 0
+        rng = np.random.default_rng(len(self.seen))
+        for start in range(0, len(pending), TRAIN_CHUNK_SIZE):
+            chunk = pending[start:start + TRAIN_CHUNK_SIZE]
+            fields = [email_fields(e.get("subject"), load_body(e, store), e.get("snippet")) for e in chunk]
+            X = self.features([field_text(f) for f in fields])
+            weak = [set(keyword_categories(f, rules)) for f in fields]
+            stored = [stored_labels(e) for e in chunk]
+            learned = [set(e.get("learnedLabels", []) or []) for e in chunk]
+            for category in categories:
+                y = np.array([category in s or category in w for s, w in zip(stored, weak)], dtype=np.int64)
+                # A category only the model itself predicted is neither a positive nor a negative
+                weight = np.array([1.0 if category in s else WEAK_LABEL_WEIGHT if category in w
+                                   else 0.0 if category in m else 1.0
+                                   for s, w, m in zip(stored, weak, learned)])
+                model = self.models.setdefault(category, SGDClassifier(loss="log_loss", alpha=SGD_ALPHA))
+                for _ in range(epochs):
+                    order = rng.permutation(len(chunk))
+                    model.partial_fit(X[order], y[order], classes=[0, 1], sample_weight=weight[order])
+                self.positives[category] += int(y.sum())
+            for e in chunk:
+                self.seen[e["id"]] = training_hash(e)
+        return len(pending)
+
+    def weights(self, categories=None):
+        """(categories, W, b) for the categories that can predict; W is categories x features."""
+        names = [c for c, m in self.models.items()
+                 if self.positives[c] >= MIN_POSITIVES and (categories is None or c in categories)]
+        if not names:
+            return [], None, None
+        W = np.vstack([self.models[c].coef_[0] for c in names])
+        b = np.array([self.models[c].intercept_[0] for c in names])
+        return names, W, b
+
+    def predict_fields(self, fields, categories=None):
+        """Categories per email for cleaned (subject, body, snippet) fields."""
+        names, W, b = self.weights(categories)
+        if not names or not fields:
+            return [[] for _ in fields]
+        X = self.features([field_text(f) for f in fields])
+        # One sparse x dense multiply scores every email against every category
+        proba = 1 / (1 + np.exp(-(X @ W.T + b)))
+        return [[c for c, p in zip(names, row) if p >= LEARNED_MIN_PROBA] for row in proba]
+
+    def predict(self, emails, categories=None):
+        """Categories per email for raw (subject, body, snippet) tuples."""
+        return self.predict_fields([email_fields(*e) for e in emails], categories)
+
+# The state is saved as a plain dict, so the file does not depend on where the class
+# was imported from (the CLI runs this module as __main__)
+STATE_FIELDS = ("models", "positives", "seen")
+
+def load_categorizer(path=LEARNED_MODEL_PATH):
+    categorizer = LearnedCategorizer()
+    if os.path.exists(path):
+        try:
+            state = joblib.load(path)
+        except Exception as e:
+            print(f"⚠️ Could not load {path}, starting a new model: {e}", file=sys.stderr)
+            return categorizer
+        if state.get("n_features") == N_FEATURES and state.get("features") == FEATURES_VERSION:
+            for name in STATE_FIELDS:
+                setattr(categorizer, name, state[name])
+        else:
+            print(f"ℹ️ {path} was trained on different features, starting a new model", file=sys.stderr)
+    return categorizer
+
+def save_categorizer(categorizer, path=LEARNED_MODEL_PATH):
+    state = {name: getattr(categorizer, name) for name in STATE_FIELDS}
+    state["n_features"] = N_FEATURES
+    state["features"] = FEATURES_VERSION
+    tmp = path + ".tmp"
+    joblib.dump(state, tmp)
+    os.replace(tmp, path)
+
+# ---------------------------
+# Evaluation
+# ---------------------------
+def holdout(email_id):
+    """Deterministic 20% evaluation split by id."""
+    return int(hashlib.sha1(email_id.encode("utf-8")).hexdigest(), 16) % 5 == 0
+
+def score_predictions(truth, predicted):
+    tp = sum(len(t & p) for t, p in zip(truth, predicted))
+    fp = sum(len(p - t) for t, p in zip(truth, predicted))
+    fn = sum(len(t - p) for t, p in zip(truth, predicted))
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    exact = sum(t == p for t, p in zip(truth, predicted)) / len(truth) if truth else 0.0
+    return {"exact": exact, "precision": precision, "recall": recall, "f1": f1}
+
+def evaluate(emails, rules):
+    labeled = [e for e in emails if e.get("id") and is_labeled(e)]
+    train = [e for e in labeled if not holdout(e["id"])]
+    test = [e for e in labeled if holdout(e["id"])]
+    if not test:
+        print("⚠️ No labeled emails to evaluate on", file=sys.stderr)
+        return
+    categories = set(rule_categories(rules))
+
+    start = time.perf_counter()
+    categorizer = LearnedCategorizer()
+    categorizer.partial_fit(train, rules, epochs=TRAIN_EPOCHS)
+    print(f"🧠 Trained on {len(train)} emails in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    # Cleaning is shared by both scorers, so it is timed separately
+    start = time.perf_counter()
+    fields = [email_fields(e.get("subject"), load_body(e), e.get("snippet")) for e in test]
+    clean_seconds = time.perf_counter() - start
+    truth = [stored_labels(e) & categories for e in test]
+
+    start = time.perf_counter()
+    keyword = [set(keyword_categories(f, rules)) for f in fields]
+    keyword_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    learned = [set(c) for c in categorizer.predict_fields(fields, categories)]
+    learned_seconds = time.perf_counter() - start
+
+    print(f"📊 {len(test)} held-out emails, {len(categories)} categories "
+          f"(cleaning: {len(test) / clean_seconds:.0f} emails/s)", file=sys.stderr)
+    print(f"  {'scorer':<10} {'exact':>7} {'prec':>7} {'recall':>7} {'f1':>7} {'emails/s':>10}", file=sys.stderr)
+    for name, predicted, seconds in (("keyword", keyword, keyword_seconds), ("learned", learned, learned_seconds)):
+        m = score_predictions(truth, predicted)
+        print(f"  {name:<10} {m['exact']:>7.3f} {m['precision']:>7.3f} {m['recall']:>7.3f} {m['f1']:>7.3f} "
+              f"{len(test) / max(seconds, 1e-9):>10.0f}", file=sys.stderr)
+    print("  Stored labels written by the keyword rules favor the keyword scorer in this comparison.", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Train or evaluate the learned email categorizer.")
+    parser.add_argument("--database", default="database.json")
+    parser.add_argument("--templates", default="template.json")
+    parser.add_argument("--model", default=LEARNED_MODEL_PATH)
+    parser.add_argument("--train", action="store_true", help="Train on labeled emails not seen yet")
+    parser.add_argument("--reset", action="store_true", help="With --train, start from an empty model")
+    parser.add_argument("--evaluate", action="store_true", help="Compare with the keyword rules on a held-out split")
+    args = parser.parse_args()
+
+    with open(args.database, "r", encoding="utf-8") as f:
+        emails = json.load(f).get("emails", [])
+    with open(args.templates, "r", encoding="utf-8") as f:
+        rules = json.load(f).get("rules", [])
+
+    if args.train:
+        categorizer = LearnedCategorizer() if args.reset else load_categorizer(args.model)
+        start = time.perf_counter()
+        trained = categorizer.partial_fit(emails, rules, epochs=TRAIN_EPOCHS)
+        save_categorizer(categorizer, args.model)
+        print(f"✅ Trained on {trained} emails in {time.perf_counter() - start:.1f}s "
+              f"({len(categorizer.seen)} seen in total)", file=sys.stderr)
+    if args.evaluate:
+        evaluate(emails, rules)
+    if not (args.train or args.evaluate):
+        parser.print_help(sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+recategorize.py
+
+Incremental re-labelling when a template.json rule is added or edited.
+
+- Keeps a persistent keyword index (SQLite, keyword_index.db):
+  token -> email -> match counts in the cleaned subject / body / snippet
+- A rule change only looks at emails that contain one of the added or removed
+  keywords; every other email's score for that rule cannot have changed
+- Single-word keywords are scored straight from the posting counts; multi-word
+  keywords ("follow up") narrow candidates by their words and are verified
+  with the same regex categorize_email uses, on those candidates only
+- Scoring (subject x3, body x2, snippet x1, category at score >= 2) lives here
+  and is shared with categorize_email in Summary_and_tone.py
+- Deleting a rule is a pure label removal and needs no index (index.js)
+
+index.js sends the rule change as JSON on stdin and applies the printed
+{"add": [...], "remove": [...]} label deltas.
+
+Usage:
+    python recategorize.py --rebuild
+    echo '{"category": "Work", "before": ["meeting"], "after": ["meeting", "standup"]}' | python recategorize.py
+"""
+
+import re
+import sys
+import json
+import sqlite3
+import hashlib
+import argparse
+from array import array
+from collections import Counter
+
+from email_text import clean_text
+from body_store import body_key, load_body
+
+KEYWORD_INDEX_PATH = "keyword_index.db"
+# Weights of a keyword match in the subject, body and snippet
+FIELD_WEIGHTS = (3, 2, 1)
+CATEGORY_MIN_SCORE = 2
+
+WORD_RE = re.compile(r"\w+")
+
+# ---------------------------
+# Scoring (shared with categorize_email)
+# ---------------------------
+def email_fields(subject, body, snippet):
+    """Cleaned, lowercased (subject, body, snippet) exactly as categorize_email sees them."""
+    return clean_text(subject).lower(), clean_text(body).lower(), clean_text(snippet).lower()
+
+def keyword_pattern(kw_lower):
+    return r'\b' + re.escape(kw_lower) + r'\b'
+
+def regex_counts(kw_lower, fields):
+    pattern = keyword_pattern(kw_lower)
+    return tuple(len(re.findall(pattern, text)) for text in fields)
+
+def score_keywords(keywords, counts):
+    """Score of one rule: counts(kw_lower) -> (subject, body, snippet) matches. Returns (score, matched)."""
+    score = 0
+    matched = []
+    for kw in keywords:
+        kw_lower = kw.lower().strip()
+        if not kw_lower:
+            continue
+        field_counts = counts(kw_lower)
+        if any(field_counts):
+            score += sum(w * c for w, c in zip(FIELD_WEIGHTS, field_counts))
+            if kw not in matched:
+                matched.append(kw)
+    return score, matched
+
+def is_single_word(kw_lower):
+    return WORD_RE.fullmatch(kw_lower) is not None
+
+# ---------------------------
+# Keyword index
+# ---------------------------
+def content_hash(email):
+    parts = (email.get("subject") or "", body_key(email), email.get("snippet") or "")
+    return hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()
+
+class KeywordIndex:
+    """token -> {doc: (subject, body, snippet) counts}, with docs mapped to email ids."""
+
+    def __init__(self, path=KEYWORD_INDEX_PATH):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY, email_id TEXT UNIQUE NOT NULL,
+                hash TEXT NOT NULL, tokens BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS tokens (
+                id INTEGER PRIMARY KEY, token TEXT UNIQUE NOT NULL);
+            CREATE TABLE IF NOT EXISTS postings (
+                token_id INTEGER NOT NULL, doc INTEGER NOT NULL,
+                subject INTEGER NOT NULL, body INTEGER NOT NULL, snippet INTEGER NOT NULL,
+                PRIMARY KEY (token_id, doc)) WITHOUT ROWID;
+        """)
+        self._token_ids = {}
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def token_id(self, token, create=False):
+        if token in self._token_ids:
+            return self._token_ids[token]
+        row = self.conn.execute("SELECT id FROM tokens WHERE token = ?", (token,)).fetchone()
+        if row is None and create:
+            row = (self.conn.execute("INSERT INTO tokens (token) VALUES (?)", (token,)).lastrowid,)
+        if row is not None:
+            self._token_ids[token] = row[0]
+            return row[0]
+        return None
+
+    def _remove(self, doc):
+        token_ids = array("q")
+        token_ids.frombytes(self.conn.execute("SELECT tokens FROM docs WHERE id = ?", (doc,)).fetchone()[0])
+        self.conn.executemany("DELETE FROM postings WHERE token_id = ? AND doc = ?",
+                              [(t, doc) for t in token_ids])
+        self.conn.execute("DELETE FROM docs WHERE id = ?", (doc,))
+
+    def _add(self, email, store=None):
+        fields = email_fields(email.get("subject"), load_body(email, store), email.get("snippet"))
+        per_field = [Counter(WORD_RE.findall(text)) for text in fields]
+        tokens = set().union(*per_field)
+        token_ids = array("q", (self.token_id(t, create=True) for t in tokens))
+        doc = self.conn.execute("INSERT INTO docs (email_id, hash, tokens) VALUES (?, ?, ?)",
+                                (email["id"], content_hash(email), token_ids.tobytes())).lastrowid
+        self.conn.executemany(
+            "INSERT INTO postings VALUES (?, ?, ?, ?, ?)",
+            [(tid, doc, per_field[0][t], per_field[1][t], per_field[2][t]) for t, tid in zip(tokens, token_ids)])
+
+    def update(self, emails, prune=True, store=None, removed_ids=()):
+        """Index new or changed emails; with prune, drop emails no longer in the list,
+        else only removed_ids. Returns counts."""
+        current = {e["id"]: e for e in emails if e.get("id")}
+        if prune:
+            known = {email_id: (doc, h) for doc, email_id, h
+                     in self.conn.execute("SELECT id, email_id, hash FROM docs")}
+            gone = [email_id for email_id in known if email_id not in current]
+        else:
+            # Only the emails involved are looked up, not the whole docs table
+            wanted = list(dict.fromkeys(list(current) + list(removed_ids)))
+            known = {}
+            for start in range(0, len(wanted), 500):
+                chunk = wanted[start:start + 500]
+                known.update((email_id, (doc, h)) for doc, email_id, h in self.conn.execute(
+                    f"SELECT id, email_id, hash FROM docs WHERE email_id IN ({','.join('?' * len(chunk))})", chunk))
+            gone = [email_id for email_id in dict.fromkeys(removed_ids) if email_id in known and email_id not in current]
+        added = updated = removed = 0
+        with self.conn:
+            for email_id in gone:
+                self._remove(known[email_id][0])
+                removed += 1
+            for email_id, email in current.items():
+                entry = known.get(email_id)
+                if entry is not None:
+                    if entry[1] == content_hash(email):
+                        continue
+                    self._remove(entry[0])
+                    updated += 1
+                else:
+                    added += 1
+                self._add(email, store)
+        return {"docs": len(self), "added": added, "updated": updated, "removed": removed}
+
+    def postings(self, token):
+        """{email_id: (subject, body, snippet)} for one token."""
+        tid = self.token_id(token)
+        if tid is None:
+            return {}
+        rows = self.conn.execute(
+            "SELECT d.email_id, p.subject, p.body, p.snippet FROM postings p JOIN docs d ON d.id = p.doc "
+            "WHERE p.token_id = ?", (tid,))
+        return {email_id: (s, b, n) for email_id, s, b, n in rows}
+
+    def candidates(self, kw_lower):
+        """Emails that can contain the keyword: every one of its words must be present."""
+        words = WORD_RE.findall(kw_lower)
+        if not words:
+            return None  # no word characters: cannot be narrowed
+        result = None
+        for word in set(words):
+            ids = set(self.postings(word))
+            result = ids if result is None else result & ids
+            if not result:
+                break
+        return result
+
+# ---------------------------
+# Rule changes
+# ---------------------------
+def _normalize(keywords):
+    return {kw.lower().strip() for kw in keywords or [] if kw.lower().strip()}
+
+def recategorize_rule(index, category, before, after, load_emails=None):
+    """Label deltas for one rule going from `before` to `after` keywords.
+
+    Returns {"category", "add": [ids], "remove": [ids], "checked": n}.
+    load_emails(ids) -> {id: email} is only called for multi-word keywords.
+    """
+    changed = _normalize(before) ^ _normalize(after)
+    label = category.lower()
+    if not changed:
+        return {"category": label, "add": [], "remove": [], "checked": 0}
+
+    affected = set()
+    for kw in changed:
+        found = index.candidates(kw)
+        if found is None:
+            raise ValueError(f"keyword {kw!r} has no word characters; rescan needed")
+        affected |= found
+
+    # Count sources: posting lists for single words, regex on the candidates for phrases
+    single = {kw: index.postings(kw) for kw in _normalize(after) if is_single_word(kw)}
+    phrases = [kw for kw in _normalize(after) if not is_single_word(kw)]
+    phrase_counts = {}
+    if phrases and affected:
+        emails = load_emails(affected) if load_emails else {}
+        for email_id in affected:
+            email = emails.get(email_id)
+            if email is None:
+                continue
+            fields = email_fields(email.get("subject"), load_body(email), email.get("snippet"))
+            phrase_counts[email_id] = {kw: regex_counts(kw, fields) for kw in phrases}
+
+    add, remove = [], []
+    for email_id in affected:
+        def counts(kw_lower):
+            if kw_lower in single:
+                return single[kw_lower].get(email_id, (0, 0, 0))
+            return phrase_counts.get(email_id, {}).get(kw_lower, (0, 0, 0))
+        score, _ = score_keywords(after or [], counts)
+        (add if score >= CATEGORY_MIN_SCORE else remove).append(email_id)
+    return {"category": label, "add": sorted(add), "remove": sorted(remove), "checked": len(affected)}
+
+def load_emails_from_database(path="database.json"):
+    def load(ids):
+        with open(path, "r", encoding="utf-8") as f:
+            emails = json.load(f).get("emails", [])
+        return {e["id"]: e for e in emails if e.get("id") in ids}
+    return load
+
+def update_keyword_index(emails, path=KEYWORD_INDEX_PATH, prune=True, store=None, removed_ids=()):
+    index = KeywordIndex(path)
+    try:
+        return index.update(emails, prune=prune, store=store, removed_ids=removed_ids)
+    finally:
+        index.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply a template rule change using the keyword index.")
+    parser.add_argument("--database", default="database.json")
+    parser.add_argument("--index", default=KEYWORD_INDEX_PATH)
+    parser.add_argument("--rebuild", action="store_true", help="Index every email in the database")
+    args = parser.parse_args()
+
+    index = KeywordIndex(args.index)
+    try:
+        if args.rebuild:
+            with open(args.database, "r", encoding="utf-8") as f:
+                emails = json.load(f).get("emails", [])
+            stats = index.update(emails)
+            print(f"✅ Keyword index: {stats['docs']} emails (+{stats['added']} ~{stats['updated']} "
+                  f"-{stats['removed']})", file=sys.stderr)
+            return 0
+        if not len(index):
+            # index.js falls back to a full scan
+            print(json.dumps({"indexed": False}))
+            return 0
+        change = json.load(sys.stdin)
+        try:
+            result = recategorize_rule(index, change["category"], change.get("before"), change.get("after"),
+                                       load_emails=load_emails_from_database(args.database))
+        except ValueError as e:
+            print(f"⚠️ {e}", file=sys.stderr)
+            print(json.dumps({"indexed": False}))
+            return 0
+        result["indexed"] = True
+        print(json.dumps(result))
+        print(f"✅ {result['category']}: checked {result['checked']} emails, "
+              f"+{len(result['add'])} -{len(result['remove'])}", file=sys.stderr)
+        return 0
+    finally:
+        index.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
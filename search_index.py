@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+search_index.py
+
+BM25 inverted index over the synced mailbox, for the dashboard search box.
+
+- Documents are the cleaned sender, subject, body and aiSummary of each email
+  (HTML bodies go through clean_text, so markup never reaches the index)
+- The index is a set of immutable segments under search_index/, like Lucene:
+  each run writes one small segment with the new or changed emails and marks
+  the old copies deleted, so only those emails are cleaned and tokenized and
+  the large segments are never rewritten
+- Small segments are merged once there are more than MAX_SEGMENTS; the whole
+  index is compacted when too many of its documents are deleted
+- index.js (/api/search) reads manifest.json and the segments, caches them by
+  file, and scores queries itself with the same BM25 as search() below; the
+  manifest carries STOP_WORDS and MAX_TERM_LENGTH so queries are tokenized
+  exactly like the documents
+
+Usage:
+    python search_index.py --rebuild
+    python search_index.py "invoice overdue"
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import hashlib
+import argparse
+from collections import Counter
+
+from email_text import clean_text
+from body_store import body_key, load_body
+
+SEARCH_INDEX_DIR = "search_index"
+INDEX_VERSION = 1
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Subject words count this many times in the document
+SUBJECT_WEIGHT = 2
+# Long bodies (newsletters, logs) are indexed up to this many tokens
+MAX_DOC_TOKENS = 2000
+MAX_TERM_LENGTH = 30
+# Merge the small segments when there are more than this many
+MAX_SEGMENTS = 8
+# Compact everything when this fraction of indexed documents is deleted
+MAX_DELETED_FRACTION = 0.3
+
+# Letters and digits; index.js tokenizes queries with /[\p{L}\p{N}]+/gu
+TOKEN_RE = re.compile(r"[^\W_]+")
+STOP_WORDS = frozenset(
+    "a an and are as at be by for from has have i in is it its of on or our so that the "
+    "this to was we were will with you your".split()
+)
+
+# ---------------------------
+# Documents
+# ---------------------------
+def tokenize(text):
+    return [t for t in TOKEN_RE.findall(text.lower())
+            if t not in STOP_WORDS and len(t) <= MAX_TERM_LENGTH]
+
+def email_fields(email, store=None):
+    summary = (email.get("aiSummary") or {}).get("summary") or ""
+    return (email.get("sender") or "", email.get("subject") or "",
+            load_body(email, store) or email.get("snippet") or "", summary)
+
+def content_hash(email):
+    # body_key avoids decompressing stored bodies just to see whether they changed
+    summary = (email.get("aiSummary") or {}).get("summary") or ""
+    parts = (email.get("sender") or "", email.get("subject") or "", body_key(email),
+             email.get("snippet") or "", summary)
+    return hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()
+
+def document_terms(email, store=None):
+    """Term frequencies and length of one email."""
+    sender, subject, body, summary = email_fields(email, store)
+    tokens = tokenize(sender) + tokenize(subject) * SUBJECT_WEIGHT + tokenize(summary)
+    tokens += tokenize(clean_text(body))[:MAX_DOC_TOKENS]
+    return Counter(tokens), len(tokens)
+
+# ---------------------------
+# Files
+# ---------------------------
+def _read_json(path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return default
+
+def _write_json(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    # Atomic so the app never reads a half-written file
+    os.replace(tmp, path)
+
+class SearchIndex:
+    """Segments + manifest on disk, plus the id -> (hash, segment, position) map."""
+
+    def __init__(self, root=SEARCH_INDEX_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.manifest = _read_json(self.path("manifest.json"), None)
+        self.docs = _read_json(self.path("docs.json"), {})
+        if not self.manifest or self.manifest.get("version") != INDEX_VERSION:
+            self.manifest = {"version": INDEX_VERSION, "k1": BM25_K1, "b": BM25_B,
+                             "nextSegment": 1, "segments": []}
+            self.docs = {}
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def segment_meta(self, name):
+        return next(s for s in self.manifest["segments"] if s["name"] == name)
+
+    def read_segment(self, name):
+        return _read_json(self.path(name), None)
+
+    # -- writing -------------------------------------------------------
+    def write_segment(self, ids, lengths, term_docs):
+        """term_docs: term -> [(position, tf), ...] sorted by position."""
+        postings = {}
+        for term, pairs in term_docs.items():
+            flat, previous = [], 0
+            for position, tf in pairs:
+                flat.extend((position - previous, tf))
+                previous = position
+            postings[term] = flat
+        name = f"seg-{self.manifest['nextSegment']:06d}.json"
+        self.manifest["nextSegment"] += 1
+        _write_json(self.path(name), {"ids": ids, "lengths": lengths, "postings": postings})
+        self.manifest["segments"].append({"name": name, "docs": len(ids), "deleted": []})
+        return name
+
+    def add_documents(self, emails, store=None):
+        ids, lengths, term_docs = [], [], {}
+        for position, email in enumerate(emails):
+            tf, length = document_terms(email, store)
+            ids.append(email["id"])
+            lengths.append(length)
+            for term, count in tf.items():
+                term_docs.setdefault(term, []).append((position, count))
+        name = self.write_segment(ids, lengths, term_docs)
+        for position, email in enumerate(emails):
+            self.docs[email["id"]] = [content_hash(email), name, position]
+
+    def delete_document(self, doc_id):
+        _, name, position = self.docs.pop(doc_id)
+        self.segment_meta(name)["deleted"].append(position)
+
+    # -- merging -------------------------------------------------------
+    def merge(self, names):
+        """Rewrite the given segments as one, dropping deleted documents."""
+        ids, lengths, term_docs = [], [], {}
+        for name in names:
+            segment = self.read_segment(name)
+            deleted = set(self.segment_meta(name)["deleted"])
+            remap = {}
+            for position, doc_id in enumerate(segment["ids"]):
+                if position not in deleted:
+                    remap[position] = len(ids)
+                    ids.append(doc_id)
+                    lengths.append(segment["lengths"][position])
+            for term, flat in segment["postings"].items():
+                position = 0
+                for i in range(0, len(flat), 2):
+                    position += flat[i]
+                    if position in remap:
+                        term_docs.setdefault(term, []).append((remap[position], flat[i + 1]))
+        self.manifest["segments"] = [s for s in self.manifest["segments"] if s["name"] not in names]
+        merged = self.write_segment(ids, lengths, term_docs) if ids else None
+        for position, doc_id in enumerate(ids):
+            self.docs[doc_id][1:] = [merged, position]
+        return names
+
+    def maybe_merge(self):
+        """Returns the names of segments that were merged away."""
+        segments = self.manifest["segments"]
+        total = sum(s["docs"] for s in segments)
+        deleted = sum(len(s["deleted"]) for s in segments)
+        if total and deleted / total > MAX_DELETED_FRACTION:
+            return self.merge([s["name"] for s in segments])
+        if len(segments) > MAX_SEGMENTS:
+            # Keep the largest segment, fold everything else into one
+            largest = max(segments, key=lambda s: s["docs"])
+            return self.merge([s["name"] for s in segments if s is not largest])
+        return []
+
+    def commit(self):
+        """Publish the manifest, then remove segments nothing points to any more."""
+        self.manifest["segments"] = [s for s in self.manifest["segments"] if len(s["deleted"]) < s["docs"]]
+        self.manifest["analyzer"] = {"stopWords": sorted(STOP_WORDS), "maxTermLength": MAX_TERM_LENGTH}
+        _write_json(self.path("docs.json"), self.docs)
+        _write_json(self.path("manifest.json"), self.manifest)
+        live = {s["name"] for s in self.manifest["segments"]}
+        for name in os.listdir(self.root):
+            if name.startswith("seg-") and name not in live:
+                os.remove(self.path(name))
+
+# ---------------------------
+# Update
+# ---------------------------
+def update_search_index(emails, root=SEARCH_INDEX_DIR, prune=True, store=None, removed_ids=()):
+    """Index new or changed emails into a new segment. Returns a stats dict.
+
+    emails is the whole mailbox by default, and indexed emails missing from it
+    are dropped; with prune=False it is just a batch of new or updated emails,
+    and only removed_ids are dropped. store is the mailbox's BodyStore
+    (default: ./body_store).
+    """
+    start = time.perf_counter()
+    index = SearchIndex(root)
+    current = {e["id"]: e for e in emails if e.get("id")}
+
+    if prune:
+        removed = [doc_id for doc_id in index.docs if doc_id not in current]
+    else:
+        removed = [doc_id for doc_id in dict.fromkeys(removed_ids) if doc_id in index.docs and doc_id not in current]
+    changed, added = [], []
+    for doc_id, email in current.items():
+        entry = index.docs.get(doc_id)
+        if entry is None:
+            added.append(email)
+        elif entry[0] != content_hash(email):
+            changed.append(email)
+
+    for doc_id in removed + [e["id"] for e in changed]:
+        index.delete_document(doc_id)
+    if changed or added:
+        index.add_documents(changed + added, store)
+    merged = index.maybe_merge()
+    if removed or changed or added or merged:
+        index.commit()
+    return {
+        "docs": len(index.docs),
+        "segments": len(index.manifest["segments"]),
+        "added": len(added),
+        "updated": len(changed),
+        "removed": len(removed),
+        "merged": len(merged),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+# ---------------------------
+# Query (same scoring as index.js)
+# ---------------------------
+def search(query, root=SEARCH_INDEX_DIR, limit=20):
+    """BM25 over all live documents; returns [(email_id, score), ...]."""
+    index = SearchIndex(root)
+    segments = []
+    n = total_length = 0
+    for meta in index.manifest["segments"]:
+        segment = index.read_segment(meta["name"])
+        deleted = set(meta["deleted"])
+        segments.append((segment, deleted))
+        live = [l for i, l in enumerate(segment["lengths"]) if i not in deleted]
+        n += len(live)
+        total_length += sum(live)
+    if not n:
+        return []
+    avgdl = total_length / n or 1
+
+    scores = Counter()
+    for term in set(tokenize(query)):
+        lists = [(s, d, s["postings"][term]) for s, d in segments if term in s["postings"]]
+        # df counts deleted copies until their segment is merged, as in Lucene
+        df = sum(len(flat) // 2 for _, _, flat in lists)
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        for segment, deleted, flat in lists:
+            position = 0
+            for i in range(0, len(flat), 2):
+                position += flat[i]
+                if position in deleted:
+                    continue
+                tf = flat[i + 1]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * segment["lengths"][position] / avgdl)
+                scores[segment["ids"][position]] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+    return scores.most_common(limit)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the mailbox search index.")
+    parser.add_argument("query", nargs="?", help="Query to run against the index")
+    parser.add_argument("--database", default="database.json")
+    parser.add_argument("--rebuild", action="store_true", help="Drop the index and re-index every email")
+    args = parser.parse_args()
+
+    if args.rebuild or not args.query:
+        with open(args.database, "r", encoding="utf-8") as f:
+            emails = json.load(f).get("emails", [])
+        if args.rebuild:
+            for name in os.listdir(SEARCH_INDEX_DIR) if os.path.isdir(SEARCH_INDEX_DIR) else []:
+                os.remove(os.path.join(SEARCH_INDEX_DIR, name))
+        stats = update_search_index(emails)
+        print(f"✅ Search index: {stats['docs']} emails in {stats['segments']} segment(s) "
+              f"(+{stats['added']} ~{stats['updated']} -{stats['removed']}) in {stats['seconds']}s", file=sys.stderr)
+    if args.query:
+        start = time.perf_counter()
+        results = search(args.query)
+        print(f"🔎 {len(results)} results in {(time.perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+        for doc_id, score in results:
+            print(f"{score:8.3f}  {doc_id}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+smart_reply.py
+
+Intent-prefixed reply candidates from a seq2seq model (flan-t5-base).
+
+- Each email gets one candidate per intent. The intent is a forced start of the
+  reply (decoder prefix), not part of the prompt, so every intent shares the same
+  encoder input: the encoder runs once per batch and its output is reused for all
+  intents
+- Intents whose prefixes have the same token length are decoded in one generate
+  call; prefixes of different lengths cannot share a call because T5 has no left
+  padding for decoder inputs, so there is one call per distinct prefix length
+
+The model and tokenizer are passed in by the caller: Summary_and_tone.py serves
+replies with them, and autotune.py times this same code path, so the tuned batch
+size counts emails rather than generated rows.
+"""
+
+import torch
+from transformers.modeling_outputs import BaseModelOutput
+
+from email_text import clean_text
+
+REPLY_INTENTS = [
+    ("reply", ""),                      # the plain reply, kept as smartReply
+    ("accept", "Yes, I"),
+    ("decline", "Unfortunately, I"),
+    ("more_info", "Could you please"),
+]
+REPLY_KWARGS = {"max_length": 150, "min_length": 20, "do_sample": False}
+FALLBACK_REPLY = "Thank you for your email. I'll get back to you shortly."
+
+def reply_prompt(email_subject, email_body, email_snippet):
+    # Use snippet or body for context
+    email_text = clean_text(email_body) if email_body and len(email_body) < 500 else clean_text(email_snippet)
+
+    # Limit text length
+    if len(email_text) > 300:
+        email_text = email_text[:300]
+
+    return f"Write a polite and professional email reply to this message:\n\nSubject: {email_subject}\nMessage: {email_text}\n\nReply:"
+
+def generate_replies(model, tokenizer, emails):
+    """Reply candidates for [(subject, body, snippet), ...]: [[{"intent", "text"}, ...], ...]"""
+    start = model.config.decoder_start_token_id
+    prefixes = [[start] + tokenizer(prefix, add_special_tokens=False)["input_ids"] for _, prefix in REPLY_INTENTS]
+    by_length = {}
+    for intent, prefix in enumerate(prefixes):
+        by_length.setdefault(len(prefix), []).append(intent)
+
+    replies = [[None] * len(REPLY_INTENTS) for _ in emails]
+    with torch.no_grad():
+        inputs = tokenizer([reply_prompt(*e) for e in emails], return_tensors="pt",
+                           padding=True, truncation=True).to(model.device)
+        hidden = model.get_encoder()(**inputs).last_hidden_state
+        for intents in by_length.values():
+            # Rows are email-major: email 0 x every intent, then email 1, ...
+            k = len(intents)
+            output = model.generate(
+                encoder_outputs=BaseModelOutput(last_hidden_state=hidden.repeat_interleave(k, dim=0)),
+                attention_mask=inputs["attention_mask"].repeat_interleave(k, dim=0),
+                decoder_input_ids=torch.tensor([prefixes[i] for i in intents] * len(emails), device=model.device),
+                **REPLY_KWARGS
+            )
+            for row, text in enumerate(tokenizer.batch_decode(output, skip_special_tokens=True)):
+                replies[row // k][intents[row % k]] = text.strip()
+
+    return [[{"intent": name, "text": text} for (name, _), text in zip(REPLY_INTENTS, texts)]
+            for texts in replies]
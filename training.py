@@ -1,16 +1,16 @@
 #!/usr/bin/env python3
 import os
-import re
 import torch
 import numpy as np
-import pandas as pd
-from datasets import load_dataset, Dataset
 from transformers import (AutoTokenizer, AutoModelForSeq2SeqLM,
-                          Seq2SeqTrainer, Seq2SeqTrainingArguments,
+                          Seq2SeqTrainingArguments,
                           DataCollatorForSeq2Seq, pipeline)
 import nltk
 from nltk.sentiment import SentimentIntensityAnalyzer
 
+from training_data import load_tokenized_split, TokenBudgetSeq2SeqTrainer, MAX_SOURCE_LEN
+from training_profile import cpu_training_profile
+
 # -------------------------
 # 1. SETUP
 # -------------------------
@@ -18,8 +18,17 @@ MODEL_NAME = "sshleifer/distilbart-cnn-12-6"
 LOCAL_MODEL_DIR = "./distilbart_finetuned"
 BATCH_SIZE = 4
 EPOCHS = 1  # adjust as needed
-MAX_SOURCE_LEN = 512
 MAX_TARGET_LEN = 150
+# Token-budget batches never cost more than BATCH_SIZE full-length rows: padded
+# source + label tokens, label tokens alone (decoder logits), and at most MAX_BATCH_SIZE rows
+MAX_TOKENS_PER_BATCH = BATCH_SIZE * (MAX_SOURCE_LEN + MAX_TARGET_LEN)
+MAX_LABEL_TOKENS_PER_BATCH = BATCH_SIZE * MAX_TARGET_LEN
+MAX_BATCH_SIZE = 4 * BATCH_SIZE
+
+# CPU profile (used only when CUDA is unavailable, see training_profile.py)
+GRAD_ACCUM_STEPS = 2       # micro-batches of MAX_TOKENS_PER_BATCH / GRAD_ACCUM_STEPS
+FREEZE_ENCODER = False
+FREEZE_LOWER_LAYERS = 0    # e.g. 6 freezes the bottom half of the 12-layer encoder
 
 os.makedirs(LOCAL_MODEL_DIR, exist_ok=True)
 
@@ -33,45 +42,16 @@ print(f"✅ Using {'GPU' if device==0 else 'CPU'}")
 tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
 model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_NAME)
 
-# -------------------------
-# 3. LOAD DATASET
-# -------------------------
-print("⏳ Loading HuggingFace dataset...")
-hf_dataset = load_dataset("sidhq/email-thread-summary")
-train_df = pd.DataFrame(hf_dataset["train"])
-
-# -------------------------
-# 4. CLEAN & PREPROCESS
-# -------------------------
-def clean_email_text(text):
-    if text is None: return ""
-    text = re.sub(r"-----Original Message-----.*", " ", text, flags=re.DOTALL|re.IGNORECASE)
-    text = re.sub(r"__+|--+|\*\*+", " ", text)
-    text = re.sub(r"\b[\w\.-]+@[\w\.-]+\.\w+\b", " ", text)
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
-
-def flatten_thread(thread):
-    subject = thread.get("subject","") if isinstance(thread, dict) else ""
-    messages = thread.get("messages",[]) if isinstance(thread, dict) else []
-    cleaned_messages = [clean_email_text(m.get("body","")) for m in messages if isinstance(m, dict)]
-    flat_text = subject + " \n " + " \n ".join(cleaned_messages)
-    return flat_text
-
-train_df["flat_text"] = train_df["thread"].apply(flatten_thread)
-train_df["summary"] = train_df["summary"].fillna("")
+cpu_args = {}
+if device == -1:
+    cpu_args = cpu_training_profile(model, grad_accum_steps=GRAD_ACCUM_STEPS,
+                                    freeze_encoder=FREEZE_ENCODER, freeze_lower_layers=FREEZE_LOWER_LAYERS)
 
 # -------------------------
-# 5. TOKENIZATION
+# 3-5. LOAD, CLEAN & TOKENIZE (cached on disk, see training_data.py)
 # -------------------------
-def tokenize(batch):
-    inputs = tokenizer(batch["flat_text"], max_length=MAX_SOURCE_LEN, truncation=True)
-    targets = tokenizer(batch["summary"], max_length=MAX_TARGET_LEN, truncation=True)
-    inputs["labels"] = targets["input_ids"]
-    return inputs
-
-train_dataset = Dataset.from_pandas(train_df)
-tokenized_train = train_dataset.map(tokenize, batched=True)
+print("⏳ Loading HuggingFace dataset...")
+tokenized_train = load_tokenized_split(tokenizer, MAX_SOURCE_LEN, MAX_TARGET_LEN)
 
 # -------------------------
 # 6. DATA COLLATOR
@@ -90,24 +70,30 @@ training_args = Seq2SeqTrainingArguments(
     num_train_epochs=EPOCHS,
     logging_steps=50,
     fp16=device==0,
-    push_to_hub=False
+    push_to_hub=False,
+    **cpu_args
 )
 
 # -------------------------
 # 8. TRAINER
 # -------------------------
-trainer = Seq2SeqTrainer(
+trainer = TokenBudgetSeq2SeqTrainer(
     model=model,
     args=training_args,
     train_dataset=tokenized_train,
     tokenizer=tokenizer,
-    data_collator=data_collator
+    data_collator=data_collator,
+    max_tokens_per_batch=MAX_TOKENS_PER_BATCH // cpu_args.get("gradient_accumulation_steps", 1),
+    max_label_tokens_per_batch=MAX_LABEL_TOKENS_PER_BATCH // cpu_args.get("gradient_accumulation_steps", 1),
+    max_batch_size=max(1, MAX_BATCH_SIZE // cpu_args.get("gradient_accumulation_steps", 1)),
 )
 
 print("⏳ Starting fine-tuning...")
 trainer.train()
-print(f"✅ Fine-tuned model saved at {LOCAL_MODEL_DIR}")
+# Re-enable the KV cache before saving, so the saved config generates with it too
+model.config.use_cache = True
 trainer.save_model(LOCAL_MODEL_DIR)
+print(f"✅ Fine-tuned model saved at {LOCAL_MODEL_DIR}")
 
 # -------------------------
 # 9. TONE DETECTION
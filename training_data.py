@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+training_data.py
+
+Shared data pipeline for training.py and Analysis.py.
+
+- Flatten/clean and tokenize run as batched, multi-process Dataset.map stages
+  on the Arrow table (no pandas round trip)
+- Fixed held-out eval split shared by training and evaluate_models.py
+- Tokenized splits cached on disk, keyed by tokenizer + max lengths
+- Length-grouped batches packed up to a token budget instead of a fixed size;
+  the budget counts padded source and label tokens, with caps on label tokens and
+  rows, so no batch costs more than the fixed-size batch it replaces
+  (`python training_data.py` checks this on synthetic lengths)
+- Seq2SeqTrainer subclass that uses them and logs tokens/sec, samples/sec,
+  padding fraction and peak memory
+"""
+
+import os
+import json
+import time
+import random
+import shutil
+import hashlib
+
+from datasets import load_dataset, load_from_disk
+from torch.utils.data import DataLoader, Sampler
+from transformers import Seq2SeqTrainer
+
+import email_text
+from email_text import flatten_thread
+from feature_store import code_version
+from training_profile import peak_memory_mb
+
+DATASET_NAME = "sidhq/email-thread-summary"
+TOKENIZED_CACHE_DIR = "./cache/tokenized"
+NUM_PROC = min(8, os.cpu_count() or 1)
+EVAL_FRACTION = 0.05
+SPLIT_SEED = 42
+# Source tokens seen in training, distillation pseudo-labels and evaluation alike
+MAX_SOURCE_LEN = 512
+
+def source_prefix(model):
+    """Task prefix the model expects in front of the thread (T5 models are trained with one)."""
+    return "summarize: " if model.config.model_type == "t5" else ""
+
+# -------------------------
+# SPLITS
+# -------------------------
+def load_splits(dataset_name=DATASET_NAME):
+    """Return {"train", "eval"}: the dataset's test split if it has one, else a seeded hold-out of train."""
+    hf_dataset = load_dataset(dataset_name)
+    if "test" in hf_dataset:
+        return {"train": hf_dataset["train"], "eval": hf_dataset["test"]}
+    split = hf_dataset["train"].train_test_split(test_size=EVAL_FRACTION, seed=SPLIT_SEED)
+    return {"train": split["train"], "eval": split["test"]}
+
+# -------------------------
+# TOKENIZED DATASET CACHE
+# -------------------------
+def tokenized_cache_key(tokenizer, max_source_len, max_target_len, fingerprint):
+    """Everything that changes the token ids goes into the key."""
+    parts = {
+        "tokenizer": tokenizer.name_or_path,
+        "tokenizer_class": type(tokenizer).__name__,
+        "vocab_size": len(tokenizer),
+        "max_source_len": max_source_len,
+        "max_target_len": max_target_len,
+        "dataset": fingerprint,
+        # email_text as a module: its regexes change the cleaned text as much as its functions
+        "cleaning": code_version(email_text, flatten_batch, build_tokenize_fn),
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def build_tokenize_fn(tokenizer, max_source_len, max_target_len):
+    def tokenize(batch):
+        """Tokenize input (email thread) and target (summary)."""
+        inputs = tokenizer(batch["flat_text"], max_length=max_source_len, truncation=True)
+        targets = tokenizer(batch["summary"], max_length=max_target_len, truncation=True)
+        inputs["labels"] = targets["input_ids"]
+        inputs["length"] = [len(ids) for ids in inputs["input_ids"]]
+        inputs["label_length"] = [len(ids) for ids in targets["input_ids"]]
+        return inputs
+    return tokenize
+
+def flatten_batch(batch):
+    """Flatten a batch of threads into model input text; replaces every input column."""
+    return {
+        "flat_text": [flatten_thread(thread)[0] for thread in batch["thread"]],
+        "summary": [summary or "" for summary in batch["summary"]],
+    }
+
+def load_tokenized_split(tokenizer, max_source_len, max_target_len, split="train",
+                         dataset_name=DATASET_NAME, cache_dir=TOKENIZED_CACHE_DIR, num_proc=NUM_PROC):
+    """Return the tokenized split ("train" or "eval"), from disk when the same tokenizer/settings were used before."""
+    split_ds = load_splits(dataset_name)[split]
+    key = tokenized_cache_key(tokenizer, max_source_len, max_target_len, split_ds._fingerprint)
+    path = os.path.join(cache_dir, f"{split}-{key}")
+    if os.path.isdir(path):
+        print(f"✅ Loaded tokenized '{split}' split from cache: {path}")
+        return load_from_disk(path)
+
+    print(f"⏳ Tokenizing '{split}' split (cache miss, num_proc={num_proc})...")
+    num_proc = num_proc if num_proc and num_proc > 1 else None
+    flat = split_ds.map(flatten_batch, batched=True, num_proc=num_proc,
+                        remove_columns=split_ds.column_names, desc="Flattening threads")
+    tokenized = flat.map(build_tokenize_fn(tokenizer, max_source_len, max_target_len),
+                         batched=True, num_proc=num_proc,
+                         remove_columns=flat.column_names, desc="Tokenizing")
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tokenized.save_to_disk(tmp)
+    os.replace(tmp, path)
+    print(f"✅ Cached tokenized '{split}' split at {path}")
+    return load_from_disk(path)
+
+# -------------------------
+# TOKEN-BUDGET BATCHING
+# -------------------------
+class TokenBudgetBatchSampler(Sampler):
+    """Group examples of similar length and fill each batch up to max_tokens padded tokens.
+
+    A batch costs rows x (longest source + longest label), since the collator pads
+    both. max_label_tokens caps rows x longest label on its own (decoder activations
+    and vocabulary-sized logits grow with it), and max_batch_size caps the rows.
+
+    Indices are shuffled, cut into pools of pool_size, and each pool is sorted by
+    length before packing, so batches are length-homogeneous but still differ
+    between epochs. Batch order is shuffled as well.
+    """
+
+    def __init__(self, lengths, max_tokens, max_batch_size=None, label_lengths=None, max_label_tokens=None,
+                 shuffle=True, seed=42, pool_size=2048):
+        self.lengths = list(lengths)
+        self.label_lengths = list(label_lengths) if label_lengths is not None else [0] * len(self.lengths)
+        self.max_tokens = max_tokens
+        self.max_label_tokens = max_label_tokens
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.pool_size = pool_size
+        self.epoch = 0
+        self._batches = None
+
+    def _build(self):
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+        batches = []
+        for start in range(0, len(indices), self.pool_size):
+            pool = sorted(indices[start:start + self.pool_size],
+                          key=lambda i: (self.lengths[i], self.label_lengths[i]))
+            batch, longest, longest_label = [], 0, 0
+            for i in pool:
+                source = max(longest, self.lengths[i])
+                label = max(longest_label, self.label_lengths[i])
+                rows = len(batch) + 1
+                over = (rows * (source + label) > self.max_tokens
+                        or (self.max_label_tokens and rows * label > self.max_label_tokens)
+                        or (self.max_batch_size and rows > self.max_batch_size))
+                if batch and over:
+                    batches.append(batch)
+                    batch, source, label = [], self.lengths[i], self.label_lengths[i]
+                batch.append(i)
+                longest, longest_label = source, label
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def __iter__(self):
+        batches = self._batches or self._build()
+        self._batches = None
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        if self._batches is None:
+            self._batches = self._build()
+        return len(self._batches)
+
+class TokenBudgetSeq2SeqTrainer(Seq2SeqTrainer):
+    """Seq2SeqTrainer with token-budget batches and throughput/padding/memory logging.
+
+    With max_tokens_per_batch unset it batches exactly like Seq2SeqTrainer and
+    only adds the tokens_per_sec / samples_per_sec / padding_fraction /
+    peak_memory_mb log entries.
+    """
+
+    def __init__(self, *args, max_tokens_per_batch=None, max_label_tokens_per_batch=None,
+                 max_batch_size=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.max_label_tokens_per_batch = max_label_tokens_per_batch
+        self.max_batch_size = max_batch_size
+        self._real_tokens = 0
+        self._padded_tokens = 0
+        self._samples = 0
+        self._throughput_start = None
+
+    def get_train_dataloader(self):
+        if not self.max_tokens_per_batch or "length" not in self.train_dataset.column_names:
+            return super().get_train_dataloader()
+        lengths = self.train_dataset["length"]
+        if "label_length" in self.train_dataset.column_names:
+            label_lengths = self.train_dataset["label_length"]
+        else:
+            label_lengths = [len(ids) for ids in self.train_dataset["labels"]]
+        dataset = self._remove_unused_columns(self.train_dataset, description="training")
+        sampler = TokenBudgetBatchSampler(lengths, self.max_tokens_per_batch, self.max_batch_size,
+                                          label_lengths, self.max_label_tokens_per_batch, seed=self.args.seed)
+        loader = DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(loader) if hasattr(self, "accelerator") else loader
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        if self._throughput_start is None:
+            self._throughput_start = time.perf_counter()
+        mask = inputs.get("attention_mask")
+        labels = inputs.get("labels")
+        if inputs.get("input_ids") is not None:
+            self._samples += inputs["input_ids"].shape[0]
+        if mask is not None:
+            self._real_tokens += int(mask.sum())
+            self._padded_tokens += mask.numel()
+        if labels is not None:
+            self._real_tokens += int((labels != -100).sum())
+            self._padded_tokens += labels.numel()
+        return super().training_step(model, inputs, *args, **kwargs)
+
+    def log(self, logs, *args, **kwargs):
+        if self._padded_tokens and self._throughput_start is not None:
+            elapsed = max(time.perf_counter() - self._throughput_start, 1e-9)
+            logs["tokens_per_sec"] = round(self._real_tokens / elapsed, 1)
+            logs["samples_per_sec"] = round(self._samples / elapsed, 3)
+            logs["padding_fraction"] = round(1 - self._real_tokens / self._padded_tokens, 4)
+        peak = peak_memory_mb()
+        if peak is not None:
+            logs["peak_memory_mb"] = peak
+        super().log(logs, *args, **kwargs)
+
+# -------------------------
+# SELF-CHECK
+# -------------------------
+def self_check(batch_size=4, max_source_len=MAX_SOURCE_LEN, max_target_len=150, n=20000):
+    """No token-budget batch may cost more than a fixed batch of batch_size full-length rows."""
+    rng = random.Random(0)
+    # Mostly short threads and summaries, with a tail at the truncation limits
+    lengths = [min(max_source_len, int(rng.expovariate(1 / 120)) + 8) for _ in range(n)]
+    label_lengths = [min(max_target_len, int(rng.expovariate(1 / 40)) + 4) for _ in range(n)]
+    failures = 0
+    for accum in (1, 2):
+        max_tokens = batch_size * (max_source_len + max_target_len) // accum
+        max_label_tokens = batch_size * max_target_len // accum
+        max_batch_size = max(1, 4 * batch_size // accum)
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens, max_batch_size, label_lengths, max_label_tokens)
+        seen = []
+        for batch in sampler:
+            rows = len(batch)
+            source = max(lengths[i] for i in batch)
+            label = max(label_lengths[i] for i in batch)
+            if rows * (source + label) > max_tokens or rows * label > max_label_tokens or rows > max_batch_size:
+                failures += 1
+                print(f"FAIL accum={accum}: {rows} rows x ({source} + {label}) tokens over budget")
+            seen.extend(batch)
+        if sorted(seen) != list(range(n)):
+            failures += 1
+            print(f"FAIL accum={accum}: batches do not cover every example exactly once")
+        print(f"accum={accum}: {len(sampler)} batches, {n / len(sampler):.1f} rows on average "
+              f"(fixed batches: {n / (batch_size / accum):.0f})")
+    print(f"{'OK' if not failures else f'{failures} failures'}")
+    return failures == 0
+
+if __name__ == "__main__":
+    raise SystemExit(0 if self_check() else 1)
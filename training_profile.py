@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+training_profile.py
+
+CPU fine-tuning profile for training.py and Analysis.py.
+
+- bf16 autocast when the CPU has native bf16 (AVX512-BF16 / AMX), else fp32
+- gradient checkpointing + gradient accumulation (effective batch is unchanged)
+- intra-op threads pinned to physical cores, a few dataloader workers
+- optional freezing of the encoder or its lower layers
+- peak memory reporting for the training logs
+"""
+
+import os
+import sys
+
+import torch
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# -------------------------
+# HARDWARE
+# -------------------------
+def physical_cores():
+    if psutil is not None:
+        cores = psutil.cpu_count(logical=False)
+        if cores:
+            return cores
+    # Assume 2-way SMT when psutil is unavailable
+    return max(1, (os.cpu_count() or 2) // 2)
+
+def cpu_supports_bf16():
+    """True when the CPU executes bf16 natively; emulated bf16 is slower than fp32."""
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            flags = f.read()
+        return "avx512_bf16" in flags or "amx_bf16" in flags
+    except OSError:
+        return False
+
+def peak_memory_mb():
+    """Peak resident memory of this process in MB, or None if it cannot be read."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is KB on Linux, bytes on macOS
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / (1024 * 1024), 1)
+    return None
+
+def current_memory_mb():
+    """Resident memory of this process right now in MB, or None if it cannot be read."""
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as f:
+            resident_pages = int(f.read().split()[1])
+        return round(resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    if psutil is not None:
+        return round(psutil.Process().memory_info().rss / (1024 * 1024), 1)
+    return None
+
+# -------------------------
+# PROFILE
+# -------------------------
+def configure_threads(intra_op=None, inter_op=1):
+    """Pin torch intra-op threads to physical cores; inter-op parallelism rarely helps training."""
+    intra_op = intra_op or physical_cores()
+    torch.set_num_threads(intra_op)
+    try:
+        torch.set_num_interop_threads(inter_op)
+    except RuntimeError:
+        # Only settable before the first parallel op runs
+        pass
+    # Tokenizers already ran; keep their thread pool out of the way of torch
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    return intra_op, torch.get_num_interop_threads()
+
+def freeze_layers(model, freeze_encoder=False, freeze_lower_layers=0):
+    """Stop gradients for the whole encoder or its first N layers (plus position embeddings).
+
+    Shared token embeddings stay trainable because the LM head is tied to them.
+    Returns (trainable, total) parameter counts.
+    """
+    encoder = model.get_encoder()
+    if freeze_encoder:
+        frozen = [encoder]
+    elif freeze_lower_layers:
+        layers = getattr(encoder, "layers", None) or getattr(encoder, "block", [])
+        frozen = list(layers[:freeze_lower_layers])
+        frozen += [m for m in (getattr(encoder, "embed_positions", None),
+                               getattr(encoder, "layernorm_embedding", None)) if m is not None]
+    else:
+        frozen = []
+    shared = model.get_input_embeddings().weight
+    for module in frozen:
+        for param in module.parameters():
+            if param is not shared:
+                param.requires_grad = False
+    if frozen:
+        # Checkpointed layers above frozen ones still need an input that requires grad
+        model.enable_input_require_grads()
+    trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    total = sum(p.numel() for p in model.parameters())
+    return trainable, total
+
+def cpu_training_profile(model, grad_accum_steps=2, freeze_encoder=False, freeze_lower_layers=0,
+                         intra_op_threads=None, dataloader_workers=2):
+    """Apply the CPU profile to model and return extra Seq2SeqTrainingArguments kwargs."""
+    intra, inter = configure_threads(intra_op_threads)
+    trainable, total = freeze_layers(model, freeze_encoder, freeze_lower_layers)
+    bf16 = cpu_supports_bf16()
+    model.config.use_cache = False  # incompatible with gradient checkpointing
+    print(f"🧮 CPU profile: threads={intra}/{inter}, bf16={bf16}, grad_accum={grad_accum_steps}, "
+          f"workers={dataloader_workers}, trainable params={trainable:,}/{total:,}")
+    return {
+        "bf16": bf16,
+        "gradient_checkpointing": True,
+        "gradient_accumulation_steps": grad_accum_steps,
+        "dataloader_num_workers": dataloader_workers,
+    }
@@ -17,6 +17,13 @@ let state = {
     latestNewEmailId: null
 };
 
+// search: email ids ranked by the server-side index (/api/search), null = filter locally
+let searchRanking = null;
+// Query searchRanking was computed for
+let searchRankingQuery = '';
+let searchTimer = null;
+const SEARCH_DEBOUNCE_MS = 150;
+
 /* -----------------------------
    DOM helpers & Utilities
    ----------------------------- */
@@ -90,7 +97,10 @@ function getFilteredEmails() {
     }
 
     // search
-    if (q) {
+    if (q && searchRanking) {
+        const rank = new Map(searchRanking.map((id, i) => [id, i]));
+        list = list.filter(e => rank.has(e.id)).sort((a, b) => rank.get(a.id) - rank.get(b.id));
+    } else if (q) {
         list = list.filter(e => (e.sender + ' ' + e.subject + ' ' + (e.preview || '') + ' ' + (e.body || '')).toLowerCase().includes(q));
     }
 
@@ -208,10 +218,25 @@ function renderPagination(total, pageCount) {
    Email open / reply / compose
    ----------------------------- */
 
+// Bodies live in the body store; fetch on first open, then re-render
+function ensureBody(email) {
+    if (email.body !== undefined || !email.bodyHash) return;
+    email.body = email.snippet || '';
+    fetch('/api/body/' + encodeURIComponent(email.bodyHash))
+        .then(res => res.ok ? res.json() : null)
+        .then(data => {
+            if (!data) return;
+            email.body = data.body;
+            if (state.selectedEmailId === email.id) openEmail(email.id);
+        })
+        .catch(err => console.error('Error loading body:', err));
+}
+
 function openEmail(id) {
     const email = emails.find(e => e.id === id);
     if (!email) return;
     state.selectedEmailId = id;
+    ensureBody(email);
     
     // mark read and clear new_email flag
     email.unread = false;
@@ -462,7 +487,35 @@ function applySearch() {
     const q = $('searchInput').value || '';
     state.search = q;
     state.page = 1;
-    renderEmails();
+    scheduleSearch();
+}
+
+/* Debounced query against the BM25 index; renders once results arrive */
+function scheduleSearch() {
+    clearTimeout(searchTimer);
+    const q = state.search.trim();
+    // Renders while the new query is pending must not use the previous ranking
+    if (q !== searchRankingQuery) searchRanking = null;
+    if (!q) {
+        searchRanking = null;
+        renderEmails();
+        return;
+    }
+    searchTimer = setTimeout(async () => {
+        let ranking = null;
+        try {
+            const res = await fetch('/api/search?q=' + encodeURIComponent(q));
+            const data = await res.json();
+            if (data.available) ranking = data.results.map(r => r.id);
+        } catch (err) {
+            console.error('Search request failed, filtering locally:', err);
+        }
+        // Ignore responses for a query the user has already changed
+        if (state.search.trim() !== q) return;
+        searchRanking = ranking;
+        searchRankingQuery = q;
+        renderEmails();
+    }, SEARCH_DEBOUNCE_MS);
 }
 
 function escapeHtml(unsafe) {
@@ -486,7 +539,7 @@ function escapeHtml(unsafe) {
     $('addLabelBtn').addEventListener('click', openCreateLabelModal);
     $('simulateNewMailBtn').addEventListener('click', simulateNewEmail);
 
-    $('searchInput').addEventListener('input', function () { state.search = this.value; state.page = 1; renderEmails(); });
+    $('searchInput').addEventListener('input', function () { state.search = this.value; state.page = 1; scheduleSearch(); });
 
     ['composeSubject', 'composeBody'].forEach(id => {
         $(id).addEventListener('input', updateComposeTone);